@@ -2,9 +2,200 @@
 #
 # Copyright (c) 2014 Michael Strosaker
 
-import itertools, math
+import array, bisect, collections, heapq, itertools, json, math, mmap
+import multiprocessing, numbers, random, struct, sys, time, weakref
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# stands in for log10(0.0) in the compiled tables
+_NEG_INF = float('-inf')
+
+# the tables of a compiled_hmm, in the order they are saved by hmm.save()
+_TABLES = ('log_initial', 'log_termination', 'log_transition',
+           'log_emission')
+
+# sequences of observations held as raw bytes, one symbol per byte (on
+# Python 2, str is taken to be text, as it always has been)
+_BUFFER_TYPES = (bytearray, memoryview, mmap.mmap)
+if bytes is not str:
+    _BUFFER_TYPES += (bytes,)
+
+# how far the probabilities of each distribution of a model may sum from 1.0
+_TOLERANCE = 1e-6
+
+# identifies the files written by hmm.save()
+_MAGIC = b'\x89HMM\r\n\x1a\n'
+_FORMAT_VERSION = 1
+
+def _byte_array(buf):
+    """
+    Returns a numpy array of unsigned bytes that shares the memory of a
+    bytes, bytearray, memoryview or mmap object.
+    """
+    try:
+        return numpy.frombuffer(buf, dtype=numpy.uint8)
+    except AttributeError:
+        # a memoryview, on Python 2
+        return numpy.frombuffer(buf.tobytes(), dtype=numpy.uint8)
+
+def _chars(buf):
+    """
+    Returns the one-character strings held in a bytes, bytearray,
+    memoryview or mmap object, as a single string.
+    """
+    chars = bytes(bytearray(buf))
+    if str is bytes:
+        return chars
+    return chars.decode('latin-1')
+
+def _bit_indices(bits):
+    """
+    Returns the positions of the bits set in an integer, in ascending
+    order.
+    """
+    indices = []
+    while bits:
+        low = bits & -bits
+        indices.append(low.bit_length() - 1)
+        bits ^= low
+    return indices
+
+def _alias(probabilities):
+    """
+    Builds the tables of the alias method (Vose's) for drawing from a
+    discrete distribution in constant time: drawing a column j uniformly,
+    and then keeping j with probability prob[j] or taking alias[j]
+    otherwise, draws each outcome with its probability.
+
+    Returns:
+      - a tuple of two lists, prob and alias, of the same length as
+        probabilities
+    """
+    m = len(probabilities)
+    total = math.fsum(probabilities)
+    scaled = [p * m / total for p in probabilities]
+    prob = [1.0] * m
+    alias = list(range(m))
+    small = [j for j, p in enumerate(scaled) if p < 1.0]
+    large = [j for j, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        j = small.pop()
+        k = large.pop()
+        prob[j] = scaled[j]
+        alias[j] = k
+        scaled[k] -= 1.0 - scaled[j]
+        if scaled[k] < 1.0:
+            small.append(k)
+        else:
+            large.append(k)
+    # whatever remains is (but for rounding) exactly 1.0, and kept
+    return (prob, alias)
+
+def _log10(p):
+    """
+    Returns the log (base 10) of a probability, or -inf if the probability
+    is 0 (or missing).
+    """
+    if not p or p <= 0.0:
+        return _NEG_INF
+    return math.log10(p)
+
+class _positions(dict):
+    """
+    Maps the keys of a distribution to the positions of their values;
+    shared by all of the distributions over the same keys.
+    """
+    __slots__ = ('order', '__weakref__')
+
+# the _positions objects in use, by the tuple of their keys
+_shared_positions = weakref.WeakValueDictionary()
+
+def _positions_of(keys):
+    positions = _shared_positions.get(keys)
+    if positions is None:
+        positions = _positions((key, i) for i, key in enumerate(keys))
+        positions.order = keys
+        _shared_positions[keys] = positions
+    return positions
+
+class _distribution(object):
+    """
+    A compact, read-mostly dictionary of probabilities: the values are held
+    in an array of doubles, and the keys (symbols or state names) in a
+    table that is shared by every distribution over the same keys, so that
+    the states of a model over one alphabet store a single copy of it.
+    Supports the usual dictionary lookups, iteration and comparison, and
+    assignment to a key (which is slower than with a dictionary if the key
+    is new).
+    """
+    __slots__ = ('_positions', '_values')
+
+    def __init__(self, probabilities=None):
+        items = list((probabilities or {}).items())
+        self._positions = _positions_of(tuple([key for key, p in items]))
+        self._values = array.array('d', [p for key, p in items])
+
+    def __getitem__(self, key):
+        return self._values[self._positions[key]]
+
+    def __setitem__(self, key, p):
+        i = self._positions.get(key)
+        if i is None:
+            self._positions = _positions_of(self._positions.order + (key,))
+            self._values.append(p)
+        else:
+            self._values[i] = p
+
+    def get(self, key, default=None):
+        i = self._positions.get(key)
+        if i is None:
+            return default
+        return self._values[i]
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __iter__(self):
+        return iter(self._positions.order)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._positions.order)
+
+    def values(self):
+        return self._values.tolist()
+
+    def items(self):
+        return list(zip(self._positions.order, self._values))
+
+    def __eq__(self, other):
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (_distribution, (dict(self.items()),))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class state(object):
+    __slots__ = ('name', 'p_initial', 'p_termination', '_emission',
+                 '_transition')
 
-class state:
     def __init__(self, name, p_initial, p_emission, p_transition,
                  p_termination=0.0):
         self.name = name			# string
@@ -13,6 +204,32 @@ class state:
         self.p_transition = p_transition	# dictionary (string: float)
         self.p_termination = p_termination	# float (between 0.0 and 1.0)
 
+    # the dictionaries are stored as _distribution objects (copied when
+    # they are assigned)
+    def _get_emission(self):
+        return self._emission
+
+    def _set_emission(self, p_emission):
+        self._emission = _distribution(p_emission)
+
+    p_emission = property(_get_emission, _set_emission)
+
+    def _get_transition(self):
+        return self._transition
+
+    def _set_transition(self, p_transition):
+        self._transition = _distribution(p_transition)
+
+    p_transition = property(_get_transition, _set_transition)
+
+    def __getstate__(self):
+        return (self.name, self.p_initial, self._emission, self._transition,
+                self.p_termination)
+
+    def __setstate__(self, d):
+        (self.name, self.p_initial, self._emission, self._transition,
+         self.p_termination) = d
+
     def __repr__(self):
         ret = ['hmm.state(']
         ret.append("'%s'," % self.name)
@@ -23,390 +240,3874 @@ class state:
         ret.append(')')
         return '\n'.join(ret)
 
-class hmm:
-    def __init__(self, alphabet, states):
+class compiled_hmm:
+    def __init__(self, model=None):
         """
-        Creates a new hidden Markov model object.
+        Creates an integer-indexed form of an hmm object, suitable for the
+        inner loops of the decoding algorithms.  (Without a model, creates
+        an empty object for load() to fill in.)
 
-        Parameters:
-          - alphabet: a list of strings, where each string represents a
-            symbol that can possibly be emitted by any of the states in
-            the model (for example, ['A', 'C', 'G', 'T'] for genomic data)
-          - states: a list of state objects
+        State names and alphabet symbols are mapped to dense indices (in
+        the order of the states dictionary and the alphabet), and the
+        probabilities are replaced by their logs (base 10), computed once.
+        Impossible events are represented by -inf.
 
-        The initial distribution vector (usually referred to as pi) is
-        described by the states with non-zero values for p_initial.
+        Members:
+          - names: a list of state names; the index of a name in this list
+            is the index of the state in all of the tables
+          - index: a dictionary mapping state names to indices
+          - symbols: a list of symbols; the alphabet of the model, followed
+            by any symbols emitted by the states that are not in it
+          - symbol_index: a dictionary mapping symbols to indices
+          - unknown: the index used for symbols that are not in symbols;
+            no state can emit it
+          - log_initial: a list of the log initial probabilities, by state
+          - log_transition: a list of lists; log_transition[i][j] is the log
+            probability of transitioning from state i to state j
+          - log_emission: a list of lists; log_emission[k][j] is the log
+            probability of state j emitting symbol k (the rows are indexed
+            by symbol so that a trellis column needs a single lookup)
+          - log_termination: a list of the log probabilities of transitioning
+            to the implied terminal state, by state; all 0.0 if the model
+            has no terminal state
+          - predecessors: a list of lists; predecessors[j] holds a tuple
+            (i, log_transition[i][j]) for each state i with an edge to
+            state j, in order of i
+          - successors: a list of lists; successors[i] holds a tuple
+            (j, log_transition[i][j]) for each state j with an edge from
+            state i, in order of j
+          - terminal_state: True if the model has an implied terminal state
+          - log10_calls: the number of logs taken to build the tables (0
+            for a model loaded from a file), reported by stats objects
 
-        If at least one of the states in the states parameter includes a
-        non-zero p_termination, then there is an implied "end" state.
-        In that case, only those states with a non-zero p_termination
-        can be the last state in a valid sequence of states.
+        The decoding algorithms only visit the edges in predecessors and
+        successors, so the cost of each trellis column is proportional to
+        the number of edges in the model rather than the square of the
+        number of states.
+        """
+        self._engines = {}
+        self._tables = None
+        self.log10_calls = 0
+        if model is None:
+            return
 
-        TODO: Data validation:
-          - ensure that all of the p_initial probabilities add up to
-            (about) 1,0
-          - ensure that the probabilities in the p_emission dictionaries
-            add up to (about) 1.0 for each state
-          - ensure that the probabilities in the p_transition dictionaries
-            (plus p_termination, if non-zero) add up to (about) 1.0 for
-            each state
-          - ensure that there are no duplicate state names
-          - ensure that no states will attempt to transition to non-
-            existent states
-          - ensure that no states will emit values that are not in the
-            specified alphabet
-          - ensure that all states are reachable
+        self.names = list(model.states.keys())
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        n = len(self.names)
+
+        self.symbols = list(model.alphabet)
+        for name in self.names:
+            for sym in (model.states[name].p_emission or {}):
+                if sym not in self.symbols:
+                    self.symbols.append(sym)
+        self.symbol_index = dict((sym, k) for k, sym in enumerate(self.symbols))
+        self.unknown = len(self.symbols)
+
+        self.terminal_state = model.terminal_state
+        self.log_initial = []
+        self.log_termination = []
+        self.log_transition = []
+        self.log_emission = [[_NEG_INF] * n
+                             for k in range(len(self.symbols) + 1)]
+        for i, name in enumerate(self.names):
+            s = model.states[name]
+            self.log_initial.append(_log10(s.p_initial))
+            if self.terminal_state:
+                self.log_termination.append(_log10(s.p_termination))
+            else:
+                self.log_termination.append(0.0)
+
+            row = [_NEG_INF] * n
+            for to_state, p in (s.p_transition or {}).items():
+                if to_state in self.index:
+                    row[self.index[to_state]] = _log10(p)
+                    self.log10_calls += 1
+            self.log_transition.append(row)
+
+            for sym, p in (s.p_emission or {}).items():
+                self.log_emission[self.symbol_index[sym]][i] = _log10(p)
+                self.log10_calls += 1
+            self.log10_calls += 2 if self.terminal_state else 1
+
+        self._build_adjacency()
+
+    def _build_adjacency(self):
+        n = len(self.names)
+        self.predecessors = [[] for i in range(n)]
+        self.successors = [[] for i in range(n)]
+        if self._tables is not None:
+            # only the edges are read from the (memory-mapped) matrix
+            table = self._tables['log_transition']
+            rows, cols = numpy.nonzero(table != _NEG_INF)
+            edges = zip(rows.tolist(), cols.tolist(),
+                        table[rows, cols].tolist())
+        else:
+            edges = ((i, j, p) for i, row in enumerate(self.log_transition)
+                     for j, p in enumerate(row) if p != _NEG_INF)
+        for i, j, p in edges:
+            self.predecessors[j].append((i, p))
+            self.successors[i].append((j, p))
+
+    def __getattr__(self, name):
+        # a model loaded from a file holds its tables as (memory-mapped)
+        # arrays; the lists used by the python engine are only built if
+        # they are needed, one table at a time
+        tables = self.__dict__.get('_tables')
+        if tables is None:
+            raise AttributeError(name)
+        if name in _TABLES:
+            setattr(self, name, tables[name].tolist())
+        elif name in ('predecessors', 'successors'):
+            self._build_adjacency()
+        else:
+            raise AttributeError(name)
+        return getattr(self, name)
+
+    def edge(self, i, j):
         """
-        self.alphabet = alphabet
-        self.terminal_state = False
-        self.initial_states = []
-        self.terminating_states = []
-        self.states = {}
-        for state in states:
-            self.states[state.name] = state
-            if state.p_initial > 0.0:
-                self.initial_states.append(state.name)
-            if state.p_termination > 0.0:
-                self.terminal_state = True
-                self.terminating_states.append(state.name)
+        Returns the log probability of the transition from state i to
+        state j (-inf if there is no edge).
+        """
+        if self._tables is not None:
+            return float(self._tables['log_transition'][i, j])
+        return self.log_transition[i][j]
 
-    def __repr__(self):
-        ret = ['hmm.hmm(']
-        ret.append('%s,' % self.alphabet)
-        ret.append('[')
-        for s_name, s in self.states.iteritems():
-            ret.append('%s,' % repr(s))
-        ret.append(']')
-        ret.append(')')
-        return '\n'.join(ret)
+    def encode(self, observed):
+        """
+        Translates a sequence of symbols into a sequence of symbol indices;
+        symbols that are not known to the model map to self.unknown.
 
-    def score(self, seq_state, seq_observed):
+        Raw bytes (bytes, bytearray, memoryview or mmap objects) are taken
+        to hold one single-character symbol per byte, and are translated
+        through byte_table() without creating an object per symbol.
+        Integer arrays (numpy arrays or array.array objects) are taken to
+        hold symbol indices already; indices outside of the range of
+        self.symbols map to self.unknown, and arrays without any such
+        index are returned as they are.  The indices are returned in a
+        numpy array (with numpy) or an array.array for these inputs, and in
+        a list otherwise.
         """
-        Calculates the log (base 10) of the probability of observing this
-        sequence of states and observations.
+        if isinstance(observed, _BUFFER_TYPES):
+            if numpy is not None:
+                return self.byte_table(True)[_byte_array(observed)]
+            if self.unknown < 256:
+                return array.array('B', bytearray(observed).translate(
+                                            self.byte_table()))
+            table = self.byte_table()
+            return array.array('l', [table[b] for b in bytearray(observed)])
+
+        if isinstance(observed, array.array) and observed.typecode in \
+           'bBhHiIlL':
+            if numpy is None:
+                unknown = self.unknown
+                return [k if 0 <= k < unknown else unknown
+                        for k in observed]
+            observed = numpy.frombuffer(observed, dtype=observed.typecode)
+        if numpy is not None and isinstance(observed, numpy.ndarray) and \
+           observed.dtype.kind in 'iu':
+            if len(observed) == 0 or (observed.min() >= 0 and
+                                      observed.max() < self.unknown):
+                return observed
+            return numpy.where((observed >= 0) & (observed < self.unknown),
+                               observed, self.unknown)
+
+        get = self.symbol_index.get
+        unknown = self.unknown
+        return [get(sym, unknown) for sym in observed]
+
+    def byte_table(self, as_array=False):
+        """
+        Returns the table that translates each byte value (0 to 255) into
+        the index of the single-character symbol it encodes, or
+        self.unknown; a numpy array if as_array is True, or else a
+        bytearray (a list if there are 256 symbols or more).
+        """
+        key = '_byte_array' if as_array else '_byte_table'
+        table = self.__dict__.get(key)
+        if table is None:
+            get = self.symbol_index.get
+            table = [get(chr(b), self.unknown) for b in range(256)]
+            if as_array:
+                table = numpy.array(table, dtype=numpy.min_scalar_type(
+                                                  self.unknown))
+            elif self.unknown < 256:
+                table = bytearray(table)
+            setattr(self, key, table)
+        return table
+
+    def viterbi(self, codes, beam=None, live=None):
+        """
+        Computes the columns of the Viterbi trellis for an encoded sequence
+        of observations.
 
         Parameters:
-          - seq_state: a list of strings, representing an ordered sequence
-            of states in the HMM
-          - seq_observed: a list of strings, representing an ordered sequence
-            of symbols that were observed
+          - codes: a list of symbol indices, as returned by encode()
+          - beam: None, or a beam object; if given, the cells that fall
+            outside of the beam are pruned (set to -inf) in every column
+            but the last
+          - live: None, or the states that may be occupied at each
+            position, as returned by reachable(); only those cells are
+            computed, and all others are -inf
         Returns:
-          - a float, representing the log (base 10) of the probability
-            of the state sequence being observed
-          - None if the specified state sequence is invalid because:
-           - the first state in the sequence cannot be an initial state (has
-             a p_initial of 0)
-           - there is no edge between two consecutive states in the state
-             sequence (i.e., the probability of transitioning from state[i] to
-             state[i+1] is 0 for some i)
-           - a state cannot emit the corresponding symbol in the sequence of
-             observations (i.e., seq_state[i] cannot emit seq_observed[i] for
-             some i)
-           - the model has a terminating state, and the last state in the
-             sequence does not have an edge to the terminating state
+          - a tuple of two lists, each with one entry per observation:
+            - the columns of the trellis; each a list of log probabilities
+              indexed by state.  The last column does not include the
+              transition to the implied terminal state.
+            - the backpointers; each a list of the index of the best
+              predecessor of each state (-1 where there is none).  The
+              first entry is None.
+        """
+        if len(codes) == 0:
+            return ([], [])
 
-        TODO: Data validation:
-          - ensure that the specified sequence of observations only
-            includes symbols present in the alphabet
+        columns = []
+        backpointers = []
+        for col, bp in self._columns(codes, self.engine('python'), beam,
+                                     live):
+            columns.append(col)
+            backpointers.append(bp)
+
+        return (columns, backpointers)
+
+    def _columns(self, codes, e, beam=None, live=None):
         """
+        Generates the columns of the Viterbi trellis for an encoded sequence
+        of observations, as tuples (column, backpointers), pruning all but
+        the last one to the beam (if any), or restricting each one to its
+        live states (if given).
+        """
+        if live is not None:
+            if beam is not None:
+                raise ValueError('a beam cannot be used with constraints')
+            n = len(self.names)
+            col = e.first(codes[0])
+            if len(live[0]) < n:
+                col = e.mask(col, live[0])
+            yield (col, None)
+            for t in range(1, len(codes)):
+                col, bp = e.expand(col, live[t-1], codes[t])
+                if len(live[t]) < n:
+                    col = e.mask(col, live[t])
+                yield (col, bp)
+            return
 
-        # if there is an implied terminal state, make sure the last state
-        # in the specified sequence has an edge to it
-        if self.terminal_state:
-            if seq_state[-1] not in self.terminating_states:
-                return None
+        last = len(codes) - 1
+        col = e.first(codes[0])
+        bp = None
+        for t in range(len(codes)):
+            if t > 0:
+                if beam is None:
+                    col, bp = e.step(col, codes[t])
+                else:
+                    col, bp = e.expand(col, kept, codes[t])
+            if beam is not None and t < last:
+                kept = e.prune(col, beam)
+            yield (col, bp)
 
-        p = 0.0
-        state_prev = None
-        for i in range(len(seq_state)):
-            state_cur = self.states[seq_state[i]]
-            if i == 0:
-                # if the initial probability for this state is 0, then
-                # this is not a valid sequence of states
-                if state_cur.p_initial == 0.0:
-                    return None
+    def reachable(self, codes, constraints=None, engine=None):
+        """
+        Computes the states that can be occupied at each position of an
+        encoded sequence of observations by a path that explains the whole
+        sequence (and satisfies the constraints, if any): those that can be
+        reached from an initial state, and from which a state that can
+        transition to the implied terminal state (if any) can be reached,
+        through states that can emit the symbols at each position.
 
-                p += math.log10(state_cur.p_initial)
+        The sets of states are computed from the topology of the model
+        alone, with one pass forwards and one backwards; all of the other
+        cells of the trellis are provably -inf.  The python engine holds
+        each set as the bits of an integer, and the numpy engine as a
+        boolean vector.
 
-            else:
-                # check that the prior state can transition to this one
-                if seq_state[i] not in state_prev.p_transition.keys():
-                    return None
+        Parameters:
+          - codes: a list of symbol indices, as returned by encode()
+          - constraints: None, or the states allowed at each position;
+            either a dictionary mapping positions to allowed states, or a
+            sequence with one entry per position.  Each entry is a state
+            name, a collection of state names, or None (for any state).
+          - engine: the name of the engine to use (see engine())
+        Returns:
+          - a list with one entry per observation: the (ascending) indices
+            of the live states at that position (in a list, or a numpy
+            array with the numpy engine).  They are all empty if no path of
+            states can explain the observations.
+        """
+        allowed = self._allowed(constraints, len(codes))
+        if isinstance(self.engine(engine), _numpy_engine):
+            return self._reachable_numpy(codes, allowed)
+
+        def bits(indices):
+            return sum([1 << i for i in indices])
 
-                p += math.log10(state_prev.p_transition[seq_state[i]])
+        masks = self.__dict__.get('_masks')
+        if masks is None:
+            def possible(key):
+                # the indices of the possible events of a table, or of each
+                # of its rows (from the shared tables of a loaded model, if
+                # there are any)
+                if self._tables is not None:
+                    table = self._tables[key] != _NEG_INF
+                    if table.ndim == 1:
+                        return numpy.flatnonzero(table).tolist()
+                    return [numpy.flatnonzero(row).tolist() for row in table]
+                table = getattr(self, key)
+                if key in ('log_initial', 'log_termination'):
+                    return [j for j, p in enumerate(table) if p != _NEG_INF]
+                return [[j for j, p in enumerate(row) if p != _NEG_INF]
+                        for row in table]
 
-            # check that this state can emit the observed alphabet symbol
-            if seq_observed[i] not in state_cur.p_emission.keys():
-                return None
+            transition = possible('log_transition')
+            predecessors = [0] * len(self.names)
+            for i, row in enumerate(transition):
+                for j in row:
+                    predecessors[j] |= 1 << i
+            masks = (bits(possible('log_initial')),
+                     bits(possible('log_termination')),
+                     [bits(row) for row in transition],
+                     predecessors,
+                     [bits(row) for row in possible('log_emission')])
+            self._masks = masks
+        initial, final, successors, predecessors, emitting = masks
+        allowed = [None if states is None else bits(states)
+                   for states in allowed]
 
-            if state_cur.p_emission[seq_observed[i]] == 0.0:
-                return None
+        forward = []
+        for t, code in enumerate(codes):
+            if t == 0:
+                cur = initial
+            else:
+                cur = 0
+                for i in _bit_indices(forward[-1]):
+                    cur |= successors[i]
+            cur &= emitting[code]
+            if allowed[t] is not None:
+                cur &= allowed[t]
+            forward.append(cur)
 
-            p += math.log10(state_cur.p_emission[seq_observed[i]])
+        live = [None] * len(codes)
+        following = final
+        for t in range(len(codes) - 1, -1, -1):
+            indices = _bit_indices(forward[t] & following)
+            live[t] = indices
+            following = 0
+            for j in indices:
+                following |= predecessors[j]
+        return live
 
-            state_prev = state_cur
+    def _reachable_numpy(self, codes, allowed):
+        """
+        The vectorized form of reachable(), for the numpy engine.
+        """
+        e = self.engine('numpy')
+        n = len(self.names)
+        # the edges as 1.0, so that the states reached are found by a
+        # product with a (floating point) matrix
+        edges = (e.log_transition != _NEG_INF).astype(float)
+        emitting = e.log_emission != _NEG_INF
+        # the sets of states usually settle into a few that recur, so the
+        # successors of each set are remembered (by its bytes)
+        successors = {}
+        predecessors = {}
+        forward = numpy.zeros((len(codes), n), dtype=bool)
+        for t, code in enumerate(codes):
+            if t == 0:
+                cur = (e.log_initial != _NEG_INF) & emitting[code]
+            else:
+                key = forward[t-1].tobytes()
+                reached = successors.get(key)
+                if reached is None:
+                    reached = successors[key] = forward[t-1].dot(edges) > 0.0
+                cur = reached & emitting[code]
+            if allowed[t] is not None:
+                keep = numpy.zeros(n, dtype=bool)
+                keep[allowed[t]] = True
+                cur &= keep
+            forward[t] = cur
 
-        return p
+        live = [None] * len(codes)
+        following = e.log_termination != _NEG_INF
+        for t in range(len(codes) - 1, -1, -1):
+            cur = forward[t] & following
+            live[t] = numpy.flatnonzero(cur)
+            key = cur.tobytes()
+            following = predecessors.get(key)
+            if following is None:
+                following = predecessors[key] = edges.dot(cur) > 0.0
+        return live
 
-    def enumerate(self, observed):
+    def _allowed(self, constraints, length):
         """
-        Enumerates and prints every possible path of states that can
-        explain an observed sequence of symbols, along with the probability
-        associated with each of the state sequences.
+        Translates the constraints given to reachable() into a list of
+        lists of state indices (or None), one per position.
+        """
+        allowed = [None] * length
+        if constraints is None:
+            return allowed
+        if isinstance(constraints, dict):
+            items = constraints.items()
+        else:
+            if len(constraints) != length:
+                raise ValueError('expected %d constraints, got %d' %
+                                 (length, len(constraints)))
+            items = enumerate(constraints)
+        for t, states in items:
+            if not isinstance(t, numbers.Integral) or not 0 <= t < length:
+                raise ValueError('invalid position: %r' % (t,))
+            if states is None:
+                continue
+            try:
+                states = [self.index[states]]
+            except (KeyError, TypeError):
+                if isinstance(states, (type(''), type(u''))):
+                    raise ValueError('unknown state: %r' % (states,))
+                try:
+                    states = [self.index[name] for name in states]
+                except KeyError as err:
+                    raise ValueError('unknown state: %r' % (err.args[0],))
+            allowed[t] = sorted(set(states))
+        return allowed
 
-        *** IMPORTANT NOTE: ***
-        Enumerating all possible state sequences is an expensive operation
-        for models with many states and for long observations.  The number
-        of state sequences in the overall enumeration is:
-            (#states)^(len(observation))
+    def engine(self, name=None):
+        """
+        Returns the object that implements the per-column computations of
+        the decoding algorithms for this model.
 
         Parameters:
-          - seq_observed: a list of strings, representing an ordered sequence
-            of symbols that were observed
-        Returns: (nothing)
+          - name: 'python' for the pure-Python implementation, or 'numpy'
+            for the implementation vectorized over the states of the model
+            (which requires numpy); None for numpy if this model was
+            loaded by load() with numpy (so that it works on the shared
+            tables of the file, rather than on lists built by each
+            process), and python otherwise
+        """
+        if name is None:
+            if self._tables is not None:
+                name = 'numpy'
+            else:
+                name = 'python'
+        if name not in self._engines:
+            if name == 'python':
+                self._engines[name] = _python_engine(self)
+            elif name == 'numpy':
+                if numpy is None:
+                    raise ImportError('the numpy engine requires numpy')
+                self._engines[name] = _numpy_engine(self)
+            else:
+                raise ValueError('unknown engine: %s' % name)
+        return self._engines[name]
 
-        TODO: Data validation:
-          - ensure that the specified sequence of observations only
-            includes symbols present in the alphabet
+    def decode(self, codes, engine=None, checkpoint=None, beam=None,
+               record=None, live=None):
         """
-        best_seq = None
-        best_score = None
-        for seq in itertools.product(self.states.keys(), repeat=len(observed)):
-            s = self.score(seq, observed)
-            if s is not None:
-                print '%s: %f' % (seq, s)
-                if best_score is None:
-                    best_seq = seq
-                    best_score = s
-                elif s > best_score:
-                    best_seq = seq
-                    best_score = s
-
-        print 'BEST: %s: %f' % (best_seq, best_score)
+        Establishes the most probable path of states for an encoded
+        sequence of observations.
 
-    def _p_emit(self, state, observation):
+        Only the backpointers are retained for the whole sequence; the
+        trellis columns are discarded as soon as the next one is computed.
+
+        If checkpoint is given, not even the backpointers are retained:
+        the forward pass keeps only every checkpoint-th column, and the
+        traceback recomputes the backpointers of one segment between two
+        checkpoints at a time.  This takes about twice as long, but the
+        memory needed is proportional to the number of states times
+        (len(codes) / checkpoint + checkpoint); with checkpoint set to
+        True, the interval is the square root of the length of the
+        sequence, which minimizes it.  The result is exactly the same.
+
+        Parameters:
+          - codes: a list of symbol indices, as returned by encode()
+          - engine: the name of the engine to use (see engine())
+          - checkpoint: None, True, or the interval between checkpoints
+          - beam: None, or a beam object, to prune the cells of each
+            column that fall outside of the beam (this cannot be combined
+            with checkpoint)
+          - record: None, or a record of a stats object, to which the
+            work done is added (see stats)
+          - live: None, or the states that may be occupied at each
+            position, as returned by reachable(); only those cells are
+            computed (this cannot be combined with checkpoint or beam)
+        Returns:
+          - a tuple of two values:
+            - a list of state indices
+            - the log probability of the path, including the transition
+              to the implied terminal state
+          - (None, None) if no path of states can explain the observations
         """
-        Retrieves the probability of a state emitting a given symbol.
+        if len(codes) == 0:
+            return (None, None)
+
+        e = self.engine(engine)
+        if checkpoint:
+            if beam is not None:
+                raise ValueError('a beam cannot be used with checkpoints')
+            if live is not None:
+                raise ValueError('constraints cannot be used with '
+                                 'checkpoints')
+            return self._decode_checkpointed(codes, e, checkpoint, record)
+
+        began = time.time()
+        backpointers = e.backpointers(len(codes))
+        for t, (col, bp) in enumerate(self._columns(codes, e, beam, live)):
+            if t > 0:
+                backpointers[t] = bp
+            if record is not None:
+                record['pruned'] += e.unreachable(col)
+
+        best, p = e.best(e.terminate(col))
+        if record is not None:
+            self._count(record, codes, e, began, 'forward', live)
+            began = time.time()
+        if p == _NEG_INF:
+            return (None, None)
+        path = e.traceback(backpointers, best)
+        if record is not None:
+            record['seconds']['traceback'] += time.time() - began
+        return (path, p)
+
+    def _count(self, record, codes, e, began, phase='forward', live=None):
         """
-        if state not in self.states.keys():
-            return None
-        if observation not in self.states[state].p_emission.keys():
-            return 0.0
-        return self.states[state].p_emission[observation]
+        Adds the cells and transitions of a pass over the trellis of an
+        encoded sequence to a record of a stats object, along with the
+        time elapsed since began.  If the pass was restricted to the live
+        states returned by reachable(), only those cells, and the edges
+        out of them, are counted.
+        """
+        if live is None:
+            record['cells'] += len(codes) * len(self.names)
+            record['transitions'] += e.transitions(codes)
+        else:
+            degree = self.__dict__.get('_out_degree')
+            if degree is None:
+                if self._tables is not None:
+                    degree = (self._tables['log_transition'] !=
+                              _NEG_INF).sum(axis=1).tolist()
+                else:
+                    degree = [len(succs) for succs in self.successors]
+                self._out_degree = degree
+            record['cells'] += sum(len(states) for states in live)
+            record['transitions'] += sum(degree[i] for states in live[:-1]
+                                         for i in states)
+        record['seconds'][phase] += time.time() - began
 
-    def _p_transition(self, from_state, to_state):
+    def _decode_checkpointed(self, codes, e, interval, record=None):
         """
-        Retrieves the probability of a state transitioning to a given state.
+        The checkpointed form of decode().  The recomputation of the
+        segments is counted as part of the traceback.
         """
-        if from_state not in self.states.keys():
-            return None
-        if to_state not in self.states[from_state].p_transition.keys():
-            return 0.0
-        return self.states[from_state].p_transition[to_state]
+        if interval is True:
+            interval = int(math.ceil(math.sqrt(len(codes))))
+        if interval < 1:
+            raise ValueError('the checkpoint interval must be at least 1')
 
-    def _connected(self, from_state, to_state):
+        began = time.time()
+        checkpoints = []
+        col = e.first(codes[0])
+        for t in range(len(codes)):
+            if t > 0:
+                col, bp = e.step(col, codes[t])
+            if t % interval == 0:
+                checkpoints.append(col)
+            if record is not None:
+                record['pruned'] += e.unreachable(col)
+
+        best, p = e.best(e.terminate(col))
+        if record is not None:
+            self._count(record, codes, e, began)
+            began = time.time()
+        if p == _NEG_INF:
+            return (None, None)
+
+        # recompute the backpointers of each segment, from the last one to
+        # the first, and follow them back to the start of the segment
+        path = []
+        state = best
+        end = len(codes) - 1
+        for m in range(len(checkpoints) - 1, -1, -1):
+            start = m * interval
+            if start == end:
+                continue
+            col = checkpoints[m]
+            backpointers = e.backpointers(end - start + 1)
+            for t in range(start + 1, end + 1):
+                col, backpointers[t - start] = e.step(col, codes[t])
+            segment = e.traceback(backpointers, state)
+            path.extend(reversed(segment[1:]))
+            state = segment[0]
+            end = start
+        path.append(state)
+        path.reverse()
+        if record is not None:
+            record['seconds']['traceback'] += time.time() - began
+
+        return (path, p)
+
+    def transfer(self, codes, engine=None, first=False):
         """
-        Establishes whether there is an edge between two given states.
+        Computes the max-plus transfer matrix of a chunk of an encoded
+        sequence: the log probability of the best path through the chunk
+        from each state at the position before it to each state at its
+        last position.  The matrices of consecutive chunks can be combined
+        (see hmm.viterbi_path()) to decode the whole sequence exactly.
 
         Parameters:
-          - from_state: a state in the states member of this object
-          - to_state: a state in the states member of this object
+          - codes: the symbol indices of the chunk
+          - engine: the name of the engine to use (see engine())
+          - first: whether the chunk starts the sequence, in which case
+            the initial probabilities are used instead
         Returns:
-          - True if there is an edge from from_state to to_state
-          - False if there is no such edge, or if the from_state does not
-            exist
+          - a list of rows, one per state at the position before the chunk
+            (or a single row, if first), each a column of log
+            probabilities indexed by state at the last position
         """
-        if from_state not in self.states.keys():
-            return False
-        if to_state not in self.states[from_state].p_transition.keys():
-            return False
-        if self.states[from_state].p_transition[to_state] > 0.0:
-            return True
-        return False
+        e = self.engine(engine)
+        n = len(self.names)
+        rows = []
+        for i in ([None] if first else range(n)):
+            if i is None:
+                col = e.first(codes[0])
+                rest = codes[1:]
+            else:
+                col = e.unit(i)
+                rest = codes
+            for code in rest:
+                if e.unreachable(col) == n:
+                    break   # no path from state i
+                col, bp = e.step(col, code)
+            rows.append(col)
+        return rows
 
-    def trellis(self, observed):
+    def segment(self, codes, engine=None, start=None, end=None,
+                terminate=True):
         """
-        Builds a trellis of the probabilities of the possible paths,
-        given a sequence of observed symbols.
+        Decodes a chunk of an encoded sequence.
 
         Parameters:
-          - observed: a sequence of observed symbols
+          - codes: the symbol indices of the chunk
+          - engine: the name of the engine to use (see engine())
+          - start: the state at the position before the chunk; None if
+            the chunk starts the sequence, or -1 if it may be any state
+          - end: the state at the last position of the chunk, or None for
+            the best one
+          - terminate: with end None, whether the chunk ends the sequence
+            (and so the transition to the implied terminal state counts)
         Returns:
-          - a list of dictionaries, one dictionary per symbol in the
-            observations; each dictionary represents a column of the trellis
+          - a list of state indices, one per position of the chunk, or
+            None if no path of states can explain the chunk
+        """
+        e = self.engine(engine)
+        if start is None or start == -1:
+            col = e.first(codes[0]) if start is None else e.free(codes[0])
+            backpointers = e.backpointers(len(codes))
+            offset = 0
+        else:
+            col = e.unit(start)
+            backpointers = e.backpointers(len(codes) + 1)
+            offset = 1
+        for t in range(1, len(backpointers)):
+            col, backpointers[t] = e.step(col, codes[t - offset])
 
-        TODO: Data validation:
-          - ensure that the specified sequence of observations only
-            includes symbols present in the alphabet
+        if end is None:
+            if terminate:
+                col = e.terminate(col)
+            end, p = e.best(col)
+        else:
+            p = col[end]
+        if p == _NEG_INF:
+            return None
+        return e.traceback(backpointers, end)[offset:]
+
+    def paths(self, codes):
         """
-        state_names = self.states.keys()
-        trellis = []
-        prior_probs = None
+        Generates the paths of states that can explain an encoded sequence
+        of observations, in order of decreasing probability (ties are
+        broken in favor of lower state indices, so the first path is the
+        one returned by decode()).
 
-        for i in range(len(observed)):
-            probs = {}
+        This is the recursive enumeration algorithm of Jimenez and Marzal
+        (1999): the k-th best path into each cell of the trellis is
+        computed only when it is needed, from a heap of candidates built
+        from the previous column, so producing the first k paths takes
+        roughly k times the work of a traceback after a single Viterbi
+        pass.
+
+        Parameters:
+          - codes: a list of symbol indices, as returned by encode()
+        Returns:
+          - a generator of tuples (path, p), where path is a list of state
+            indices and p is the log probability of the path, including
+            the transition to the implied terminal state
+        """
+        if len(codes) == 0:
+            return
+        columns, backpointers = self.viterbi(codes)
+        last = len(codes) - 1
 
-            if i == 0:
-                # first state; only those states with initial probabilities
-                # can have non-None values in this column
-                for state in state_names:
-                    p_init = self.states[state].p_initial
-                    p_emit = self._p_emit(state, observed[i])
-                    if p_init == 0.0 or p_emit == 0.0:
-                        probs[state] = None
+        # ranked[t, j] is the list of the best paths into cell (t, j) found
+        # so far, as tuples (log probability, predecessor, rank of the path
+        # into the predecessor); candidates[t, j] is the heap of the next
+        # possible paths, and pending[t, j] is the path into the predecessor
+        # that must be added to the heap before the next one is popped
+        ranked = {}
+        candidates = {}
+        pending = {}
+
+        def ensure(t, j, k):
+            # compute the k-th best path into cell (t, j), if there is one,
+            # without recursion (the dependencies go back to the first
+            # column)
+            stack = [(t, j, k)]
+            while stack:
+                t, j, k = stack[-1]
+                paths = ranked.setdefault((t, j), [])
+                if len(paths) > k:
+                    stack.pop()
+                    continue
+                if t == 0:
+                    # there is only one path into each cell of the first
+                    # column
+                    if not paths and columns[0][j] != _NEG_INF:
+                        paths.append((columns[0][j], None, None))
                     else:
-                        probs[state] = math.log10(p_init) + \
-                                       math.log10(p_emit)
+                        exhausted.add((t, j))
+                    stack.pop()
+                    continue
+
+                heap = candidates.get((t, j))
+                if heap is None:
+                    heap = []
+                    emit = self.log_emission[codes[t]][j]
+                    if emit != _NEG_INF:
+                        for i, a in self.predecessors[j]:
+                            p = columns[t-1][i] + a + emit
+                            if p != _NEG_INF:
+                                heap.append((-p, i, 0))
+                        heapq.heapify(heap)
+                    candidates[(t, j)] = heap
 
+                if (t, j) in pending:
+                    i, r = pending[(t, j)]
+                    prev = ranked.get((t-1, i), [])
+                    if len(prev) <= r and (t-1, i) not in exhausted:
+                        stack.append((t-1, i, r))
+                        continue
+                    del pending[(t, j)]
+                    if len(prev) > r:
+                        p = prev[r][0] + self.log_transition[i][j] + \
+                            self.log_emission[codes[t]][j]
+                        heapq.heappush(heap, (-p, i, r))
+
+                if not heap:
+                    exhausted.add((t, j))
+                    stack.pop()
+                    continue
+                p, i, r = heapq.heappop(heap)
+                paths.append((-p, i, r))
+                pending[(t, j)] = (i, r + 1)
+
+        exhausted = set()
+
+        # the final candidates, through the implied terminal state
+        heap = []
+        for j, p in enumerate(self.terminate(columns[last])):
+            if p != _NEG_INF:
+                heap.append((-p, j, 0))
+        heapq.heapify(heap)
+
+        while heap:
+            p, j, r = heapq.heappop(heap)
+            path = [j]
+            k = r
+            for t in range(last, 0, -1):
+                ensure(t, path[-1], k)
+                score, i, k = ranked[(t, path[-1])][k]
+                path.append(i)
+            path.reverse()
+            yield (path, -p)
+
+            ensure(last, j, r + 1)
+            paths = ranked.get((last, j), [])
+            if len(paths) > r + 1:
+                heapq.heappush(heap, (-(paths[r+1][0] +
+                                        self.log_termination[j]),
+                                      j, r + 1))
+
+    def forward(self, codes, engine=None, live=None):
+        """
+        Computes the scaled forward probabilities for an encoded sequence of
+        observations.
+
+        Each column is divided by its sum (its scale), so that it sums to
+        1.0; the scales are kept as logs, so that the algorithm remains
+        numerically stable on long sequences.
+
+        Parameters:
+          - codes: a list of symbol indices, as returned by encode()
+          - engine: the name of the engine to use (see engine())
+          - live: None, or the states that may be occupied at each
+            position, as returned by reachable(); only the paths through
+            those states are summed
+        Returns:
+          - a tuple of three values:
+            - a list of the scaled columns
+            - a list of the log scales, one per column, followed by the
+              log probability of transitioning from the last column to
+              the implied terminal state (0.0 if the model has none)
+            - the log probability of the observations, or -inf if no
+              path of states can explain them
+        """
+        e = self.engine(engine)
+        columns = []
+        scales = []
+        col = None
+        for t, code in enumerate(codes):
+            if t == 0:
+                col = e.sum_first(code)
+            elif live is None:
+                col = e.sum_step(col, code)
             else:
-                for state in state_names:
-                    p_emit = self._p_emit(state, observed[i])
-                    if p_emit == 0.0:
-                        probs[state] = None
-                    else:
-                        best = None
-                        for prev_state, prev_prob in prior_probs.iteritems():
-                            if prev_prob is None:
-                                continue
-                            if self._connected(prev_state, state):
-                                p_tran = self._p_transition(prev_state, state)
-                                s = prev_prob + math.log10(p_emit) + \
-                                      math.log10(p_tran)
-                                if best == None:
-                                    best = s
-                                elif s > best:
-                                    best = s
-                        probs[state] = best
+                col = e.sum_expand(col, live[t-1], code)
+            if live is not None:
+                col = e.mask(col, live[t], 0.0)
+            col, scale = e.normalize(col)
+            columns.append(col)
+            scales.append(_log10(scale))
+            if scale == 0.0:
+                return (columns, scales, _NEG_INF)
 
-            # the last column of the trellis can only include those states
-            # that can transition to the implied terminal state, if one exists
-            if i == (len(observed)-1):
-                if self.terminal_state:
-                    for s in state_names:
-                        if s not in self.terminating_states:
-                            probs[s] = None
-                        else:
-                            probs[s] += math.log10(self.states[s].p_termination)
+        if columns:
+            scales.append(_log10(e.sum_terminate(col)))
+        return (columns, scales, math.fsum(scales))
 
-            trellis.append(probs)
-            prior_probs = probs
+    def backward(self, codes, scales, engine=None, live=None):
+        """
+        Computes the scaled backward probabilities for an encoded sequence
+        of observations, using the scales from forward(), so that the
+        product of the forward and backward columns at each position is the
+        posterior probability of each state.
 
-        return trellis
+        Parameters:
+          - codes: a list of symbol indices, as returned by encode()
+          - scales: the log scales returned by forward()
+          - engine: the name of the engine to use (see engine())
+          - live: None, or the live states given to forward()
+        Returns:
+          - a list of the scaled columns
+        """
+        e = self.engine(engine)
+        columns = [None] * len(codes)
+        if len(codes) == 0:
+            return columns
+        col = e.scale(e.end(), scales[-1])
+        if live is not None:
+            col = e.mask(col, live[-1], 0.0)
+        columns[-1] = col
+        for t in range(len(codes) - 2, -1, -1):
+            col = e.scale(e.sum_back(col, codes[t+1]), scales[t+1])
+            if live is not None:
+                col = e.mask(col, live[t], 0.0)
+            columns[t] = col
+        return columns
 
-    def viterbi_path(self, observed):
+    def expected_counts(self, codes, engine=None):
         """
-        Establish the most probable path of states that explains a sequence
-        of observations, along with the probability of that path being
-        observed.
+        Computes the expected number of times that each initial state,
+        emission, transition and terminal state is used in explaining an
+        encoded sequence of observations (the E-step of the Baum-Welch
+        algorithm).
 
         Parameters:
-          - seq_observed: a list of strings, representing an ordered sequence
-            of symbols that were observed
+          - codes: a list of symbol indices, as returned by encode()
+          - engine: the name of the engine to use (see engine())
         Returns:
           - a tuple of two values:
-            - a list of state names that explains the observations
-            - a float, representing the log (base 10) of the probability
-              of the sequence being observed
+            - a training_counts object holding the expected counts
+            - the log probability of the observations
+          - (None, -inf) if no path of states can explain the observations
         """
-        trellis = self.trellis(observed)
-
-        # start with the best (largest) value in the last column of the
-        # trellis; we will work backwards from here
-        probs = trellis[-1]
-        next_state = max(probs, key=probs.get)
-        state_seq = [next_state]
-        p_overall = probs[next_state]
-
-        for i in reversed(range(len(trellis)-1)):
-            probs = trellis[i]
-            states = probs.keys()
-            # eliminate the states that cannot transition to the (known)
-            # next state
-            for state in states:
-                if probs[state] == None:
-                    del probs[state]
-                elif not self._connected(state, next_state):
-                    del probs[state]
-            next_state = max(probs, key=probs.get)
-            state_seq.append(next_state)
-
-        state_seq.reverse()   # because the list of states was built backwards
-        return (state_seq, p_overall)
-
-def train_hmm(training_data, include_terminal_state=False):
-    """
-    Create a new HMM based solely on annotated training data.  Both the
-    topology of the state interconnections and the probabilities of the
-    emissions and transitions are inferred from training data.
+        columns, scales, p = self.forward(codes, engine)
+        if not columns or p == _NEG_INF:
+            return (None, _NEG_INF)
+        backward = self.backward(codes, scales, engine)
+        e = self.engine(engine)
+        initial, emission, transition, end = e.expected(codes, columns,
+                                                        backward, scales)
 
-    Parameters:
-      - training_data: a list of tuples; each tuple consists of two lists
-        of the same length:
-        - a list of symbols
-        - a list of states corresponding to the sequence that best explains
-          the list of symbols
-      - include_terminal_state: a boolean, indicating whether an implied
-        terminal state should be included in the model
-    Returns:
-      - a new hmm object, ready for use
+        counts = training_counts()
+        counts.sequences = 1
+        for j, name in enumerate(self.names):
+            emit = {}
+            for k, sym in enumerate(self.symbols):
+                if emission[k][j] > 0.0:
+                    emit[sym] = float(emission[k][j])
+            if not emit:
+                continue   # the state is not used
+            counts.emission[name] = emit
+            counts.occurrences[name] = math.fsum(emit.values())
+            counts.initial[name] = float(initial[j])
+            counts.termination[name] = float(end[j])
+            tran = {}
+            for (to, a), x in zip(self.successors[j], transition[j]):
+                if x > 0.0:
+                    tran[self.names[to]] = float(x)
+            counts.transition[name] = tran
+        return (counts, p)
 
-    TODO: data validation; ensure that the lengths of the two lists in
-    each tuple is exactly the same length
-    """
-    # determine the list of states and alphabet of symbols
-    alphabet = []
-    state_names = []
-    for sample in training_data:
-        alphabet.extend(list(set(sample[0])))
-        state_names.extend(list(set(sample[1])))
-    alphabet = list(set(alphabet))
-    state_names = list(set(state_names))
-
-    states = []
-    for s_name in state_names:
-        states.append(state(s_name, 0.0, None, None))
-
-    # calculate the initial probabilities
-    s_dict = {}
-    for s in state_names:
-        s_dict[s] = 0
-    for sample in training_data:
-        s_dict[sample[1][0]] += 1
-    for s in states:
-        s.p_initial = s_dict[s.name] / (len(training_data) * 1.0)
-
-    # calculate the emission probabilities for each state
-    for s in states:
-        emit = {}
-        total = 0
-        for sample in training_data:
-            for i in range(len(sample[1])):
-                if sample[1][i] == s.name:
-                    total += 1
-                    emit[sample[0][i]] = emit.get(sample[0][i], 0) + 1
-        for e in emit.keys():
-            emit[e] = emit[e] / (total * 1.0)
-        s.p_emission = emit
-
-    # calculate the transition probabilities for each state
-    for s in states:
-        tran = {}
-        total = 0
-        term = 0
-        for sample in training_data:
-            for i in range(len(sample[1])-1):
-                if sample[1][i] == s.name:
-                    total += 1
-                    tran[sample[1][i+1]] = tran.get(sample[1][i+1], 0) + 1
-            if include_terminal_state:
-                if sample[1][-1] == s.name:
-                    total += 1
-                    term += 1
-        for t in tran.keys():
-            tran[t] = tran[t] / (total * 1.0)
-        s.p_transition = tran
-        if include_terminal_state:
-            s.p_termination = term / (total * 1.0)
-
-    return hmm(alphabet, states)
+    def terminate(self, column):
+        """
+        Adds the log probability of transitioning to the implied terminal
+        state (if any) to a final trellis column.
+        """
+        return [p + t for p, t in zip(column, self.log_termination)]
+
+    def path_score(self, path, codes):
+        """
+        Calculates the log probability of an encoded sequence of states and
+        observations, not including the transition to the implied terminal
+        state.  Returns -inf if the path is not possible (or if it differs
+        in length from the observations).
+        """
+        if len(path) != len(codes):
+            return _NEG_INF
+        if self._tables is not None and len(path):
+            path = numpy.asarray(path, dtype=numpy.intp)
+            codes = numpy.asarray(codes, dtype=numpy.intp)
+            tables = self._tables
+            return float(tables['log_initial'][path[0]] +
+                         tables['log_transition'][path[:-1], path[1:]].sum() +
+                         tables['log_emission'][codes, path].sum())
+        p = 0.0
+        prev = None
+        for i, code in zip(path, codes):
+            if prev is None:
+                p += self.log_initial[i]
+            else:
+                p += self.log_transition[prev][i]
+            p += self.log_emission[code][i]
+            if p == _NEG_INF:
+                break
+            prev = i
+        return p
+
+    def encode_path(self, path):
+        """
+        Translates a sequence of state names into a list of state indices;
+        names that are not known to the model map to -1.  Sequences of
+        integers (including integer arrays) are taken to be indices
+        already, and are returned as they are.
+        """
+        if numpy is not None and isinstance(path, numpy.ndarray) and \
+           path.dtype.kind in 'iu':
+            return path
+        path = list(path)
+        if path and isinstance(path[0], numbers.Integral):
+            return path
+        get = self.index.get
+        return [get(name, -1) for name in path]
+
+    def score_paths(self, paths, codes, engine='numpy'):
+        """
+        Calculates the log probabilities of many encoded sequences of
+        states and observations at once, as path_score() would, except
+        that paths that end in a state that cannot transition to the
+        implied terminal state (if any) are also invalid.
+
+        With the numpy engine, the paths are concatenated and the
+        probabilities of all of their steps are gathered from the tables
+        and summed by path, with no loop over the paths in Python.
+
+        Parameters:
+          - paths: a list of sequences of state indices (which may differ
+            in length); an index that is not that of a state (such as -1)
+            denotes an unknown state
+          - codes: a list of sequences of symbol indices, one per path
+          - engine: 'numpy' (the default) or 'python'
+        Returns:
+          - a tuple of two values, each with one entry per path (numpy
+            arrays with the numpy engine, or lists):
+            - the log probabilities, or -inf for the invalid paths
+            - True for each valid path, False for each invalid path
+        """
+        if engine == 'python':
+            scores = []
+            for path, obs in zip(paths, codes):
+                if len(path) == 0 or len(path) != len(obs) or \
+                   min(path) < 0 or max(path) >= len(self.names):
+                    scores.append(_NEG_INF)
+                    continue
+                if self.log_termination[path[-1]] == _NEG_INF:
+                    scores.append(_NEG_INF)
+                else:
+                    scores.append(self.path_score(path, obs))
+            return (scores, [p != _NEG_INF for p in scores])
+
+        e = self.engine(engine)
+        lengths = numpy.array([len(path) for path in paths], dtype=int)
+        ok = (lengths > 0) & \
+             (lengths == numpy.array([len(obs) for obs in codes], dtype=int))
+        if not ok.any():
+            return (numpy.repeat(_NEG_INF, len(paths)), ok)
+        # only the paths that can be valid go into the flat arrays
+        keep = numpy.flatnonzero(ok)
+        states = numpy.concatenate([numpy.asarray(paths[i], dtype=int)
+                                    for i in keep])
+        symbols = numpy.concatenate([numpy.asarray(codes[i], dtype=int)
+                                     for i in keep])
+        starts = numpy.concatenate(([0], numpy.cumsum(lengths[keep])[:-1]))
+        ends = starts + lengths[keep] - 1
+
+        unknown = (states < 0) | (states >= len(self.names))
+        states[unknown] = 0
+        steps = numpy.empty(len(states))
+        steps[1:] = e.log_transition[states[:-1], states[1:]]
+        steps[starts] = e.log_initial[states[starts]]
+        steps += e.log_emission[symbols, states]
+        steps[unknown] = _NEG_INF
+
+        scores = numpy.repeat(_NEG_INF, len(paths))
+        kept = numpy.add.reduceat(steps, starts)
+        kept[e.log_termination[states[ends]] == _NEG_INF] = _NEG_INF
+        scores[keep] = kept
+        return (scores, scores != _NEG_INF)
+
+    def _sampling_rows(self, terminate):
+        """
+        Returns the distributions that sample() draws from, as lists of
+        rows of (outcome, probability) pairs with non-zero probabilities:
+        the initial states (one row), the successors of each state, and the
+        symbols emitted by each state.  The outcome -1 ends a sequence: it
+        stands for the transition to the implied terminal state (if
+        terminate is True), and is the only outcome of a state that cannot
+        be followed by any state or cannot emit.  The last row of the
+        successors and of the symbols, for sequences that have already
+        ended, always draws -1 (so that it can be indexed by -1).
+        """
+        n = len(self.names)
+        ended = [(-1, 1.0)]
+        initial = [(j, 10.0 ** p) for j, p in enumerate(self.log_initial)
+                   if p != _NEG_INF]
+        successors = []
+        emissions = []
+        for i in range(n):
+            row = [(j, 10.0 ** a) for j, a in self.successors[i]]
+            if (terminate and self.terminal_state and
+                    self.log_termination[i] != _NEG_INF):
+                row.append((-1, 10.0 ** self.log_termination[i]))
+            successors.append(row or ended)
+            row = [(k, 10.0 ** emit[i])
+                   for k, emit in enumerate(self.log_emission)
+                   if emit[i] != _NEG_INF]
+            emissions.append(row or ended)
+        return ([initial or ended], successors + [ended], emissions + [ended])
+
+    def sample(self, count=1, length=None, seed=None, max_length=None,
+               batch=1024):
+        """
+        Generates random sequences of states, and of the symbols they emit,
+        from this model (see hmm.sample()).
+
+        With numpy, the sequences are generated batch at a time: each step
+        draws the next state of every sequence of the batch at once, from
+        alias tables (see _alias()) of the successors of each state, and
+        the symbols of the whole batch are then drawn at once in the same
+        way.  Without numpy, each draw is a binary search of the
+        cumulative probabilities of a state.
+
+        Returns:
+          - a generator of tuples of two values, one per sequence: the
+            symbol indices, and the state indices (numpy arrays, or lists
+            without numpy)
+        """
+        if length is None:
+            if not self.terminal_state:
+                raise ValueError('a length is required to sample from a '
+                                 'model with no terminal state')
+            limit = max_length
+        else:
+            if length < 0:
+                raise ValueError('invalid length: %r' % (length,))
+            limit = length
+        tables = self.__dict__.setdefault('_sampling', {})
+        terminate = length is None
+        if terminate not in tables:
+            rows = self._sampling_rows(terminate)
+            if numpy is None:
+                tables[terminate] = [self._cumulative(r) for r in rows]
+            else:
+                tables[terminate] = [self._alias_tables(r) for r in rows]
+        if numpy is None:
+            return self._sample_python(tables[terminate], count, limit, seed)
+        return self._sample_numpy(tables[terminate], count, limit, seed,
+                                  batch)
+
+    def _cumulative(self, rows):
+        tables = []
+        for row in rows:
+            cumulative = []
+            total = 0.0
+            for outcome, p in row:
+                total += p
+                cumulative.append(total)
+            tables.append(([outcome for outcome, p in row], cumulative))
+        return tables
+
+    def _sample_python(self, tables, count, limit, seed):
+        r = random.Random(seed)
+
+        def draw(table):
+            outcomes, cumulative = table
+            j = bisect.bisect_right(cumulative, r.random() * cumulative[-1])
+            return outcomes[min(j, len(outcomes) - 1)]   # against rounding
+
+        initial, successors, emissions = tables
+        sampled = 0
+        while count is None or sampled < count:
+            codes = []
+            path = []
+            i = draw(initial[0])
+            while i >= 0 and (limit is None or len(path) < limit):
+                k = draw(emissions[i])
+                if k < 0:
+                    break
+                codes.append(k)
+                path.append(i)
+                i = draw(successors[i])
+            yield (codes, path)
+            sampled += 1
+
+    def _alias_tables(self, rows):
+        """
+        Builds the alias tables of the rows of distributions from
+        _sampling_rows(), padded to the same width, as a tuple of numpy
+        arrays: the outcomes, the probabilities of keeping each column,
+        the alias of each column, and the width of each row.
+        """
+        width = max(len(row) for row in rows)
+        outcomes = numpy.zeros((len(rows), width), dtype=numpy.intp)
+        prob = numpy.ones((len(rows), width))
+        alias = numpy.zeros((len(rows), width), dtype=numpy.intp)
+        for i, row in enumerate(rows):
+            p, a = _alias([q for outcome, q in row])
+            outcomes[i, :len(row)] = [outcome for outcome, q in row]
+            prob[i, :len(row)] = p
+            alias[i, :len(row)] = a
+        return (outcomes, prob, alias,
+                numpy.array([len(row) for row in rows]))
+
+    def _sample_numpy(self, tables, count, limit, seed, batch):
+        rng = numpy.random.RandomState(seed)
+
+        def draw(table, rows):
+            outcomes, prob, alias, width = table
+            x = rng.random_sample(len(rows)) * width[rows]
+            j = numpy.minimum(x.astype(numpy.intp), width[rows] - 1)
+            j = numpy.where(x - j < prob[rows, j], j, alias[rows, j])
+            return outcomes[rows, j]
+
+        code_type = numpy.min_scalar_type(self.unknown)
+        state_type = numpy.min_scalar_type(max(len(self.names) - 1, 0))
+        initial, successors, emissions = tables
+        sampled = 0
+        while count is None or sampled < count:
+            b = batch if count is None else min(batch, count - sampled)
+            # the states of the batch, one step (row) at a time, with -1
+            # once a sequence has ended
+            steps = []
+            current = draw(initial, numpy.zeros(b, dtype=numpy.intp))
+            while limit is None or len(steps) < limit:
+                steps.append(current)
+                if len(steps) == limit or (current < 0).all():
+                    break
+                current = draw(successors, current)
+            states = numpy.array(steps, dtype=numpy.intp).reshape(
+                len(steps), b).T
+            codes = draw(emissions, states.ravel()).reshape(states.shape)
+            if not steps:
+                lengths = numpy.zeros(b, dtype=numpy.intp)   # limit is 0
+            else:
+                ended = (states < 0) | (codes < 0)
+                lengths = numpy.where(ended.any(axis=1),
+                                      ended.argmax(axis=1), len(steps))
+            for j in range(b):
+                n = lengths[j]
+                yield (codes[j, :n].astype(code_type),
+                       states[j, :n].astype(state_type))
+            sampled += b
+
+class _python_engine:
+    """
+    The per-column computations of the decoding algorithms, on the lists
+    of a compiled_hmm.  Columns are lists of log probabilities indexed by
+    state, and backpointers are lists of state indices (-1 where a cell
+    has no predecessor).
+    """
+    def __init__(self, compiled):
+        self.c = compiled
+
+    def first(self, code):
+        emit = self.c.log_emission[code]
+        return [p + e for p, e in zip(self.c.log_initial, emit)]
+
+    def unit(self, i):
+        """
+        Returns a column in which only state i is possible (with log
+        probability 0), to start a trellis from a given state.
+        """
+        col = [_NEG_INF] * len(self.c.names)
+        col[i] = 0.0
+        return col
+
+    def free(self, code):
+        """
+        Returns the first column of a trellis that may start in any state,
+        regardless of the initial probabilities.
+        """
+        return list(self.c.log_emission[code])
+
+    def step(self, prev, code):
+        """
+        Computes a column of the Viterbi trellis from the previous column,
+        along with the best predecessor of each cell.
+        """
+        emit = self.c.log_emission[code]
+        col = []
+        bp = []
+        for j, preds in enumerate(self.c.predecessors):
+            if emit[j] == _NEG_INF:
+                col.append(_NEG_INF)
+                bp.append(-1)
+                continue
+            best = _NEG_INF
+            best_i = -1
+            for i, a in preds:
+                s = prev[i] + a
+                if s > best:
+                    best = s
+                    best_i = i
+            col.append(best + emit[j])
+            bp.append(best_i)
+        return (col, bp)
+
+    def terminate(self, col):
+        return self.c.terminate(col)
+
+    def best(self, col):
+        """
+        Returns the index and value of the largest entry in a column (the
+        first one, in case of ties).
+        """
+        i = max(range(len(col)), key=col.__getitem__)
+        return (i, col[i])
+
+    def _linear(self):
+        """
+        Builds the tables of probabilities (rather than log probabilities)
+        used by the forward and backward algorithms.
+        """
+        c = self.c
+        self.initial = [10.0 ** p for p in c.log_initial]
+        self.predecessors = [[(i, 10.0 ** a) for i, a in preds]
+                             for preds in c.predecessors]
+        self.successors = [[(j, 10.0 ** a) for j, a in succs]
+                           for succs in c.successors]
+        self.emission = [[10.0 ** p for p in row] for row in c.log_emission]
+        self.termination = [10.0 ** p for p in c.log_termination]
+
+    def sum_first(self, code):
+        if not hasattr(self, 'initial'):
+            self._linear()
+        return [p * e for p, e in zip(self.initial, self.emission[code])]
+
+    def sum_step(self, prev, code):
+        """
+        Computes a column of forward probabilities from the previous column.
+        """
+        emit = self.emission[code]
+        return [emit[j] * sum([prev[i] * a for i, a in preds])
+                for j, preds in enumerate(self.predecessors)]
+
+    def sum_expand(self, prev, live, code):
+        """
+        Computes a column of forward probabilities from the previous column,
+        following only the edges out of the given (live) states.
+        """
+        col = [0.0] * len(prev)
+        for i in live:
+            p = prev[i]
+            for j, a in self.successors[i]:
+                col[j] += p * a
+        return [p * e for p, e in zip(col, self.emission[code])]
+
+    def sum_back(self, next, code):
+        """
+        Computes a column of backward probabilities from the next column,
+        where code is the symbol observed at the next position.
+        """
+        weighted = [e * b for e, b in zip(self.emission[code], next)]
+        return [sum([a * weighted[j] for j, a in succs])
+                for succs in self.successors]
+
+    def sum_terminate(self, col):
+        return sum([p * t for p, t in zip(col, self.termination)])
+
+    def end(self):
+        if not hasattr(self, 'initial'):
+            self._linear()
+        return list(self.termination)
+
+    def expected(self, codes, forward, backward, scales):
+        """
+        Computes the expected counts for expected_counts(), from the scaled
+        forward and backward columns: the initial states, the emissions
+        (by symbol and state), the transitions (aligned with the successor
+        lists) and the final states.
+        """
+        n = len(self.c.names)
+        emission = [[0.0] * n for row in self.c.log_emission]
+        for t, code in enumerate(codes):
+            gamma = [f * b for f, b in zip(forward[t], backward[t])]
+            row = emission[code]
+            for j in range(n):
+                row[j] += gamma[j]
+            if t == 0:
+                initial = gamma
+
+        transition = [[0.0] * len(succs) for succs in self.successors]
+        for t in range(len(codes) - 1):
+            f = forward[t]
+            factor = 10.0 ** -scales[t+1]
+            weighted = [e * b * factor for e, b in
+                        zip(self.emission[codes[t+1]], backward[t+1])]
+            for i, succs in enumerate(self.successors):
+                if f[i] == 0.0:
+                    continue
+                row = transition[i]
+                for k, (j, a) in enumerate(succs):
+                    row[k] += f[i] * a * weighted[j]
+
+        return (initial, emission, transition, gamma)
+
+    def normalize(self, col):
+        total = sum(col)
+        if total == 0.0:
+            return (col, total)
+        return ([p / total for p in col], total)
+
+    def scale(self, col, log_scale):
+        if log_scale == _NEG_INF:
+            return col
+        factor = 10.0 ** -log_scale
+        return [p * factor for p in col]
+
+    def expand(self, prev, live, code):
+        """
+        Computes a column of the Viterbi trellis from the previous column,
+        along with the best predecessor of each cell, following only the
+        edges out of the given (live) states of the previous column (all of
+        its other cells must be -inf).
+        """
+        n = len(prev)
+        col = [_NEG_INF] * n
+        bp = [-1] * n
+        successors = self.c.successors
+        for i in live:
+            p = prev[i]
+            for j, a in successors[i]:
+                s = p + a
+                if s > col[j]:
+                    col[j] = s
+                    bp[j] = i
+        emit = self.c.log_emission[code]
+        return ([p + e for p, e in zip(col, emit)], bp)
+
+    def mask(self, col, keep, fill=_NEG_INF):
+        """
+        Returns a copy of a column in which only the cells of the given
+        states are kept, and all others are set to fill.
+        """
+        masked = [fill] * len(col)
+        for j in keep:
+            masked[j] = col[j]
+        return masked
+
+    def prune(self, col, beam):
+        """
+        Prunes the cells of a column that fall outside of a beam, by setting
+        them to -inf, and returns the indices of the cells that remain.
+        """
+        live = self.live(col)
+        keep = live
+        if keep and beam.threshold is not None:
+            floor = max([col[j] for j in keep]) - beam.threshold
+            keep = [j for j in keep if col[j] >= floor]
+        if beam.width is not None and len(keep) > beam.width:
+            keep = sorted(sorted(keep, key=lambda j: -col[j])[:beam.width])
+        if len(keep) < len(live):
+            kept = set(keep)
+            for j in live:
+                if j not in kept:
+                    col[j] = _NEG_INF
+        beam.live += len(live)
+        beam.pruned += len(live) - len(keep)
+        return keep
+
+    def live(self, col):
+        """
+        Returns the indices of the states with non-zero probability in a
+        column.
+        """
+        return [j for j, p in enumerate(col) if p != _NEG_INF]
+
+    def unreachable(self, col):
+        """
+        Returns the number of cells of a column with zero probability.
+        """
+        return col.count(_NEG_INF)
+
+    def transitions(self, codes):
+        """
+        Returns the number of transitions evaluated by step() over an
+        encoded sequence: those into the states that can emit each symbol.
+        """
+        per_code = getattr(self, '_per_code', None)
+        if per_code is None:
+            per_code = [sum(len(preds) for preds, p in
+                            zip(self.c.predecessors, emit) if p != _NEG_INF)
+                        for emit in self.c.log_emission]
+            self._per_code = per_code
+        return sum(per_code[k] for k in codes[1:])
+
+    def backpointers(self, length):
+        return [None] * length
+
+    def traceback(self, backpointers, last):
+        path = [last]
+        for t in range(len(backpointers) - 1, 0, -1):
+            path.append(backpointers[t][path[-1]])
+        path.reverse()   # because the list of states was built backwards
+        return path
+
+class _numpy_engine(_python_engine):
+    """
+    The per-column computations of the decoding algorithms, vectorized
+    over the states with numpy.  Each trellis column is the max-plus
+    product of the previous column with the log transition matrix, and
+    the backpointers for a whole sequence are kept in a single array of
+    the smallest integer type that can index the states.
+
+    For sparse models (fewer than a quarter of the possible edges), the
+    max-plus product is computed over the edges only, with the
+    predecessor lists in compressed sparse column form.
+    """
+    def __init__(self, compiled):
+        self.c = compiled
+        self.n = len(compiled.names)
+        if compiled._tables is not None:
+            tables = compiled._tables
+        else:
+            tables = dict((key, numpy.array(getattr(compiled, key),
+                                            dtype=float))
+                          for key in _TABLES)
+        self.log_initial = tables['log_initial']
+        self.log_transition = tables['log_transition'].reshape(self.n,
+                                                               self.n)
+        self.log_emission = tables['log_emission']
+        self.log_termination = tables['log_termination']
+        self.index_type = numpy.min_scalar_type(max(self.n - 1, 0))
+        self._cells = numpy.arange(self.n)
+
+        # the edges, ordered by destination and then by source
+        to_state, from_state = numpy.nonzero(self.log_transition.T !=
+                                             _NEG_INF)
+        self.sparse = len(to_state) * 4 < self.n * self.n
+        if self.sparse:
+            counts = numpy.bincount(to_state, minlength=self.n)
+            self.pred_from = from_state
+            self.pred_log = self.log_transition[from_state, to_state]
+            self.pred_ptr = numpy.concatenate(([0], numpy.cumsum(counts)))
+            # the states with at least one predecessor, and the offsets of
+            # their (contiguous) runs of edges
+            self.pred_states = numpy.flatnonzero(counts)
+            self.pred_starts = self.pred_ptr[self.pred_states]
+            self._edge_index = numpy.arange(len(to_state))
+            self._edge_count = counts[self.pred_states]
+
+    def first(self, code):
+        return self.log_initial + self.log_emission[code]
+
+    def unit(self, i):
+        col = numpy.empty(self.n)
+        col.fill(_NEG_INF)
+        col[i] = 0.0
+        return col
+
+    def free(self, code):
+        return self.log_emission[code].copy()
+
+    def step(self, prev, code):
+        if self.sparse:
+            return self._sparse_step(prev, code)
+        scores = prev[:, None] + self.log_transition
+        bp = scores.argmax(axis=0)
+        col = scores[bp, self._cells] + self.log_emission[code]
+        return (col, bp)
+
+    def _sparse_step(self, prev, code):
+        col = numpy.empty(self.n)
+        col.fill(_NEG_INF)
+        bp = numpy.zeros(self.n, dtype=int)
+        if len(self.pred_states) == 0:
+            return (col, bp)
+        scores = prev[self.pred_from] + self.pred_log
+        best = numpy.maximum.reduceat(scores, self.pred_starts)
+        # the first edge that attains the maximum in each run, so that ties
+        # are broken the same way as in the dense computation
+        hits = numpy.where(scores == numpy.repeat(best, self._edge_count),
+                           self._edge_index, len(self._edge_index))
+        first = numpy.minimum.reduceat(hits, self.pred_starts)
+        states = self.pred_states
+        col[states] = best + self.log_emission[code][states]
+        bp[states] = self.pred_from[first]
+        return (col, bp)
+
+    def terminate(self, col):
+        return col + self.log_termination
+
+    def best(self, col):
+        i = int(col.argmax())
+        return (i, float(col[i]))
+
+    def _linear(self):
+        self.initial = 10.0 ** self.log_initial
+        self.transition = 10.0 ** self.log_transition
+        self.emission = 10.0 ** self.log_emission
+        self.termination = 10.0 ** self.log_termination
+
+    def sum_first(self, code):
+        if not hasattr(self, 'initial'):
+            self._linear()
+        return self.initial * self.emission[code]
+
+    def sum_step(self, prev, code):
+        return prev.dot(self.transition) * self.emission[code]
+
+    def sum_expand(self, prev, live, code):
+        return prev[live].dot(self.transition[live]) * self.emission[code]
+
+    def sum_back(self, next, code):
+        return self.transition.dot(self.emission[code] * next)
+
+    def sum_terminate(self, col):
+        return float(col.dot(self.termination))
+
+    def end(self):
+        if not hasattr(self, 'initial'):
+            self._linear()
+        return self.termination.copy()
+
+    def expected(self, codes, forward, backward, scales):
+        codes = numpy.asarray(codes)
+        forward = numpy.array(forward)
+        backward = numpy.array(backward)
+        gamma = forward * backward
+        emission = numpy.zeros(self.log_emission.shape)
+        numpy.add.at(emission, codes, gamma)
+
+        factors = 10.0 ** -numpy.array(scales[1:len(codes)])
+        weighted = self.emission[codes[1:]] * backward[1:] * factors[:, None]
+        xi = forward[:-1].T.dot(weighted) * self.transition
+        transition = [[xi[i, j] for j, a in succs]
+                      for i, succs in enumerate(self.c.successors)]
+
+        return (gamma[0], emission, transition, gamma[-1])
+
+    def normalize(self, col):
+        total = float(col.sum())
+        if total == 0.0:
+            return (col, total)
+        return (col / total, total)
+
+    def scale(self, col, log_scale):
+        if log_scale == _NEG_INF:
+            return col
+        return col * 10.0 ** -log_scale
+
+    def expand(self, prev, live, code):
+        if len(live) * 2 >= self.n:
+            # the other cells of prev are -inf, and it is cheaper to
+            # compute the whole column than to gather the live rows
+            return self.step(prev, code)
+        if len(live) == 0:
+            col = numpy.empty(self.n)
+            col.fill(_NEG_INF)
+            return (col, numpy.zeros(self.n, dtype=int))
+        live = numpy.asarray(live)
+        scores = prev[live][:, None] + self.log_transition[live]
+        arg = scores.argmax(axis=0)
+        col = scores[arg, self._cells] + self.log_emission[code]
+        return (col, live[arg])
+
+    def mask(self, col, keep, fill=_NEG_INF):
+        masked = numpy.empty(self.n)
+        masked.fill(fill)
+        masked[keep] = col[keep]
+        return masked
+
+    def prune(self, col, beam):
+        live = numpy.flatnonzero(col != _NEG_INF)
+        keep = live
+        if len(keep) and beam.threshold is not None:
+            keep = keep[col[keep] >= col[keep].max() - beam.threshold]
+        if beam.width is not None and len(keep) > beam.width:
+            order = numpy.argsort(-col[keep], kind='mergesort')
+            keep = numpy.sort(keep[order[:beam.width]])
+        if len(keep) < len(live):
+            pruned = numpy.ones(self.n, dtype=bool)
+            pruned[keep] = False
+            col[pruned] = _NEG_INF
+        beam.live += len(live)
+        beam.pruned += len(live) - len(keep)
+        return keep
+
+    def live(self, col):
+        return numpy.flatnonzero(col != _NEG_INF).tolist()
+
+    def unreachable(self, col):
+        return int(numpy.count_nonzero(col == _NEG_INF))
+
+    def transitions(self, codes):
+        # every transition is evaluated, or every edge of a sparse model
+        if self.sparse:
+            return max(len(codes) - 1, 0) * len(self.pred_from)
+        return max(len(codes) - 1, 0) * self.n * self.n
+
+    def backpointers(self, length):
+        return numpy.zeros((length, self.n), dtype=self.index_type)
+
+    def traceback(self, backpointers, last):
+        path = [last]
+        for t in range(len(backpointers) - 1, 0, -1):
+            path.append(int(backpointers[t, path[-1]]))
+        path.reverse()   # because the list of states was built backwards
+        return path
+
+class hmm(object):
+    __slots__ = ('alphabet', 'terminal_state', 'initial_states',
+                 'terminating_states', 'states', '_compiled', '_source',
+                 '_stats', '_cache')
+
+    def __init__(self, alphabet, states, validate=True):
+        """
+        Creates a new hidden Markov model object.
+
+        Parameters:
+          - alphabet: a list of strings, where each string represents a
+            symbol that can possibly be emitted by any of the states in
+            the model (for example, ['A', 'C', 'G', 'T'] for genomic data)
+          - states: a list of state objects
+          - validate: whether to check the model (see below)
+
+        The initial distribution vector (usually referred to as pi) is
+        described by the states with non-zero values for p_initial.
+
+        If at least one of the states in the states parameter includes a
+        non-zero p_termination, then there is an implied "end" state.
+        In that case, only those states with a non-zero p_termination
+        can be the last state in a valid sequence of states.
+
+        The model is validated once, here, so that none of its methods
+        need to check it again; a ValueError is raised if:
+          - two states have the same name
+          - a probability is not between 0.0 and 1.0
+          - the p_initial probabilities do not add up to 1.0, or the
+            p_emission probabilities of a state do not, or its
+            p_transition probabilities plus its p_termination do not
+            (unless they are all 0.0, for a state that cannot emit, or
+            that cannot be followed by any state)
+          - a state can transition to a state that is not in the model
+          - a state can emit a symbol that is not in the alphabet
+          - a state cannot be reached from any initial state
+        Modifying the states afterwards is not checked.
+        """
+        self.alphabet = alphabet
+        self.terminal_state = False
+        self.initial_states = []
+        self.terminating_states = []
+        self.states = {}
+        for state in states:
+            if validate and state.name in self.states:
+                raise ValueError('duplicate state: %r' % (state.name,))
+            self.states[state.name] = state
+            if state.p_initial > 0.0:
+                self.initial_states.append(state.name)
+            if state.p_termination > 0.0:
+                self.terminal_state = True
+                self.terminating_states.append(state.name)
+        self._compiled = None
+        self._source = None
+        self._stats = None
+        self._cache = None
+        if validate:
+            self._validate()
+
+    def _validate(self):
+        """
+        Checks the probabilities and the topology of this model (see
+        __init__()).
+        """
+        def check_sum(total, what):
+            if abs(total - 1.0) > _TOLERANCE:
+                raise ValueError('the %s add up to %r, not 1.0' %
+                                 (what, total))
+
+        def check(p, what):
+            if not -_TOLERANCE <= p <= 1.0 + _TOLERANCE:
+                raise ValueError('invalid probability %r of %s' % (p, what))
+
+        symbols = set(self.alphabet)
+        for name, s in self.states.items():
+            check(s.p_initial, 'state %r being initial' % (name,))
+            check(s.p_termination, 'state %r terminating' % (name,))
+            for sym, p in s.p_emission.items():
+                if sym not in symbols:
+                    raise ValueError('state %r emits %r, which is not in '
+                                     'the alphabet' % (name, sym))
+                check(p, 'state %r emitting %r' % (name, sym))
+            for to_state, p in s.p_transition.items():
+                if to_state not in self.states:
+                    raise ValueError('state %r transitions to an unknown '
+                                     'state: %r' % (name, to_state))
+                check(p, 'state %r transitioning to %r' % (name, to_state))
+
+            total = math.fsum(s.p_emission.values())
+            if total != 0.0:
+                check_sum(total, 'emission probabilities of state %r' %
+                                 (name,))
+            total = math.fsum(s.p_transition.values()) + s.p_termination
+            if total != 0.0:
+                check_sum(total, 'transition and termination probabilities '
+                                 'of state %r' % (name,))
+        if self.states:
+            check_sum(math.fsum([s.p_initial for s in self.states.values()]),
+                      'initial probabilities')
+
+        reached = set(self.initial_states)
+        pending = list(reached)
+        while pending:
+            for to_state, p in self.states[pending.pop()].p_transition.items():
+                if p > 0.0 and to_state not in reached:
+                    reached.add(to_state)
+                    pending.append(to_state)
+        if len(reached) < len(self.states):
+            raise ValueError('unreachable states: %s' % ', '.join(
+                [repr(name) for name in self.states if name not in reached]))
+
+    def compile(self):
+        """
+        Builds the integer-indexed form of this model (see compiled_hmm),
+        which is used by all of the decoding and scoring methods.
+
+        This happens automatically the first time that it is needed; call
+        it again after modifying the states of the model to bring the
+        compiled form up to date.
+
+        Returns:
+          - the compiled_hmm object
+        """
+        self._compiled = compiled_hmm(self)
+        self._source = None
+        return self._compiled
+
+    def _model(self):
+        """
+        Returns the compiled form of this model, compiling it if needed.
+        """
+        if self._compiled is None:
+            return self.compile()
+        return self._compiled
+
+    def instrument(self, stats):
+        """
+        Attaches a stats object to this model, to collect counts and
+        timings of the work done by its methods, or detaches it (if stats
+        is None).  Without a stats object, the methods do no extra work.
+        """
+        self._stats = stats
+
+    def use_cache(self, cache):
+        """
+        Attaches a trellis_cache object to this model, so that trellis(),
+        viterbi_path() and extend_trellis() reuse the columns of the
+        trellises of the sequences they have seen that share a prefix with
+        the sequence they are given, or detaches it (if cache is None).
+        """
+        self._cache = cache
+
+    def _begin(self, method):
+        """
+        Starts a record of a call to a method, if this model has a stats
+        object (or returns None), compiling the model if needed.
+        """
+        if self._stats is None:
+            return None
+        record = self._stats.begin(method)
+        if self._compiled is None:
+            began = time.time()
+            self.compile()
+            record['seconds']['compile'] += time.time() - began
+            record['log10_calls'] += self._compiled.log10_calls
+        return record
+
+    def _end(self, record, length):
+        if record is not None:
+            record['length'] = length
+            self._stats.end(record)
+
+    def encode(self, observed):
+        """
+        Translates a sequence of observed symbols into a compact sequence
+        of symbol indices, which can be passed to any of the methods that
+        take a sequence of observations in place of the symbols, and is
+        cheaper to keep and to send to other processes.
+
+        The index of each symbol is its position in the alphabet; symbols
+        that are not in the alphabet map to larger values.  Raw bytes
+        (bytes, bytearray, memoryview or mmap objects, one symbol per
+        byte) are translated without creating an object per symbol.
+
+        Parameters:
+          - observed: a sequence of observed symbols
+        Returns:
+          - a numpy array of symbol indices (or, without numpy, an
+            array.array)
+        """
+        c = self._model()
+        codes = c.encode(observed)
+        if isinstance(codes, list):
+            if numpy is not None:
+                return numpy.array(codes,
+                                   dtype=numpy.min_scalar_type(c.unknown))
+            return array.array('B' if c.unknown < 256 else 'l', codes)
+        return codes
+
+    def __getattr__(self, name):
+        # the states of a model loaded from a file are only built if they
+        # are needed
+        if name != 'states' or getattr(self, '_compiled', None) is None:
+            raise AttributeError(name)
+        c = self._compiled
+        self.states = {}
+        for i, s_name in enumerate(c.names):
+            emission = {}
+            for k, sym in enumerate(c.symbols):
+                if c.log_emission[k][i] != _NEG_INF:
+                    emission[sym] = 10.0 ** c.log_emission[k][i]
+            transition = {}
+            for j, p in c.successors[i]:
+                transition[c.names[j]] = 10.0 ** p
+            termination = 0.0
+            if self.terminal_state:
+                termination = 10.0 ** c.log_termination[i]
+            self.states[s_name] = state(s_name, 10.0 ** c.log_initial[i],
+                                        emission, transition, termination)
+        return self.states
+
+    def __getstate__(self):
+        # a model loaded from a file is sent to other processes as the name
+        # of the file, so that they can map the same copy of it
+        if self._source is not None:
+            return {'_source': self._source}
+        d = dict((key, getattr(self, key)) for key in hmm.__slots__)
+        # the counts and caches of other processes are not kept
+        d['_stats'] = None
+        d['_cache'] = None
+        return d
+
+    def __setstate__(self, d):
+        if list(d.keys()) == ['_source']:
+            model = load(*d['_source'])
+            # the states of the loaded model are not built until needed
+            d = dict((key, getattr(model, key)) for key in hmm.__slots__
+                     if key != 'states')
+        for key, value in d.items():
+            setattr(self, key, value)
+
+    def save(self, filename):
+        """
+        Saves this model to a file in a compact binary format, which can be
+        loaded (and memory-mapped) by load().
+
+        The file consists of a header, holding the alphabet, the names of
+        the states and the symbols, followed by the log (base 10)
+        probability tables of the compiled model (see compiled_hmm), as
+        little-endian 64-bit floats: the initial probabilities, the
+        termination probabilities, the transition matrix (by row) and the
+        emission matrix (by symbol).  The tables start on an 8-byte
+        boundary.
+        """
+        c = self._model()
+        header = json.dumps({
+            'version': _FORMAT_VERSION,
+            'alphabet': list(self.alphabet),
+            'states': c.names,
+            'symbols': c.symbols,
+            'terminal_state': c.terminal_state,
+        }).encode('utf-8')
+        offset = len(_MAGIC) + 4 + len(header)
+        header += b' ' * (-offset % 8)
+
+        f = open(filename, 'wb')
+        try:
+            f.write(_MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for key in _TABLES:
+                table = getattr(c, key)
+                if c._tables is not None:
+                    table = c._tables[key].ravel().tolist()
+                elif key in ('log_transition', 'log_emission'):
+                    table = [p for row in table for p in row]
+                values = array.array('d', table)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                f.write(values.tostring() if sys.version_info[0] < 3
+                        else values.tobytes())
+        finally:
+            f.close()
+
+    def __repr__(self):
+        ret = ['hmm.hmm(']
+        ret.append('%s,' % self.alphabet)
+        ret.append('[')
+        for s_name, s in self.states.items():
+            ret.append('%s,' % repr(s))
+        ret.append(']')
+        ret.append(')')
+        return '\n'.join(ret)
+
+    def score(self, seq_state, seq_observed):
+        """
+        Calculates the log (base 10) of the probability of observing this
+        sequence of states and observations.
+
+        Parameters:
+          - seq_state: a list of strings, representing an ordered sequence
+            of states in the HMM
+          - seq_observed: a list of strings, representing an ordered sequence
+            of symbols that were observed
+        Returns:
+          - a float, representing the log (base 10) of the probability
+            of the state sequence being observed
+          - None if the specified state sequence is invalid because:
+           - the first state in the sequence cannot be an initial state (has
+             a p_initial of 0)
+           - there is no edge between two consecutive states in the state
+             sequence (i.e., the probability of transitioning from state[i] to
+             state[i+1] is 0 for some i)
+           - a state cannot emit the corresponding symbol in the sequence of
+             observations (i.e., seq_state[i] cannot emit seq_observed[i] for
+             some i)
+           - the model has a terminating state, and the last state in the
+             sequence does not have an edge to the terminating state
+           - the sequences of states and observations differ in length
+
+        TODO: Data validation:
+          - ensure that the specified sequence of observations only
+            includes symbols present in the alphabet
+        """
+
+        record = self._begin('score')
+        c = self._model()
+        path = [c.index[s] for s in seq_state]
+        codes = c.encode(seq_observed)
+        # there must be one state per observation, and if there is an
+        # implied terminal state, the last state must have an edge to it
+        if len(path) != len(codes) or \
+           (path and c.log_termination[path[-1]] == _NEG_INF):
+            self._end(record, len(path))
+            return None
+
+        began = time.time()
+        p = c.path_score(path, codes)
+        if record is not None:
+            record['cells'] += len(codes)
+            record['transitions'] += max(len(codes) - 1, 0)
+            record['seconds']['forward'] += time.time() - began
+            self._end(record, len(codes))
+        if p == _NEG_INF:
+            return None
+        return p
+
+    def score_paths(self, paths, observed, per_path=False, engine=None):
+        """
+        Calculates the log (base 10) of the probability of each of many
+        sequences of states, given the observations, in one vectorized
+        pass (see compiled_hmm.score_paths()).
+
+        Parameters:
+          - paths: a list of sequences of states; each may be a list of
+            state names, or a sequence of state indices (such as an integer
+            array), as in the names member of the compiled model.  They may
+            differ in length.
+          - observed: a sequence of observed symbols, shared by all of the
+            paths; or if per_path is True, a list of such sequences, one per
+            path
+          - per_path: see observed
+          - engine: 'numpy' or 'python'; by default, numpy if it is
+            installed
+        Returns:
+          - a tuple of two values, each with one entry per path (numpy
+            arrays with the numpy engine, or lists):
+            - the value that score() would return for each path, except
+              that invalid paths have -inf rather than None
+            - True for each valid path, False for each invalid one (see
+              score()); paths that differ in length from their observations,
+              or that include unknown states, are also invalid
+        """
+        if engine is None:
+            engine = 'numpy' if numpy is not None else 'python'
+        c = self._model()
+        paths = [c.encode_path(path) for path in paths]
+        if per_path:
+            codes = [c.encode(obs) for obs in observed]
+        else:
+            codes = [c.encode(observed)] * len(paths)
+        return c.score_paths(paths, codes, engine)
+
+    def enumerate(self, observed):
+        """
+        Enumerates every possible path of states that can explain an
+        observed sequence of symbols, along with the probability associated
+        with each of the state sequences, from the most probable to the
+        least probable.
+
+        The paths are generated lazily (see compiled_hmm.paths()), so
+        taking the first few is cheap even for long observations; it is
+        only exhausting the enumeration that is expensive, since the number
+        of state sequences can be as large as:
+            (#states)^(len(observation))
+
+        Parameters:
+          - observed: a sequence of observed symbols
+        Returns:
+          - a generator of tuples of two values:
+            - a list of state names
+            - a float, representing the log (base 10) of the probability
+              of the path, including the transition to the implied
+              terminal state (so the first tuple is the one returned by
+              viterbi_path())
+        """
+        c = self._model()
+        for path, p in c.paths(c.encode(observed)):
+            yield ([c.names[i] for i in path], p)
+
+    def k_best(self, observed, k):
+        """
+        Establishes the k most probable paths of states that explain a
+        sequence of observations.
+
+        Parameters:
+          - observed: a sequence of observed symbols
+          - k: the number of paths
+        Returns:
+          - a list of up to k tuples, as generated by enumerate(), in order
+            of decreasing probability
+        """
+        return list(itertools.islice(self.enumerate(observed), k))
+
+    def _p_emit(self, state, observation):
+        """
+        Retrieves the probability of a state emitting a given symbol.
+        """
+        s = self.states.get(state)
+        if s is None:
+            return None
+        return s.p_emission.get(observation, 0.0)
+
+    def _p_transition(self, from_state, to_state):
+        """
+        Retrieves the probability of a state transitioning to a given state.
+        """
+        s = self.states.get(from_state)
+        if s is None:
+            return None
+        return s.p_transition.get(to_state, 0.0)
+
+    def _connected(self, from_state, to_state):
+        """
+        Establishes whether there is an edge between two given states.
+
+        Parameters:
+          - from_state: a state in the states member of this object
+          - to_state: a state in the states member of this object
+        Returns:
+          - True if there is an edge from from_state to to_state
+          - False if there is no such edge, or if the from_state does not
+            exist
+        """
+        s = self.states.get(from_state)
+        return s is not None and s.p_transition.get(to_state, 0.0) > 0.0
+
+    def trellis(self, observed, beam=None, constraints=None):
+        """
+        Builds a trellis of the probabilities of the possible paths,
+        given a sequence of observed symbols.
+
+        Parameters:
+          - observed: a sequence of observed symbols
+          - beam: None, or a beam object; if given, the cells outside of
+            the beam are pruned (and shown as None), and only the cells
+            that survive are extended into the next column
+          - constraints: None, or the states allowed at each position (see
+            live_states()); only the cells of the trellis that lie on a
+            path that satisfies them are computed (the
+            others are shown as None)
+        Returns:
+          - a list of dictionaries, one dictionary per symbol in the
+            observations; each dictionary represents a column of the trellis
+
+        TODO: Data validation:
+          - ensure that the specified sequence of observations only
+            includes symbols present in the alphabet
+        """
+        record = self._begin('trellis')
+        c = self._model()
+        codes = c.encode(observed)
+        if beam is not None:
+            beam.cells += len(codes) * len(c.names)
+        began = time.time()
+        if constraints is not None:
+            columns, backpointers = c.viterbi(
+                codes, beam, c.reachable(codes, constraints, 'python'))
+        elif self._cache is not None and beam is None and len(codes):
+            # the cache only counts the columns that it computes
+            columns = self._cache.columns(c, 'python', codes, None, record)
+            began = None
+        else:
+            columns, backpointers = c.viterbi(codes, beam)
+        if record is not None:
+            if began is not None:
+                e = c.engine('python')
+                record['pruned'] += sum(e.unreachable(col) for col in columns)
+                c._count(record, codes, e, began)
+            self._end(record, len(codes))
+        if columns:
+            # the last column of the trellis can only include those states
+            # that can transition to the implied terminal state, if one
+            # exists
+            columns[-1] = c.terminate(columns[-1])
+        return self._named_columns(columns)
+
+    def _named_columns(self, columns):
+        """
+        Translates columns of log probabilities into dictionaries keyed by
+        state name, with None in place of -inf.
+        """
+        names = self._model().names
+        trellis = []
+        for col in columns:
+            probs = {}
+            for name, p in zip(names, col):
+                if p == _NEG_INF:
+                    probs[name] = None
+                else:
+                    probs[name] = p
+            trellis.append(probs)
+        return trellis
+
+    def extend_trellis(self, observed, appended):
+        """
+        Computes the columns of the trellis for symbols appended to a
+        sequence of observed symbols, without recomputing the columns of
+        the sequence itself if it (or a longer sequence that starts with
+        it) has been seen before by a cache attached with use_cache().
+
+        Parameters:
+          - observed: the sequence of observed symbols seen so far
+          - appended: the sequence of symbols appended to it
+        Returns:
+          - a list of dictionaries, one per appended symbol, which are the
+            columns of trellis(observed + appended) for those symbols
+        """
+        c = self._model()
+        codes = c.encode(observed)
+        new = c.encode(appended)
+        if len(new) == 0:
+            return []
+        whole = list(codes) + list(new)
+        if self._cache is not None:
+            columns = self._cache.columns(c, 'python', whole, len(new))
+        else:
+            columns = c.viterbi(whole)[0][len(codes):]
+        columns[-1] = c.terminate(columns[-1])
+        return self._named_columns(columns)
+
+    def viterbi_path(self, observed, engine=None, checkpoint=None,
+                     beam=None, chunks=None, constraints=None):
+        """
+        Establish the most probable path of states that explains a sequence
+        of observations, along with the probability of that path being
+        observed.
+
+        Parameters:
+          - seq_observed: a list of strings, representing an ordered sequence
+            of symbols that were observed
+          - engine: 'python' or 'numpy'; the numpy engine vectorizes each
+            column of the trellis over the states of the model and stores
+            the backpointers in a compact integer array.  Both engines
+            return identical results.  By default, numpy for a model
+            loaded by load(), and python otherwise (see
+            compiled_hmm.engine()).
+          - checkpoint: for very long sequences, None (the default), True,
+            or an interval k; if given, only every k-th column of the
+            trellis is kept, and the backpointers are recomputed one
+            segment at a time during the traceback, so that memory grows
+            with the square root of the length of the sequence rather than
+            linearly (with True, k is that square root).  The result is
+            exactly the same.
+          - beam: None, or a beam object, for approximate decoding: only the
+            best cells of each column (by the width and threshold of the
+            beam) are extended into the next column.  The beam collects
+            statistics about the pruning; see the beam class.
+          - chunks: None, or a chunking object, to split one long
+            sequence into chunks that are decoded in parallel processes
+            (exactly, or approximately with overlapping chunks); see the
+            chunking class.  This cannot be combined with checkpoint or
+            beam.
+          - constraints: None, or the states allowed at each position (see
+            live_states()); only the cells of the trellis that lie on a
+            path that satisfies them are computed
+            (this cannot be combined with checkpoint, beam or chunks)
+        Returns:
+          - a tuple of two values:
+            - a list of state names that explains the observations
+            - a float, representing the log (base 10) of the probability
+              of the sequence being observed
+          - (None, None) if no path of states can explain the observations
+        """
+        if chunks is not None:
+            if checkpoint or beam is not None or constraints is not None:
+                raise ValueError('chunks cannot be used with checkpoints, '
+                                 'a beam or constraints')
+            return self._viterbi_chunked(observed, engine, chunks)
+
+        record = self._begin('viterbi_path')
+        c = self._model()
+        codes = c.encode(observed)
+        if constraints is not None:
+            path, p = c.decode(codes, engine, checkpoint, beam, record,
+                               c.reachable(codes, constraints, engine))
+        elif self._cache is not None and beam is None and not checkpoint:
+            path, p = self._cache.decode(c, engine, codes, record)
+        else:
+            path, p = c.decode(codes, engine, checkpoint, beam, record)
+        self._end(record, len(codes))
+        if beam is not None:
+            beam.cells += len(codes) * len(c.names)
+            beam.score = p
+            if beam.compare:
+                exact_path, beam.exact_score = c.decode(codes, engine)
+                if p is not None and beam.exact_score is not None:
+                    beam.score_gap = beam.exact_score - p
+                else:
+                    beam.score_gap = None
+        if path is None:
+            return (None, None)
+        return ([c.names[i] for i in path], p)
+
+    def _viterbi_chunked(self, observed, engine, chunks):
+        """
+        The chunked form of viterbi_path().
+        """
+        c = self._model()
+        codes = c.encode(observed)
+        if len(codes) == 0:
+            return (None, None)
+        if chunks.size < 1:
+            raise ValueError('the chunk size must be at least 1')
+        bounds = [(a, min(a + chunks.size, len(codes)))
+                  for a in range(0, len(codes), chunks.size)]
+        chunks.chunks = len(bounds)
+        chunks.compared = 0
+        chunks.disagreements = 0
+        chunks.repaired = 0
+        chunks.exact = False
+
+        if chunks.overlap is not None:
+            path = self._stitch_overlapping(codes, engine, chunks, bounds)
+            if path is not None:
+                p = c.path_score(path, codes) + c.log_termination[path[-1]]
+                if p != _NEG_INF:
+                    return ([c.names[i] for i in path], p)
+            # the approximation failed, which does not mean that no path
+            # can explain the sequence: decode it exactly instead
+            chunks.exact = True
+
+        # the transfer matrices of the chunks, in parallel; then the best
+        # column at the end of each chunk, in turn
+        args = [(codes[a:b], engine, a == 0) for a, b in bounds]
+        matrices = list(self._map('_transfer', args, chunks.workers, 1,
+                                  True, {}))
+        e = c.engine('python')
+        ends = [list(matrices[0][0])]
+        for rows in matrices[1:]:
+            prev = ends[-1]
+            col = None
+            for i, row in enumerate(rows):
+                if prev[i] == _NEG_INF:
+                    continue
+                scores = [prev[i] + p for p in row]
+                if col is None:
+                    col = scores
+                else:
+                    col = [max(x, y) for x, y in zip(col, scores)]
+            if col is None:
+                return (None, None)
+            ends.append(col)
+
+        # the states at the boundaries of the chunks, from the last one back
+        state, p = e.best(e.terminate(ends[-1]))
+        if p == _NEG_INF:
+            return (None, None)
+        states = [state]
+        for k in range(len(matrices) - 1, 0, -1):
+            prev = ends[k - 1]
+            scores = [prev[i] + matrices[k][i][states[-1]]
+                      for i in range(len(prev))]
+            states.append(e.best(scores)[0])
+        states.reverse()
+
+        # the paths through the chunks, between those states, in parallel
+        args = [(codes[a:b], engine, states[k - 1] if k else None,
+                 states[k]) for k, (a, b) in enumerate(bounds)]
+        path = []
+        for segment in self._map('_segment', args, chunks.workers, 1, True,
+                                 {}):
+            path.extend(segment)
+        return ([c.names[i] for i in path], float(p))
+
+    def _stitch_overlapping(self, codes, engine, chunks, bounds):
+        """
+        Decodes each chunk, extended by the overlap on both sides,
+        independently, and joins the middles of their paths; the positions
+        in the overlaps where neighboring chunks disagree are counted.
+        """
+        extents = [(max(a - chunks.overlap, 0),
+                    min(b + chunks.overlap, len(codes))) for a, b in bounds]
+        args = [(codes[a:b], engine, None if a == 0 else -1, None,
+                 b == len(codes)) for a, b in extents]
+        segments = list(self._map('_segment', args, chunks.workers, 1, True,
+                                  {}))
+        if None in segments:
+            return None
+
+        c = self._model()
+        path = []
+        for k, ((a, b), (x, y)) in enumerate(zip(bounds, extents)):
+            middle = segments[k][a - x:b - x]
+            if path and c.edge(path[-1], middle[0]) == _NEG_INF:
+                # the chunks were decoded independently, and do not join:
+                # decode this one again from where the last one ended
+                middle = c.segment(codes[a:b], engine, path[-1], None,
+                                   b == len(codes))
+                chunks.repaired += 1
+                if middle is None:
+                    return None
+            path.extend(middle)
+            if k + 1 < len(bounds):
+                # the positions decoded by both this chunk and the next
+                x2 = extents[k + 1][0]
+                for t in range(x2, y):
+                    chunks.compared += 1
+                    if segments[k][t - x] != segments[k + 1][t - x2]:
+                        chunks.disagreements += 1
+        return path
+
+    def _transfer(self, codes, engine, first):
+        return self._model().transfer(codes, engine, first)
+
+    def _segment(self, codes, engine, start, end, terminate=True):
+        return self._model().segment(codes, engine, start, end, terminate)
+
+    def live_states(self, observed, constraints=None):
+        """
+        Establishes the states that can be occupied at each position by a
+        path of states that explains a sequence of observations: those
+        that can be reached from an initial state, and that can reach a
+        state that transitions to the implied terminal state (if any), in
+        the given number of steps.  All of the other cells of the trellis
+        are dead, and are skipped when constraints are given to trellis(),
+        viterbi_path(), likelihood(), forward(), backward() or posterior().
+
+        Parameters:
+          - observed: a sequence of observed symbols
+          - constraints: None, or the states allowed at each position (for
+            example, anchors where the state is known); either a
+            dictionary mapping positions to allowed states, or a sequence
+            with one entry per observation.  Each entry is a state name, a
+            collection of state names, or None (for any state).  An empty
+            dictionary allows any state, so that only the dead cells are
+            skipped.
+        Returns:
+          - a list of lists, one per symbol in the observations, of the
+            names of the live states at that position (all empty if no
+            path of states can explain the observations)
+        """
+        c = self._model()
+        return [[c.names[j] for j in live]
+                for live in c.reachable(c.encode(observed), constraints)]
+
+    def _live(self, c, codes, constraints, engine):
+        if constraints is None:
+            return None
+        return c.reachable(codes, constraints, engine)
+
+    def likelihood(self, observed, engine=None, constraints=None):
+        """
+        Calculates the log (base 10) of the total probability of a sequence
+        of observations, over all of the paths of states that can explain
+        it (using the forward algorithm).
+
+        Parameters:
+          - observed: a sequence of observed symbols
+          - engine: 'python' or 'numpy' (by default, numpy for a model
+            loaded by load(), and python otherwise)
+          - constraints: None, or the states allowed at each position (see
+            live_states()); if given, only the paths that satisfy them are
+            summed, so the result is the joint probability of the
+            observations and the constraints
+        Returns:
+          - a float, representing the log (base 10) of the probability
+            of the sequence being observed
+          - None if no path of states can explain the observations
+        """
+        record = self._begin('likelihood')
+        c = self._model()
+        codes = c.encode(observed)
+        began = time.time()
+        live = self._live(c, codes, constraints, engine)
+        columns, scales, p = c.forward(codes, engine, live)
+        if record is not None:
+            c._count(record, codes, c.engine(engine), began, 'forward', live)
+            record['log10_calls'] += len(scales)   # one log per scale
+            self._end(record, len(codes))
+        if not columns or p == _NEG_INF:
+            return None
+        return p
+
+    def forward(self, observed, engine=None, constraints=None):
+        """
+        Computes the forward probabilities of a sequence of observations:
+        the probability of observing the symbols up to and including each
+        position, and being in each state at that position.
+
+        Parameters:
+          - observed: a sequence of observed symbols
+          - engine: 'python' or 'numpy' (by default, numpy for a model
+            loaded by load(), and python otherwise)
+          - constraints: None, or the states allowed at each position (see
+            live_states()); if given, only the paths that satisfy them are
+            summed
+        Returns:
+          - a list of dictionaries, one dictionary per symbol in the
+            observations, mapping each state name to the log (base 10) of
+            its forward probability, or None if it is 0.  The last column
+            does not include the transition to the implied terminal state.
+        """
+        c = self._model()
+        codes = c.encode(observed)
+        live = self._live(c, codes, constraints, engine)
+        columns, scales, p = c.forward(codes, engine, live)
+        ret = []
+        offset = 0.0
+        for col, scale in zip(columns, scales):
+            offset += scale
+            ret.append(self._log_column(c, col, offset))
+        return ret
+
+    def backward(self, observed, engine=None, constraints=None):
+        """
+        Computes the backward probabilities of a sequence of observations:
+        the probability of observing the symbols after each position (and
+        then transitioning to the implied terminal state, if any), given
+        each state at that position.
+
+        Parameters:
+          - observed: a sequence of observed symbols
+          - engine: 'python' or 'numpy' (by default, numpy for a model
+            loaded by load(), and python otherwise)
+          - constraints: None, or the states allowed at each position (see
+            live_states()); if given, only the paths that satisfy them are
+            summed
+        Returns:
+          - a list of dictionaries, one dictionary per symbol in the
+            observations, mapping each state name to the log (base 10) of
+            its backward probability, or None if it is 0
+        """
+        c = self._model()
+        codes = c.encode(observed)
+        live = self._live(c, codes, constraints, engine)
+        columns, scales, p = c.forward(codes, engine, live)
+        if p == _NEG_INF:
+            return [dict((name, None) for name in c.names) for code in codes]
+        ret = []
+        offset = 0.0
+        for col, scale in zip(reversed(c.backward(codes, scales, engine,
+                                                  live)),
+                              reversed(scales)):
+            offset += scale
+            ret.append(self._log_column(c, col, offset))
+        ret.reverse()
+        return ret
+
+    def posterior(self, observed, engine=None, constraints=None):
+        """
+        Computes the posterior probability of each state at each position,
+        given the whole sequence of observations (using the forward-backward
+        algorithm).
+
+        Parameters:
+          - observed: a sequence of observed symbols
+          - engine: 'python' or 'numpy' (by default, see
+            compiled_hmm.engine()); the numpy engine vectorizes each
+            column over the states of the model
+          - constraints: None, or the states allowed at each position (see
+            live_states()); if given, the probabilities are conditioned on
+            them as well
+        Returns:
+          - a list of dictionaries, one dictionary per symbol in the
+            observations, mapping each state name to the probability of
+            being in that state at that position
+          - None if no path of states can explain the observations
+        """
+        record = self._begin('posterior')
+        c = self._model()
+        codes = c.encode(observed)
+        began = time.time()
+        live = self._live(c, codes, constraints, engine)
+        forward, scales, p = c.forward(codes, engine, live)
+        if record is not None:
+            c._count(record, codes, c.engine(engine), began, 'forward', live)
+            record['log10_calls'] += len(scales)   # one log per scale
+        if p == _NEG_INF:
+            self._end(record, len(codes))
+            return None
+        began = time.time()
+        backward = c.backward(codes, scales, engine, live)
+        if record is not None:
+            c._count(record, codes, c.engine(engine), began, 'backward')
+            self._end(record, len(codes))
+        ret = []
+        for f, b in zip(forward, backward):
+            ret.append(dict(zip(c.names, [float(x * y) for x, y in zip(f, b)])))
+        return ret
+
+    def decode_many(self, sequences, workers=None, chunksize=64,
+                    ordered=True, engine=None):
+        """
+        Establishes the most probable path of states for each of many
+        independent sequences of observations, in parallel across a pool of
+        worker processes.
+
+        The model (in its compiled form) is sent to each worker process
+        once, when the pool is started; the sequences are then streamed to
+        the workers in chunks, so the input can be any iterable, including
+        a generator that reads the sequences from a file.
+
+        Parameters:
+          - sequences: an iterable of sequences of observed symbols
+          - workers: the number of worker processes; the number of CPUs
+            if None.  With 1, the sequences are decoded in this process.
+          - chunksize: the number of sequences sent to a worker at a time
+          - ordered: if True, the results are yielded in the order of the
+            input; otherwise they are yielded as they are completed
+          - engine: 'python' or 'numpy' (by default, numpy for a model
+            loaded by load(), and python otherwise)
+        Returns:
+          - a generator; if ordered is True, it yields the same tuples as
+            viterbi_path() would for each sequence, in order.  Otherwise,
+            it yields tuples (i, result), where i is the position of the
+            sequence in the input.
+        """
+        return self._map('viterbi_path', ((obs,) for obs in sequences),
+                         workers, chunksize, ordered, {'engine': engine})
+
+    def score_many(self, pairs, workers=None, chunksize=64, ordered=True):
+        """
+        Calculates the score of each of many pairs of sequences of states
+        and observations, in parallel across a pool of worker processes.
+
+        Parameters:
+          - pairs: an iterable of tuples (seq_state, seq_observed)
+          - workers, chunksize, ordered: as for decode_many()
+        Returns:
+          - a generator of the values that score() would return for each
+            pair (see decode_many() for the effect of ordered)
+        """
+        return self._map('score', pairs, workers, chunksize, ordered, {})
+
+    def likelihood_many(self, sequences, workers=None, chunksize=64,
+                        ordered=True, engine=None):
+        """
+        Calculates the likelihood of each of many sequences of observations,
+        in parallel across a pool of worker processes.
+
+        Parameters:
+          - sequences: an iterable of sequences of observed symbols
+          - workers, chunksize, ordered, engine: as for decode_many()
+        Returns:
+          - a generator of the values that likelihood() would return for
+            each sequence (see decode_many() for the effect of ordered)
+        """
+        return self._map('likelihood', ((obs,) for obs in sequences),
+                         workers, chunksize, ordered, {'engine': engine})
+
+    def trellis_many(self, sequences, workers=None, chunksize=64,
+                     ordered=True):
+        """
+        Builds the trellis for each of many sequences of observations, in
+        parallel across a pool of worker processes.
+
+        Parameters:
+          - sequences: an iterable of sequences of observed symbols
+          - workers, chunksize, ordered: as for decode_many()
+        Returns:
+          - a generator of the values that trellis() would return for each
+            sequence (see decode_many() for the effect of ordered)
+        """
+        return self._map('trellis', ((obs,) for obs in sequences),
+                         workers, chunksize, ordered, {})
+
+    def viterbi_stream(self, observations, lag=None, engine=None):
+        """
+        Decodes a stream of observations online, yielding the states of the
+        most probable path as soon as they are known (see viterbi_decoder).
+
+        Parameters:
+          - observations: an iterable of observed symbols, or raw bytes
+            (bytes, bytearray, memoryview or mmap objects, one symbol per
+            byte)
+          - lag: if not None, the largest number of positions that may be
+            pending at any time; see viterbi_decoder
+          - engine: 'python' or 'numpy' (by default, numpy for a model
+            loaded by load(), and python otherwise)
+        Returns:
+          - a generator of state names, one per observation
+        Raises:
+          - ValueError if no path of states can explain the observations
+        """
+        decoder = viterbi_decoder(self, lag, engine)
+        if isinstance(observations, _BUFFER_TYPES):
+            # raw bytes are encoded a block at a time, rather than a
+            # symbol at a time (or all at once)
+            c = decoder.c
+            for start in range(0, len(observations), 65536):
+                for code in c.encode(observations[start:start + 65536]):
+                    for s in decoder._push(int(code)):
+                        yield s
+        else:
+            for symbol in observations:
+                for s in decoder.push(symbol):
+                    yield s
+        for s in decoder.finish():
+            yield s
+
+    def sample(self, count=1, length=None, seed=None, encoded=False,
+               max_length=None, batch=1024):
+        """
+        Generates random sequences of states, and of the symbols they emit,
+        from this model.
+
+        Without a length, each sequence ends when it transitions to the
+        implied terminal state, so the lengths vary as the model says they
+        should.  With a length, the implied terminal state (if any) is
+        ignored, and every sequence has exactly that length.  Either way, a
+        sequence ends early if it reaches a state that cannot emit any
+        symbol or that cannot be followed by any state.
+
+        With numpy, the sequences are drawn a batch at a time with
+        vectorized draws from alias tables of the states (see
+        compiled_hmm.sample()); the memory used is proportional to batch
+        times the length of the longest sequence of the batch.
+
+        Parameters:
+          - count: the number of sequences, or None for an endless stream
+          - length: None, or the length of every sequence
+          - seed: None, or the seed of the random number generator; the
+            same seed gives the same sequences (with the same version of
+            numpy, or without numpy)
+          - encoded: if True, the symbols and states are given as arrays
+            of indices, as returned by encode() for the symbols, and as
+            indices into the names of the states of the compiled model for
+            the states (which is much faster for large volumes)
+          - max_length: None, or the length at which sequences are cut
+            short (when length is None)
+          - batch: the number of sequences drawn at once
+        Returns:
+          - a generator of tuples of two values, one per sequence:
+            - the symbols emitted
+            - the names of the states that emitted them
+        Raises:
+          - ValueError if length is None and the model has no implied
+            terminal state
+        """
+        c = self._model()
+        for codes, path in c.sample(count, length, seed, max_length, batch):
+            if encoded:
+                if isinstance(codes, list):
+                    codes = array.array('B' if c.unknown < 256 else 'l',
+                                        codes)
+                    path = array.array('l', path)
+                yield (codes, path)
+            else:
+                if numpy is not None:
+                    codes = codes.tolist()
+                    path = path.tolist()
+                yield ([c.symbols[k] for k in codes],
+                       [c.names[i] for i in path])
+
+    def baum_welch(self, sequences, threshold=1e-6, max_iterations=100,
+                   workers=1, chunksize=64, engine=None, report=None):
+        """
+        Re-estimates the probabilities of this model from unannotated
+        sequences of observations, using the Baum-Welch (expectation
+        maximization) algorithm.
+
+        Each iteration computes the expected counts of the initial states,
+        emissions, transitions and terminal states over all of the
+        sequences (see compiled_hmm.expected_counts()), and then builds a
+        new model from them as train_hmm() would.  The E-step can be spread
+        across a pool of worker processes; each worker returns the merged
+        counts for a chunk of sequences (see training_counts.merge()).
+
+        The topology of the model is preserved: a transition or emission
+        with a probability of 0 never acquires an expected count, and the
+        implied terminal state (if any) is only reachable from the states
+        that could reach it before.  States that are not used in explaining
+        any of the sequences keep their probabilities.
+
+        Parameters:
+          - sequences: an iterable of sequences of observed symbols
+          - threshold: the iterations stop once the log (base 10) of the
+            likelihood of the sequences improves by less than this
+          - max_iterations: the largest number of iterations to run
+          - workers: the number of worker processes for the E-step; the
+            number of CPUs if None, or this process if 1 (the default)
+          - chunksize: the number of sequences in each task for a worker
+          - engine: 'python' or 'numpy' (by default, numpy for a model
+            loaded by load(), and python otherwise)
+          - report: if not None, a function called after each iteration
+            with three arguments: the number of the iteration, the log
+            (base 10) of the likelihood of the sequences under the model at
+            the start of the iteration, and the wall time of the iteration
+            in seconds
+        Returns:
+          - a tuple of two values:
+            - the re-estimated hmm object
+            - a list of tuples (iteration, log likelihood, seconds), one
+              per iteration, as passed to report
+        Raises:
+          - ValueError if none of the sequences can be explained by this
+            model
+        """
+        record = self._begin('baum_welch')
+        began = time.time()
+        sequences = list(sequences)
+        chunks = [(sequences[i:i+chunksize], engine)
+                  for i in range(0, len(sequences), chunksize)]
+
+        model = self
+        history = []
+        prev = None
+        for iteration in range(1, max_iterations + 1):
+            start = time.time()
+            counts = training_counts()
+            log_likelihood = 0.0
+            for i, (c, p) in model._map('_expected_counts', chunks,
+                                        workers, 1, False, {}):
+                counts.merge(c)
+                log_likelihood += p
+            if record is not None and model is not self:
+                record['log10_calls'] += model._model().log10_calls
+            if counts.sequences == 0:
+                raise ValueError('none of the sequences can be explained '
+                                 'by the model')
+
+            converged = prev is not None and \
+                        log_likelihood - prev < threshold
+            if not converged:
+                updated = model._reestimate(counts)
+            history.append((iteration, log_likelihood, time.time() - start))
+            if report is not None:
+                report(*history[-1])
+            if converged:
+                break
+            prev = log_likelihood
+            model = updated
+
+        if record is not None:
+            record['seconds']['training'] += time.time() - began
+            self._end(record, sum(len(seq) for seq in sequences))
+        return (model, history)
+
+    def _expected_counts(self, sequences, engine=None):
+        """
+        Computes the merged expected counts for a list of sequences of
+        observations, along with the sum of their log likelihoods; the
+        sequences that cannot be explained by this model are skipped.
+        """
+        c = self._model()
+        counts = training_counts()
+        log_likelihood = 0.0
+        for observed in sequences:
+            seq_counts, p = c.expected_counts(c.encode(observed), engine)
+            if seq_counts is not None:
+                counts.merge(seq_counts)
+                log_likelihood += p
+        return (counts, log_likelihood)
+
+    def _reestimate(self, counts):
+        """
+        Builds the model for the next iteration of baum_welch() from the
+        expected counts.
+        """
+        estimated = counts.model(self.terminal_state, self.alphabet).states
+        states = []
+        for name, s in self.states.items():
+            new = estimated.get(name)
+            if new is None or not counts.occurrences.get(name):
+                new = state(name, 0.0, s.p_emission, s.p_transition,
+                            s.p_termination)
+            elif not new.p_transition and not new.p_termination:
+                # only ever the last state of a sequence, in a model with
+                # no terminal state
+                new.p_transition = s.p_transition
+            states.append(new)
+        # the states that the expected counts never reach are kept, but
+        # become unreachable
+        return hmm(self.alphabet, states, validate=False)
+
+    def _map(self, method, args, workers, chunksize, ordered, kwargs):
+        """
+        Calls a method of this model for each tuple of arguments, in a
+        pool of worker processes.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self._model()   # so that the workers receive the compiled form
+
+        if workers <= 1:
+            call = getattr(self, method)
+            for i, a in enumerate(args):
+                if ordered:
+                    yield call(*a, **kwargs)
+                else:
+                    yield (i, call(*a, **kwargs))
+            return
+
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (self, method, kwargs))
+        try:
+            if ordered:
+                for i, result in pool.imap(_call_worker, enumerate(args),
+                                           chunksize):
+                    yield result
+            else:
+                for i, result in pool.imap_unordered(_call_worker,
+                                                     enumerate(args),
+                                                     chunksize):
+                    yield (i, result)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _log_column(self, c, col, offset):
+        """
+        Converts a scaled column of probabilities into a dictionary of
+        log probabilities, by state name.
+        """
+        probs = {}
+        for name, p in zip(c.names, col):
+            if p > 0.0:
+                probs[name] = math.log10(p) + offset
+            else:
+                probs[name] = None
+        return probs
+
+class beam:
+    def __init__(self, width=None, threshold=None, compare=False):
+        """
+        Describes a beam for approximate decoding with hmm.viterbi_path()
+        and hmm.trellis(), and collects statistics about the pruning.
+
+        After each column of the trellis is computed, only the cells
+        within the beam are kept and extended into the next column: the
+        width best cells, and/or those whose log (base 10) probability is
+        within threshold of the best cell of the column.  The last column
+        is never pruned.
+
+        Parameters:
+          - width: None, or the largest number of cells kept per column
+          - threshold: None, or the largest difference in log probability
+            between a kept cell and the best cell of its column
+          - compare: if True, viterbi_path() also decodes each sequence
+            exactly, to report the score gap
+
+        Members (accumulated over all of the calls that use this beam):
+          - cells: the number of cells in the trellises
+          - live: the number of cells with a non-zero probability, before
+            pruning
+          - pruned: the number of those cells that were pruned
+
+        Members (for the last call to viterbi_path()):
+          - score: the log probability of the decoded path
+          - exact_score: if compare is True, the log probability of the
+            exact Viterbi path
+          - score_gap: if compare is True, exact_score - score
+        """
+        self.width = width
+        self.threshold = threshold
+        self.compare = compare
+        self.cells = 0
+        self.live = 0
+        self.pruned = 0
+        self.score = None
+        self.exact_score = None
+        self.score_gap = None
+
+class stats:
+    # the phases that the wall time of a call is split into
+    PHASES = ('compile', 'forward', 'backward', 'traceback', 'training')
+
+    def __init__(self, callback=None):
+        """
+        Collects counts and timings of the work done by the methods of the
+        hmm objects it is attached to (see hmm.instrument()), and by
+        train_hmm(), to explain where the time of a slow call goes.
+
+        The counts are of:
+          - cells: the cells of the trellises computed
+          - transitions: the transitions evaluated (by the Viterbi and
+            forward/backward passes, or scored by score()); with a beam,
+            the transitions out of the pruned cells are included
+          - pruned: the cells of the Viterbi trellises found to be
+            unreachable (with zero probability), including those pruned
+            by a beam
+          - log10_calls: the logarithms of probabilities taken, when
+            compiling a model (see compiled_hmm) and scaling the forward
+            pass of likelihood() and posterior()
+
+        and the wall time (in seconds) is split by phase: 'compile' (the
+        compilation of the model on first use), 'forward' (the Viterbi or
+        forward pass), 'backward' (the backward pass), 'traceback' (the
+        traceback of the Viterbi path, including the recomputation of
+        checkpointed segments) and 'training' (train_hmm() and
+        hmm.baum_welch()).
+
+        Parameters:
+          - callback: None, or a function that is called with the record
+            of each call, when it completes (for example, to export it to
+            a metrics system)
+
+        Members (accumulated over all of the calls):
+          - calls: the number of calls
+          - length: the total length of the sequences
+          - cells, transitions, pruned, log10_calls: the counts
+          - seconds: a dictionary mapping each phase to its wall time
+          - last: the record of the last call
+
+        Each record is a dictionary of the counts, the seconds by phase,
+        'method' (the name of the method) and 'length' (the length of the
+        sequence, or the total length of the training data).
+        """
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        """
+        Sets all of the counts and timings back to zero.
+        """
+        self.calls = 0
+        self.length = 0
+        self.cells = 0
+        self.transitions = 0
+        self.pruned = 0
+        self.log10_calls = 0
+        self.seconds = dict((phase, 0.0) for phase in self.PHASES)
+        self.last = None
+
+    def begin(self, method):
+        """
+        Returns a new record of a call to a method.
+        """
+        return {'method': method, 'length': 0, 'cells': 0,
+                'transitions': 0, 'pruned': 0,
+                'log10_calls': 0,
+                'seconds': dict((phase, 0.0) for phase in self.PHASES)}
+
+    def end(self, record):
+        """
+        Completes a record, and adds it to the totals.
+        """
+        self.calls += 1
+        for key in ('length', 'cells', 'transitions', 'pruned',
+                    'log10_calls'):
+            setattr(self, key, getattr(self, key) + record[key])
+        for phase, seconds in record['seconds'].items():
+            self.seconds[phase] += seconds
+        self.last = record
+        if self.callback is not None:
+            self.callback(record)
+
+class chunking:
+    def __init__(self, size, overlap=None, workers=None):
+        """
+        Describes how hmm.viterbi_path() splits one long sequence into
+        chunks that are decoded in parallel, and collects statistics about
+        the last call that uses it.
+
+        Without an overlap, the decoding is exact: the max-plus transfer
+        matrix of each chunk (the best score from each state before the
+        chunk to each state at its end) is computed in parallel, the
+        matrices are combined in turn to find the states at the ends of
+        the chunks, and the paths through the chunks between those states
+        are then found in parallel.  The score is the same as that of the
+        sequential algorithm, as is the path (unless several paths tie).
+        Computing a transfer matrix takes about as many times the work of
+        decoding the chunk as there are states, so this pays off when
+        there are more processors than states.
+
+        With an overlap, each chunk is extended by overlap positions on
+        each side and decoded on its own (from and to any state, in the
+        middle of the sequence), and the middles of the paths are joined.
+        This takes about the work of decoding the sequence once, but the
+        path is only approximate, and its score is that of the joined
+        path.  The number of positions in the overlaps where neighboring
+        chunks decoded different states is reported; if it is not small,
+        the overlap should be larger.  Where the paths of two chunks do
+        not join (the last state of one cannot transition to the first
+        state of the next), the second chunk is decoded again from the
+        last state of the first; if that fails as well, the sequence is
+        decoded exactly instead, so that (None, None) is only returned
+        when no path of states can explain it.
+
+        Parameters:
+          - size: the number of positions per chunk
+          - overlap: None, for exact decoding, or the number of positions
+            each chunk is extended by on each side
+          - workers: the number of worker processes; None (the default)
+            uses one per CPU
+
+        Members (for the last call to viterbi_path()):
+          - chunks: the number of chunks
+          - compared: with an overlap, the number of positions decoded by
+            two neighboring chunks
+          - disagreements: the number of those positions at which the two
+            chunks decoded different states
+          - repaired: with an overlap, the number of chunks decoded again
+            so that their paths join
+          - exact: True if, with an overlap, the approximation failed and
+            the sequence was decoded exactly
+        """
+        self.size = size
+        self.overlap = overlap
+        self.workers = workers
+        self.chunks = 0
+        self.compared = 0
+        self.disagreements = 0
+        self.repaired = 0
+        self.exact = False
+
+class _trie_node(object):
+    """
+    A node of the trie of a trellis_cache: the column of the trellis for
+    the prefix of a sequence that ends at the node.
+    """
+    __slots__ = ('column', 'backpointers', 'parent', 'code', 'children')
+
+    def __init__(self, column, backpointers, parent, code):
+        self.column = column
+        self.backpointers = backpointers
+        self.parent = parent
+        self.code = code
+        self.children = {}
+
+class _trace_node(object):
+    """
+    A node of the traceback tree of a viterbi_decoder: a live state at a
+    pending position, linked to the state before it on its best path
+    (None at the oldest pending position).
+    """
+    __slots__ = ('state', 'position', 'parent', 'children')
+
+    def __init__(self, state, position, parent):
+        self.state = state
+        self.position = position
+        self.parent = parent
+        self.children = set()
+
+class trellis_cache:
+    def __init__(self, max_columns=100000):
+        """
+        A cache of the columns of Viterbi trellises, keyed by the prefix of
+        the sequence of observations they were computed for, for use with
+        hmm.use_cache().  When the trellis of a sequence is needed, the
+        columns of its longest cached prefix are reused, and only the
+        columns of the rest of the sequence are computed (and cached).
+
+        The columns are stored in a trie, with one node per column.  When
+        the cache is full, the least recently used columns are evicted,
+        starting from the ends of the sequences (a column is only evicted
+        after all of the columns that extend it), so a cached column can
+        always be traced back to the start of its sequence.
+
+        The cache belongs to a single model; it is cleared if it is used
+        with a different model (or after the model is recompiled).
+
+        Parameters:
+          - max_columns: the largest number of columns kept
+
+        Members:
+          - hits: the number of columns reused from the cache
+          - misses: the number of columns computed
+          - evictions: the number of columns evicted
+        """
+        self.max_columns = max_columns
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        """
+        Removes all of the columns from the cache (the counters are kept).
+        """
+        self._compiled = None
+        self._roots = {}
+        self._lru = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._lru)
+
+    def _touch(self, node):
+        """
+        Marks the columns of a prefix as the most recently used, from the
+        last one to the first, so that each column is more recently used
+        than all of the columns that extend it.
+        """
+        lru = self._lru
+        while node.parent is not None:
+            if node in lru:
+                del lru[node]
+                lru[node] = None
+            node = node.parent
+
+    def _make_room(self, keep):
+        """
+        Evicts the least recently used columns until there is room for
+        one more, and returns True, or returns False if that would evict a
+        column of the sequence being computed (keep, or one that it
+        extends).
+        """
+        lru = self._lru
+        while len(lru) >= self.max_columns:
+            if not lru:
+                return False
+            oldest = next(iter(lru))
+            if oldest is keep or oldest.children:
+                return False
+            del lru[oldest]
+            del oldest.parent.children[oldest.code]
+            self.evictions += 1
+        return True
+
+    def _lookup(self, compiled, engine, codes, record=None):
+        """
+        Returns the node of the last column of the trellis of an encoded
+        sequence, reusing the cached columns of its longest prefix and
+        computing (and caching) the rest.  Only the columns computed are
+        added to the record of a stats object, if one is given.
+        """
+        if self._compiled is not compiled:
+            self.clear()
+            self._compiled = compiled
+        e = compiled.engine(engine)
+        root = self._roots.get(e)
+        if root is None:
+            root = self._roots[e] = _trie_node(None, None, None, None)
+
+        node = root
+        t = 0
+        while t < len(codes):
+            child = node.children.get(int(codes[t]))
+            if child is None:
+                break
+            node = child
+            t += 1
+        self.hits += t
+        self._touch(node)
+
+        began = time.time()
+        start = t
+        caching = True
+        for t in range(start, len(codes)):
+            code = int(codes[t])
+            if t == 0:
+                col, bp = e.first(code), None
+            else:
+                col, bp = e.step(node.column, code)
+            child = _trie_node(col, bp, node, code)
+            if caching:
+                caching = self._make_room(node)
+            if caching:
+                node.children[code] = child
+                self._lru[child] = None
+            node = child
+            self.misses += 1
+        self._touch(node)
+        if record is not None and start < len(codes):
+            computed = node
+            for t in range(start, len(codes)):
+                record['pruned'] += e.unreachable(computed.column)
+                computed = computed.parent
+            record['cells'] += (len(codes) - start) * len(compiled.names)
+            record['transitions'] += e.transitions(codes[max(start - 1, 0):])
+            record['seconds']['forward'] += time.time() - began
+        return node
+
+    def columns(self, compiled, engine, codes, count=None, record=None):
+        """
+        Returns the columns of the trellis of an encoded sequence (or only
+        the last count of them); the last column does not include the
+        transition to the implied terminal state.
+        """
+        node = self._lookup(compiled, engine, codes, record)
+        if count is None:
+            count = len(codes)
+        columns = []
+        for i in range(count):
+            columns.append(node.column)
+            node = node.parent
+        columns.reverse()
+        return columns
+
+    def decode(self, compiled, engine, codes, record=None):
+        """
+        Returns the Viterbi path of an encoded sequence, as a list of state
+        indices, and its log probability, like compiled_hmm.decode().
+        """
+        if len(codes) == 0:
+            return (None, None)
+        node = self._lookup(compiled, engine, codes, record)
+        began = time.time()
+        e = compiled.engine(engine)
+        best, p = e.best(e.terminate(node.column))
+        if p == _NEG_INF:
+            return (None, None)
+        path = [best]
+        while node.backpointers is not None:
+            path.append(int(node.backpointers[path[-1]]))
+            node = node.parent
+        path.reverse()   # because the list of states was built backwards
+        if record is not None:
+            record['seconds']['traceback'] += time.time() - began
+        return (path, p)
+
+class viterbi_decoder:
+    def __init__(self, model, lag=None, engine=None):
+        """
+        Creates an online Viterbi decoder, which consumes observations one
+        at a time and emits the states of the most probable path as soon
+        as they are final.
+
+        A state is final once every path that is still possible passes
+        through it; the trellis columns and backpointers before that point
+        are discarded, so memory stays bounded as long as the surviving
+        paths keep converging.  This is exact: the emitted states are the
+        same as those returned by hmm.viterbi_path() for the whole sequence.
+
+        If lag is not None, then no more than lag positions are left
+        pending: when that many have accumulated, the oldest is decided by
+        the path that is currently the most probable, and the paths that
+        disagree with it are abandoned.  This bounds the memory and the
+        delay of the decoder for any model, but the result may differ from
+        the exact Viterbi path.
+
+        Parameters:
+          - model: an hmm object
+          - lag: None, or the largest number of pending positions (at
+            least 1)
+          - engine: 'python' or 'numpy' (by default, numpy for a model
+            loaded by load(), and python otherwise)
+
+        Members:
+          - position: the number of observations consumed so far
+          - emitted: the number of states emitted so far
+          - score: after finish(), the log (base 10) of the probability of
+            the decoded path, including the transition to the implied
+            terminal state
+        """
+        if lag is not None and lag < 1:
+            raise ValueError('lag must be at least 1')
+        self.c = model._model()
+        self.e = self.c.engine(engine)
+        self.lag = lag
+        self.position = 0
+        self.emitted = 0
+        self.score = None
+        self._column = None
+        # the backpointers of the pending positions (None for the first
+        # position of the sequence)
+        self._backpointers = collections.deque()
+        # the traceback tree of the surviving paths: its nodes in the
+        # current column, by state, and at the oldest pending position.
+        # Branches are removed as soon as they die, so the paths have
+        # converged when there is a single root.
+        self._leaves = {}
+        self._roots = set()
+
+    def push(self, symbol):
+        """
+        Consumes an observed symbol.  A byte value (an integer from 0 to
+        255, or a bytes object of length one), as found by iterating over
+        raw bytes, is taken to be the single-character symbol it encodes
+        (see compiled_hmm.encode()), unless it is itself a symbol of the
+        model.
+
+        Returns:
+          - a list of the names of the states that have become final, in
+            order (possibly empty)
+        Raises:
+          - ValueError if no path of states can explain the observations
+        """
+        c = self.c
+        code = c.symbol_index.get(symbol)
+        if code is None:
+            if isinstance(symbol, _BUFFER_TYPES) and len(symbol) == 1:
+                symbol = bytearray(symbol)[0]
+            if isinstance(symbol, int) and 0 <= symbol < 256:
+                code = c.byte_table()[symbol]
+            else:
+                code = c.unknown
+        return self._push(code)
+
+    def _push(self, code):
+        """
+        Consumes an encoded symbol; see push().
+        """
+        if self._column is None:
+            self._column = self.e.first(code)
+            self._backpointers.append(None)
+        else:
+            self._column, bp = self.e.step(self._column, code)
+            self._backpointers.append(bp)
+        self.position += 1
+
+        live = self.e.live(self._column)
+        if not live:
+            raise ValueError('no path of states can explain the observations')
+
+        self._grow(live, self._backpointers[-1])
+        emitted = self._converge()
+        if emitted:
+            return emitted
+
+        if self.lag is not None and self.position - self.emitted > self.lag:
+            # decide the oldest pending positions by the best current path,
+            # and abandon the paths that do not pass through the decision
+            k = self.position - self.lag - 1
+            best, p = self.e.best(self._column)
+            chosen = self._ancestors([best], k)[best]
+            ancestors = self._ancestors(live, k)
+            for s in live:
+                if ancestors[s] != chosen:
+                    self._column[s] = _NEG_INF
+                    self._prune(self._leaves.pop(s))
+            return self._converge()
+
+        return []
+
+    def _grow(self, live, bp):
+        """
+        Adds the live states of the new column to the traceback tree, and
+        removes the branches that end in the previous column.
+        """
+        position = self.position - 1
+        previous = self._leaves
+        self._leaves = {}
+        for s in live:
+            parent = None if bp is None else previous.get(int(bp[s]))
+            if parent is not None and parent.position < self.emitted:
+                parent = None   # its state has already been emitted
+            node = _trace_node(s, position, parent)
+            if parent is None:
+                self._roots.add(node)
+            else:
+                parent.children.add(node)
+            self._leaves[s] = node
+        for node in previous.values():
+            self._prune(node)
+
+    def _prune(self, node):
+        """
+        Removes a node of the traceback tree if no path continues from it,
+        and then its ancestors that no path passes through any more.
+        """
+        while node is not None and not node.children:
+            parent = node.parent
+            if parent is None:
+                self._roots.discard(node)
+            else:
+                parent.children.discard(node)
+            node = parent
+
+    def _converge(self):
+        """
+        Emits the pending states that every surviving path passes through,
+        from the oldest pending position on, and returns their names.
+        """
+        last = None
+        while len(self._roots) == 1:
+            last = self._roots.pop()
+            for child in last.children:
+                child.parent = None
+            self._roots, last.children = last.children, set()
+        if last is None:
+            return []
+        return self._emit(last.position, last.state)
+
+    def finish(self):
+        """
+        Signals the end of the observations.
+
+        Returns:
+          - a list of the names of the remaining states of the path
+        Raises:
+          - ValueError if no path of states can explain the observations
+        """
+        if self._column is None:
+            return []
+        best, p = self.e.best(self.e.terminate(self._column))
+        if p == _NEG_INF:
+            raise ValueError('no path of states can explain the observations')
+        self.score = p
+        return self._emit(self.position - 1, best)
+
+    def _ancestors(self, states, k):
+        """
+        Maps each of the given states in the current column to the state
+        on its best path at position k.
+        """
+        current = dict((s, s) for s in states)
+        bps = reversed(self._backpointers)
+        for pos in range(self.position - 1, k, -1):
+            bp = next(bps)
+            for s in states:
+                current[s] = int(bp[current[s]])
+        return current
+
+    def _emit(self, k, last):
+        """
+        Finalizes the pending positions up to and including position k,
+        where the path is in state last, and discards their backpointers.
+        """
+        if k < self.emitted:
+            return []
+        count = k - self.emitted + 1
+        bps = list(itertools.islice(self._backpointers, count))
+        path = [last]
+        for i in range(count - 1, 0, -1):
+            path.append(int(bps[i][path[-1]]))
+        path.reverse()
+
+        for i in range(count):
+            self._backpointers.popleft()
+        self.emitted = k + 1
+        return [self.c.names[s] for s in path]
+
+# the model, method and keyword arguments used by the worker processes of
+# hmm.decode_many() and friends; set once in each process by _init_worker()
+_worker_model = None
+_worker_method = None
+_worker_kwargs = None
+
+def _init_worker(model, method, kwargs):
+    global _worker_model, _worker_method, _worker_kwargs
+    _worker_model = model
+    _worker_method = getattr(model, method)
+    _worker_kwargs = kwargs
+
+def _call_worker(task):
+    i, args = task
+    return (i, _worker_method(*args, **_worker_kwargs))
+
+def load(filename, use_mmap=True):
+    """
+    Loads a model saved by hmm.save().
+
+    With numpy, the probability tables are used in place: the file is
+    memory-mapped (read-only) if use_mmap is True, so that processes that
+    load the same file share one copy of it, and loading takes about the
+    same time regardless of the size of the model.  The lists used by the
+    python engine and the states member of the model (with probabilities
+    recovered from their logs, to within rounding) are only built if they
+    are used.  Without numpy, the tables are read into lists.
+
+    Parameters:
+      - filename: the name of the file
+      - use_mmap: whether to memory-map the file (with numpy)
+    Returns:
+      - a new hmm object, ready for use
+    Raises:
+      - ValueError if the file is not in the expected format
+    """
+    f = open(filename, 'rb')
+    try:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('%s is not a saved hmm' % filename)
+        length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length).decode('utf-8'))
+        if header['version'] != _FORMAT_VERSION:
+            raise ValueError('unsupported format version: %s' %
+                             header['version'])
+        start = len(_MAGIC) + 4 + length
+
+        n = len(header['states'])
+        shapes = {'log_initial': (n,), 'log_termination': (n,),
+                  'log_transition': (n, n),
+                  'log_emission': (len(header['symbols']) + 1, n)}
+
+        c = compiled_hmm()
+        c.names = header['states']
+        c.index = dict((name, i) for i, name in enumerate(c.names))
+        c.symbols = header['symbols']
+        c.symbol_index = dict((sym, k) for k, sym in enumerate(c.symbols))
+        c.unknown = len(c.symbols)
+        c.terminal_state = header['terminal_state']
+
+        if numpy is not None:
+            if use_mmap:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                f.seek(0)
+                buf = f.read()
+            c._tables = {}
+            offset = start
+            for key in _TABLES:
+                count = int(numpy.prod(shapes[key]))
+                c._tables[key] = numpy.frombuffer(
+                    buf, dtype='<f8', count=count,
+                    offset=offset).reshape(shapes[key])
+                offset += count * 8
+        else:
+            f.seek(start)
+            for key in _TABLES:
+                shape = shapes[key]
+                values = array.array('d')
+                values.fromfile(f, shape[0] * (shape[1] if len(shape) > 1
+                                               else 1))
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                values = values.tolist()
+                if len(shape) > 1:
+                    values = [values[i*shape[1]:(i+1)*shape[1]]
+                              for i in range(shape[0])]
+                setattr(c, key, values)
+            c._build_adjacency()
+    finally:
+        f.close()
+
+    model = hmm(header['alphabet'], [])
+    del model.states
+    model.terminal_state = c.terminal_state
+    if c._tables is not None:
+        initial = c._tables['log_initial']
+        termination = c._tables['log_termination']
+    else:
+        initial = c.log_initial
+        termination = c.log_termination
+    model.initial_states = [name for name, p in zip(c.names, initial)
+                            if p != _NEG_INF]
+    model.terminating_states = []
+    if c.terminal_state:
+        model.terminating_states = [name for name, p in
+                                    zip(c.names, termination)
+                                    if p != _NEG_INF]
+    model._compiled = c
+    model._source = (filename, use_mmap)
+    return model
+
+def _open(source):
+    """
+    Returns a file object for a file name or an open (binary) file, and
+    whether it should be closed by the caller.
+    """
+    if hasattr(source, 'read'):
+        return (source, False)
+    return (open(source, 'rb'), True)
+
+def read_fasta(source):
+    """
+    Reads the sequences in a FASTA file, one at a time, so that a file
+    that holds many sequences never needs to be in memory at once.
+
+    Parameters:
+      - source: a file name, or a file object open in binary mode
+    Returns:
+      - a generator of tuples (name, sequence), where name is the text of
+        the header line after the '>' (a string) and sequence is the
+        sequence with the line breaks removed (bytes, one symbol per
+        byte), suitable for any of the methods that take a sequence of
+        observations
+    """
+    f, close = _open(source)
+    try:
+        name = None
+        lines = []
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield (name, b''.join(lines))
+                name = line[1:].strip().decode('utf-8')
+                lines = []
+            elif name is not None:
+                lines.append(line.strip())
+        if name is not None:
+            yield (name, b''.join(lines))
+    finally:
+        if close:
+            f.close()
+
+def read_lines(source):
+    """
+    Reads a file that holds one sequence of observations per line, one
+    line at a time; blank lines are skipped.
+
+    Parameters:
+      - source: a file name, or a file object open in binary mode
+    Returns:
+      - a generator of sequences (bytes, one symbol per byte, without the
+        line break)
+    """
+    f, close = _open(source)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if close:
+            f.close()
+
+class training_counts:
+    def __init__(self):
+        """
+        Creates an empty accumulator of the counts needed to construct an
+        HMM from annotated training data (see train_hmm()).
+
+        Each annotated sequence is read exactly once, so the training data
+        can be streamed from disk; accumulators built from different parts
+        of the training data (for example, in different processes) can be
+        combined with merge().  The counts may be fractional.
+
+        Members:
+          - sequences: the number of sequences counted
+          - initial: a dictionary mapping each state name to the number of
+            sequences that start in it
+          - occurrences: a dictionary mapping each state name to the number
+            of times it appears
+          - emission: a dictionary mapping each state name to a dictionary
+            of the number of times it emits each symbol
+          - transition: a dictionary mapping each state name to a
+            dictionary of the number of times it transitions to each state
+          - termination: a dictionary mapping each state name to the number
+            of sequences that end in it
+        """
+        self.sequences = 0
+        self.initial = {}
+        self.occurrences = {}
+        self.emission = {}
+        self.transition = {}
+        self.termination = {}
+
+    def add(self, symbols, states):
+        """
+        Counts one annotated sequence.
+
+        Either sequence may be given as raw bytes (bytes, bytearray,
+        memoryview or mmap objects), holding one single-character symbol
+        or state name per byte; when both are, and numpy is installed, the
+        sequence is counted without creating an object per position.
+
+        Parameters:
+          - symbols: a sequence of observed symbols
+          - states: a sequence of state names of the same length, which
+            best explains the symbols
+        """
+        if len(symbols) != len(states):
+            raise ValueError('the sequences of symbols and states must '
+                             'have the same length')
+        if len(states) == 0:
+            return
+
+        if isinstance(symbols, _BUFFER_TYPES) and \
+           isinstance(states, _BUFFER_TYPES) and numpy is not None:
+            self._add_bytes(_byte_array(symbols), _byte_array(states))
+            return
+        if isinstance(symbols, _BUFFER_TYPES):
+            symbols = _chars(symbols)
+        if isinstance(states, _BUFFER_TYPES):
+            states = _chars(states)
+
+        occurrences = self.occurrences
+        emission = self.emission
+        transition = self.transition
+        prev = None
+        for sym, s in zip(symbols, states):
+            occurrences[s] = occurrences.get(s, 0) + 1
+            emit = emission.setdefault(s, {})
+            emit[sym] = emit.get(sym, 0) + 1
+            if prev is not None:
+                tran = transition.setdefault(prev, {})
+                tran[s] = tran.get(s, 0) + 1
+            prev = s
+
+        self.sequences += 1
+        self.initial[states[0]] = self.initial.get(states[0], 0) + 1
+        self.termination[prev] = self.termination.get(prev, 0) + 1
+
+    def _add_bytes(self, symbols, states):
+        """
+        Counts one annotated sequence held in two numpy arrays of bytes,
+        by counting the pairs of byte values at once.
+        """
+        states = states.astype(numpy.intp)
+        pairs = numpy.bincount(states * 256 + symbols, minlength=65536)
+        steps = numpy.bincount(states[:-1] * 256 + states[1:],
+                               minlength=65536)
+        for counts, table in ((pairs, self.emission),
+                              (steps, self.transition)):
+            for pair in numpy.flatnonzero(counts):
+                row = table.setdefault(_chars([pair // 256]), {})
+                key = _chars([pair % 256])
+                row[key] = row.get(key, 0) + int(counts[pair])
+        totals = pairs.reshape(256, 256).sum(axis=1)
+        for s in numpy.flatnonzero(totals):
+            name = _chars([s])
+            self.occurrences[name] = self.occurrences.get(name, 0) + \
+                int(totals[s])
+
+        self.sequences += 1
+        first = _chars([states[0]])
+        last = _chars([states[-1]])
+        self.initial[first] = self.initial.get(first, 0) + 1
+        self.termination[last] = self.termination.get(last, 0) + 1
+
+    def update(self, training_data):
+        """
+        Counts each (symbols, states) tuple in an iterable.
+        """
+        for symbols, states in training_data:
+            self.add(symbols, states)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the counts of another training_counts object to this one.
+        """
+        self.sequences += other.sequences
+        for mine, theirs in ((self.initial, other.initial),
+                             (self.occurrences, other.occurrences),
+                             (self.termination, other.termination)):
+            for key, n in theirs.items():
+                mine[key] = mine.get(key, 0) + n
+        for mine, theirs in ((self.emission, other.emission),
+                             (self.transition, other.transition)):
+            for key, counts in theirs.items():
+                row = mine.setdefault(key, {})
+                for k, n in counts.items():
+                    row[k] = row.get(k, 0) + n
+        return self
+
+    def model(self, include_terminal_state=False, alphabet=None):
+        """
+        Creates an HMM from the counts.
+
+        Parameters:
+          - include_terminal_state: a boolean, indicating whether an implied
+            terminal state should be included in the model
+          - alphabet: the alphabet of the model; by default, the symbols
+            that were counted
+        Returns:
+          - a new hmm object, ready for use
+        """
+        if alphabet is None:
+            symbols = set()
+            for emit in self.emission.values():
+                symbols.update(emit.keys())
+            alphabet = list(symbols)
+
+        states = []
+        for s_name in self.occurrences:
+            s = state(s_name, self.initial.get(s_name, 0) /
+                              (self.sequences * 1.0), None, None)
+
+            emit = dict(self.emission.get(s_name, {}))
+            total = sum(emit.values())
+            for e in emit.keys():
+                emit[e] = emit[e] / (total * 1.0)
+            s.p_emission = emit
+
+            tran = dict(self.transition.get(s_name, {}))
+            total = sum(tran.values())
+            term = 0
+            if include_terminal_state:
+                term = self.termination.get(s_name, 0)
+                total += term
+            for t in tran.keys():
+                tran[t] = tran[t] / (total * 1.0)
+            s.p_transition = tran
+            if include_terminal_state:
+                s.p_termination = term / (total * 1.0)
+
+            states.append(s)
+
+        return hmm(alphabet, states)
+
+def train_hmm(training_data, include_terminal_state=False, stats=None):
+    """
+    Create a new HMM based solely on annotated training data.  Both the
+    topology of the state interconnections and the probabilities of the
+    emissions and transitions are inferred from training data.
+
+    The training data is read in a single pass (see training_counts), so
+    it can be any iterable, such as a generator that reads the sequences
+    from a file.
+
+    Parameters:
+      - training_data: an iterable of tuples; each tuple consists of two
+        lists of the same length:
+        - a list of symbols
+        - a list of states corresponding to the sequence that best explains
+          the list of symbols
+        Either list may be given as raw bytes, with one single-character
+        symbol or state name per byte (see training_counts.add()).
+      - include_terminal_state: a boolean, indicating whether an implied
+        terminal state should be included in the model
+      - stats: None, or a stats object to which the time taken is added
+    Returns:
+      - a new hmm object, ready for use
+    Raises:
+      - ValueError if the two lists in a tuple differ in length
+    """
+    if stats is not None:
+        record = stats.begin('train_hmm')
+        began = time.time()
+    counts = training_counts()
+    counts.update(training_data)
+    model = counts.model(include_terminal_state)
+    if stats is not None:
+        record['seconds']['training'] += time.time() - began
+        record['length'] = sum(counts.occurrences.values())
+        stats.end(record)
+    return model
 
@@ -0,0 +1,259 @@
+# Copyright (c) 2014 Michael Strosaker
+# MIT License
+# http://opensource.org/licenses/MIT
+
+"""
+The command-line interface of the hmm module, installed as the hmm
+command (or run as python -m hmm_cli):
+
+    hmm train annotated.txt [...] -o model.hmm [--terminal]
+    hmm decode model.hmm input.fa [-o paths.txt] [--workers N] ...
+    hmm score model.hmm input.fa [-o scores.txt] [--workers N] ...
+
+Annotated training files hold one sequence per line: the symbols and the
+states, separated by a tab.  Each is either a string of one-character
+symbols (or state names), or a list of them separated by spaces.
+
+The input files of decode and score are FASTA files, or files with one
+sequence of one-character symbols per line (the format is detected from
+the first character of the file); - reads the standard input.  The results
+are written as they are computed, one line per sequence: the name of the
+sequence (its header, or its line number), the log (base 10) probability
+(of the Viterbi path, or of the sequence), and, for decode, the path.
+
+Each command prints the number of sequences and symbols processed, the
+throughput and the peak memory use of the process to the standard error.
+"""
+
+import argparse, collections, io, sys, time
+
+import hmm
+
+try:
+    import resource
+except ImportError:
+    resource = None   # not available on Windows
+
+def _fields(field):
+    field = field.strip()
+    if ' ' in field:
+        return field.split()
+    return field
+
+def read_annotated(filename):
+    """
+    Reads an annotated training file, as a generator of tuples of
+    (symbols, states).
+    """
+    f = sys.stdin if filename == '-' else io.open(filename, 'rt')
+    try:
+        for n, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                symbols, states = line.rstrip('\r\n').split('\t')
+            except ValueError:
+                raise ValueError('%s, line %d: expected symbols and states '
+                                 'separated by a tab' % (filename, n + 1))
+            yield (_fields(symbols), _fields(states))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def _detect_format(f):
+    """
+    Returns 'fasta' or 'lines', according to the first byte of a file,
+    without consuming it.
+    """
+    if hasattr(f, 'peek'):
+        first = f.peek(1)[:1]
+    else:
+        try:
+            position = f.tell()
+            first = f.read(1)
+            f.seek(position)
+        except (IOError, OSError):
+            raise ValueError('cannot detect the format of the input; use '
+                             '--format')
+    return 'fasta' if first == b'>' else 'lines'
+
+def read_sequences(filename, format='auto'):
+    """
+    Reads a FASTA file or a file of one sequence per line, as a generator
+    of tuples of (name, sequence).
+    """
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    f = stdin if filename == '-' else open(filename, 'rb')
+    try:
+        if format == 'auto':
+            format = _detect_format(f)
+        if format == 'fasta':
+            for record in hmm.read_fasta(f):
+                yield record
+        else:
+            for n, seq in enumerate(hmm.read_lines(f)):
+                yield (str(n + 1), seq)
+    finally:
+        if f is not stdin:
+            f.close()
+
+class _progress:
+    """
+    Counts the sequences and symbols read, and the names of the sequences
+    whose results have not been written yet.
+    """
+    def __init__(self, records):
+        self.records = records
+        self.names = collections.deque()
+        self.sequences = 0
+        self.symbols = 0
+        self.start = time.time()
+
+    def __iter__(self):
+        for name, seq in self.records:
+            self.names.append(name)
+            self.sequences += 1
+            self.symbols += len(seq)
+            yield seq
+
+    def report(self, out=None):
+        out = out or sys.stderr
+        seconds = max(time.time() - self.start, 1e-9)
+        out.write('%d sequences, %d symbols in %.3f s: %.1f sequences/s, '
+                  '%.1f symbols/s\n' % (self.sequences, self.symbols, seconds,
+                                        self.sequences / seconds,
+                                        self.symbols / seconds))
+        peak = peak_memory()
+        if peak is not None:
+            out.write('peak memory: %.1f MB\n' % (peak / 1048576.0))
+
+def peak_memory():
+    """
+    Returns the peak resident memory of this process and its (finished)
+    worker processes, in bytes, or None if it is not known.
+    """
+    if resource is None:
+        return None
+    peak = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        peak = max(peak, resource.getrusage(who).ru_maxrss)
+    if sys.platform == 'darwin':
+        return peak         # already in bytes
+    return peak * 1024      # from kilobytes
+
+def _open_output(filename):
+    if filename is None or filename == '-':
+        return sys.stdout
+    return io.open(filename, 'wt')
+
+def _format_path(path):
+    if path is None:
+        return '-'
+    if all(len(name) == 1 for name in path):
+        return ''.join(path)
+    return ' '.join(path)
+
+def _format_score(p):
+    return '-inf' if p is None else repr(float(p))
+
+def train(args):
+    progress = _progress(())
+    counts = hmm.training_counts()
+    for filename in args.files:
+        for symbols, states in read_annotated(filename):
+            progress.sequences += 1
+            progress.symbols += len(symbols)
+            counts.add(symbols, states)
+    model = counts.model(args.terminal)
+    model.save(args.output)
+    progress.report()
+
+def decode(args):
+    model = hmm.load(args.model)
+    progress = _progress(read_sequences(args.input, args.format))
+    out = _open_output(args.output)
+    try:
+        if args.split:
+            chunks = hmm.chunking(args.split, workers=args.workers)
+            results = (model.viterbi_path(seq, args.engine, chunks=chunks)
+                       for seq in progress)
+        else:
+            results = model.decode_many(progress, args.workers,
+                                        args.chunksize, engine=args.engine)
+        for path, p in results:
+            out.write(u'%s\t%s\t%s\n' % (progress.names.popleft(),
+                                        _format_score(p), _format_path(path)))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    progress.report()
+
+def score(args):
+    model = hmm.load(args.model)
+    progress = _progress(read_sequences(args.input, args.format))
+    out = _open_output(args.output)
+    try:
+        for p in model.likelihood_many(progress, args.workers,
+                                       args.chunksize, engine=args.engine):
+            out.write(u'%s\t%s\n' % (progress.names.popleft(),
+                                     _format_score(p)))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    progress.report()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='hmm', description='Trains hidden Markov models, and decodes '
+                                'and scores sequences with them.')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('train', help='train a model from annotated '
+                                          'sequences')
+    p.add_argument('files', nargs='+', help='annotated training files')
+    p.add_argument('-o', '--output', required=True,
+                   help='the file to save the model to')
+    p.add_argument('--terminal', action='store_true',
+                   help='include an implied terminal state')
+    p.set_defaults(run=train)
+
+    for name, run, help in (
+            ('decode', decode, 'find the Viterbi path of each sequence'),
+            ('score', score, 'compute the log probability of each '
+                             'sequence')):
+        p = commands.add_parser(name, help=help)
+        p.add_argument('model', help='a model saved by train (or by '
+                                     'hmm.save())')
+        p.add_argument('input', help='a FASTA file, or a file of one '
+                                     'sequence per line (- for the '
+                                     'standard input)')
+        p.add_argument('-o', '--output',
+                       help='the file to write the results to (by '
+                            'default, the standard output)')
+        p.add_argument('--format', choices=['auto', 'fasta', 'lines'],
+                       default='auto', help='the format of the input')
+        p.add_argument('--workers', type=int, default=None,
+                       help='the number of worker processes (by default, '
+                            'one per CPU)')
+        p.add_argument('--chunksize', type=int, default=64,
+                       help='the number of sequences sent to a worker at a '
+                            'time')
+        p.add_argument('--engine', choices=['python', 'numpy'],
+                       default=None,
+                       help='the decoding engine (by default, numpy if it '
+                            'is installed, so that the worker processes '
+                            'share the tables of the model)')
+        if name == 'decode':
+            p.add_argument('--split', type=int, default=None,
+                           help='decode each sequence in chunks of this '
+                                'many symbols, in parallel (for very long '
+                                'sequences)')
+        p.set_defaults(run=run)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'run', None) is None:
+        parser.error('a command is required')
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+# Copyright (c) 2014 Michael Strosaker
+# MIT License
+# http://opensource.org/licenses/MIT
+
+"""
+An asyncio service that decodes sequences of observations with an hmm
+model, over HTTP on a TCP port or a Unix socket.  (Requires Python 3.7 or
+later; the hmm module itself does not.)
+
+Concurrent requests are coalesced into micro-batches, which are decoded
+by a pool of worker processes (or threads) that each hold a copy of the
+model.  The queue of pending requests is bounded: when it is full, new
+requests are rejected at once (503), rather than left to wait; requests
+that wait longer than the timeout are abandoned (504).
+
+Endpoints:
+  - POST /decode, with a JSON object {"observed": ...}, where the
+    observations are a string (one symbol per character) or a list of
+    symbols; the response is {"path": [...], "score": ...}, with nulls if
+    no path of states can explain the observations (or 400 if the
+    observations are neither)
+  - GET /metrics: the counters of the server (see decoding_server)
+
+Usage:
+    python hmm_server.py model.hmm [--host HOST] [--port PORT]
+                                   [--unix PATH] [--workers N] ...
+"""
+
+import argparse, asyncio, concurrent.futures, functools, json, os, time
+
+import hmm
+
+def _decode(model, engine, sequences):
+    """
+    Decodes a batch of sequences of observations.  The result of a sequence
+    that cannot be decoded is the exception raised, so that it fails alone
+    rather than with the rest of its batch.
+    """
+    results = []
+    for observed in sequences:
+        try:
+            results.append(model.viterbi_path(observed, engine=engine))
+        except Exception as e:
+            results.append(e)
+    return results
+
+# the model and engine of a worker process, set by _init_worker()
+_worker = None
+
+def _init_worker(model, engine):
+    global _worker
+    _worker = (model, engine)
+
+def _decode_batch(sequences):
+    return _decode(_worker[0], _worker[1], sequences)
+
+class decoding_server:
+    def __init__(self, model, batch_size=64, batch_delay=0.002,
+                 max_queue=1024, timeout=10.0, workers=None,
+                 engine=None):
+        """
+        Creates a service that decodes sequences of observations with a
+        model; see start() and serve_forever().
+
+        Parameters:
+          - model: an hmm object
+          - batch_size: the largest number of requests decoded together
+          - batch_delay: how long (in seconds) to wait for more requests
+            to join a batch, once there is one
+          - max_queue: the largest number of requests waiting to be
+            decoded; more are rejected
+          - timeout: how long (in seconds) a request may wait for its
+            result
+          - workers: the number of worker processes (None for one per
+            CPU), or 0 to decode in threads of this process
+          - engine: the engine passed to hmm.viterbi_path() (by default,
+            numpy for a model loaded by hmm.load(), which the worker
+            processes then share rather than copy)
+
+        Members:
+          - the counters of the server, in metrics()
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.workers = workers
+        self.engine = engine
+
+        self.requests = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched = 0
+        self.largest_batch = 0
+        self.max_queue_depth = 0
+        self.latency = 0.0
+
+        self._queue = None
+        self._servers = []
+        self._batcher = None
+        self._executor = None
+
+    def metrics(self):
+        """
+        Returns the counters of the server, as a dictionary:
+          - requests: the number of decoding requests received
+          - completed: the number decoded
+          - rejected: the number rejected because the queue was full
+          - timeouts: the number abandoned after the timeout
+          - errors: the number that could not be decoded
+          - queue_depth: the number of requests waiting now
+          - max_queue_depth: the largest number that have waited at once
+          - batches: the number of batches decoded
+          - mean_batch_size, largest_batch: the sizes of the batches
+          - mean_latency: the mean time (in seconds) from receiving a
+            request to its result, for the completed requests
+        """
+        return {
+            'requests': self.requests,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'max_queue_depth': self.max_queue_depth,
+            'batches': self.batches,
+            'mean_batch_size': self.batched / float(self.batches)
+                               if self.batches else 0.0,
+            'largest_batch': self.largest_batch,
+            'mean_latency': self.latency / self.completed
+                            if self.completed else 0.0,
+        }
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """
+        Starts the worker pool and the batcher, and listens for requests on
+        a TCP port (port 0 picks a free one) or, if path is given, on a
+        Unix socket.  Returns the address listened on: (host, port) or the
+        path.
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_queue)
+            if self.workers == 0:
+                self._executor = concurrent.futures.ThreadPoolExecutor(1)
+            else:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, initializer=_init_worker,
+                    initargs=(self.model, self.engine))
+            self._batcher = asyncio.ensure_future(self._batch_loop())
+
+        if path is not None:
+            server = await asyncio.start_unix_server(self._handle, path)
+            address = path
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+            address = server.sockets[0].getsockname()[:2]
+        self._servers.append(server)
+        return address
+
+    async def close(self):
+        """
+        Stops listening, and shuts down the batcher and the worker pool.
+        """
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._queue = None
+
+    async def serve_forever(self, host='127.0.0.1', port=8000, path=None):
+        await self.start(host, port, path)
+        try:
+            await asyncio.gather(*[server.serve_forever()
+                                   for server in self._servers])
+        finally:
+            await self.close()
+
+    async def decode(self, observed):
+        """
+        Queues a sequence of observations to be decoded in the next batch,
+        and returns its result, as hmm.viterbi_path() would.
+
+        Raises:
+          - asyncio.QueueFull if the queue is full
+          - asyncio.TimeoutError if there is no result within the timeout
+        """
+        self.requests += 1
+        received = time.time()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((observed, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise
+        self.max_queue_depth = max(self.max_queue_depth,
+                                   self._queue.qsize())
+        try:
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        self.completed += 1
+        self.latency += time.time() - received
+        return result
+
+    async def _batch_loop(self):
+        """
+        Takes batches of requests off of the queue and dispatches them to
+        the worker pool; at most one batch per worker is in flight, so
+        that the queue (and not the pool) holds the waiting requests.
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(max(self.workers or os.cpu_count() or 1,
+                                      1))
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(),
+                                                        remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # the requests that have timed out while waiting are dropped
+            batch = [(observed, future) for observed, future in batch
+                     if not future.done()]
+            if not batch:
+                continue
+            await slots.acquire()
+            self.batches += 1
+            self.batched += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            asyncio.ensure_future(self._dispatch(loop, batch, slots))
+
+    async def _dispatch(self, loop, batch, slots):
+        sequences = [observed for observed, future in batch]
+        try:
+            if self.workers == 0:
+                work = functools.partial(_decode, self.model, self.engine,
+                                         sequences)
+            else:
+                work = functools.partial(_decode_batch, sequences)
+            results = await loop.run_in_executor(self._executor, work)
+        except Exception as e:
+            for observed, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (observed, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            slots.release()
+
+    async def _handle(self, reader, writer):
+        """
+        Serves the HTTP requests of one connection.
+        """
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, payload = await self._respond(method, target, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                _write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method, target, body):
+        if target == '/metrics' and method == 'GET':
+            return (200, self.metrics())
+        if target != '/decode':
+            return (404, {'error': 'not found'})
+        if method != 'POST':
+            return (405, {'error': 'method not allowed'})
+        try:
+            observed = json.loads(body.decode('utf-8'))['observed']
+        except (ValueError, KeyError, TypeError):
+            return (400, {'error': 'expected a JSON object with an '
+                                   '"observed" member'})
+        if not isinstance(observed, str) and not (
+                isinstance(observed, list) and
+                all(isinstance(symbol, str) for symbol in observed)):
+            return (400, {'error': 'the observations must be a string or '
+                                   'a list of strings'})
+        try:
+            path, score = await self.decode(observed)
+        except asyncio.QueueFull:
+            return (503, {'error': 'the queue is full'})
+        except asyncio.TimeoutError:
+            return (504, {'error': 'timed out'})
+        except Exception as e:
+            return (500, {'error': str(e)})
+        return (200, {'path': path, 'score': score})
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 500: 'Internal Server Error',
+            503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+async def _read_request(reader):
+    """
+    Reads an HTTP request, as (method, target, headers, body), or returns
+    None at the end of the connection.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, version = line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = b''
+    length = int(headers.get('content-length', 0))
+    if length:
+        body = await reader.readexactly(length)
+    return (method, target, headers, body)
+
+def _write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(('HTTP/1.1 %d %s\r\n'
+                  'Content-Type: application/json\r\n'
+                  'Content-Length: %d\r\n'
+                  'Connection: %s\r\n\r\n' %
+                  (status, _REASONS[status], len(body),
+                   'keep-alive' if keep_alive else 'close')).encode('latin-1'))
+    writer.write(body)
+
+async def request(address, method, target, payload=None):
+    """
+    Sends one HTTP request to a server (on its own connection), and
+    returns the status and the decoded JSON response.
+
+    Parameters:
+      - address: (host, port), or the path of a Unix socket
+      - method: 'GET' or 'POST'
+      - target: '/decode' or '/metrics'
+      - payload: None, or an object to send as JSON
+    """
+    if isinstance(address, str):
+        reader, writer = await asyncio.open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection(*address)
+    try:
+        body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        writer.write(('%s %s HTTP/1.1\r\nHost: localhost\r\n'
+                      'Content-Type: application/json\r\n'
+                      'Content-Length: %d\r\nConnection: close\r\n\r\n' %
+                      (method, target, len(body))).encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+        line = await reader.readline()
+        status = int(line.split()[1])
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        return (status, json.loads((await reader.readexactly(length))
+                                   .decode('utf-8')))
+    finally:
+        writer.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serves Viterbi decoding with an hmm model saved by '
+                    'hmm.save().')
+    parser.add_argument('model', help='the file of the model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', help='listen on a Unix socket instead')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (0 for threads; default: '
+                             'one per CPU)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--batch-delay', type=float, default=0.002)
+    parser.add_argument('--max-queue', type=int, default=1024)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--engine', default=None,
+                        choices=['python', 'numpy'],
+                        help='default: numpy, if it is installed')
+    args = parser.parse_args(argv)
+
+    server = decoding_server(hmm.load(args.model), args.batch_size,
+                             args.batch_delay, args.max_queue, args.timeout,
+                             args.workers, args.engine)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
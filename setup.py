@@ -3,7 +3,19 @@
 # http://opensource.org/licenses/MIT
 
 import os, sys
-from distutils.core import setup
+
+try:
+    from setuptools import setup
+    # the hmm command; see hmm_cli.py
+    commands = {
+        'entry_points': {
+            'console_scripts': ['hmm = hmm_cli:main'],
+        },
+    }
+except ImportError:
+    # without setuptools, the command is run as python -m hmm_cli
+    from distutils.core import setup
+    commands = {}
 
 try:
     with open('README.rst', 'rt') as readme:
@@ -30,6 +42,10 @@ setup(
     # All packages and sub-packages must be listed here
     py_modules=[
         'hmm',
+        'hmm_cli',
+        'hmm_server',
         ],
+
+    **commands
 )
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2014 Michael Strosaker
+# MIT License
+# http://opensource.org/licenses/MIT
+
+"""
+Benchmarks for the hmm module.
+
+Random models of a given number of states, alphabet size and topology are
+generated from a fixed seed, sequences are sampled from them with
+hmm.sample(), and the main operations of the module are timed over a range
+of sizes.  The results are printed as a table and can be written to a JSON
+file; a previous JSON file can be given with --compare to report the change
+in each timing, to catch regressions between versions.
+
+Usage:
+    python benchmark.py [--quick] [--output results.json]
+                        [--compare baseline.json]
+"""
+
+import argparse, json, os, platform, random, string, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import hmm
+
+TOPOLOGIES = ('dense', 'left-to-right', 'banded')
+
+def random_model(n_states, n_symbols, topology='dense', band=2,
+                 terminal=False, seed=0):
+    """
+    Generates a random HMM.
+
+    Parameters:
+      - n_states: the number of states
+      - n_symbols: the size of the alphabet (at most 62); the symbols are
+        single characters, so that sequences can be given as bytes
+      - topology: the edges between the states:
+        - 'dense': every state can transition to every state
+        - 'left-to-right': each state can only transition to itself and
+          to the next band states; only the first state is initial
+        - 'banded': each state can transition to the states within band
+          of it
+      - band: the width of the band, for the left-to-right and banded
+        topologies
+      - terminal: whether the model has an implied terminal state
+      - seed: the seed of the random number generator
+    Returns:
+      - a new hmm object
+    """
+    if topology not in TOPOLOGIES:
+        raise ValueError('unknown topology: %s' % topology)
+    r = random.Random(seed)
+    alphabet = list((string.ascii_uppercase + string.ascii_lowercase +
+                     string.digits)[:n_symbols])
+    names = ['s%d' % i for i in range(n_states)]
+
+    states = []
+    for i, name in enumerate(names):
+        if topology == 'dense':
+            targets = range(n_states)
+        elif topology == 'left-to-right':
+            targets = range(i, min(i + band + 1, n_states))
+        else:
+            targets = range(max(i - band, 0), min(i + band + 1, n_states))
+        transition = dict((names[j], r.random() + 0.01) for j in targets)
+        termination = 0.0
+        if terminal:
+            termination = 0.01
+        total = sum(transition.values()) / (1.0 - termination)
+        for j in transition:
+            transition[j] /= total
+
+        emission = dict((sym, r.random() + 0.01) for sym in alphabet)
+        total = sum(emission.values())
+        for sym in emission:
+            emission[sym] /= total
+
+        if topology == 'left-to-right':
+            initial = 1.0 if i == 0 else 0.0
+        else:
+            initial = 1.0 / n_states
+        states.append(hmm.state(name, initial, emission, transition,
+                                termination))
+
+    return hmm.hmm(alphabet, states)
+
+def measure(func, repeat=3):
+    """
+    Returns the best time, in seconds, of several calls to a function.
+    """
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+def benchmarks(quick=False):
+    """
+    Generates the benchmarks to run, as tuples of (parameters, function),
+    where parameters is a dictionary describing the benchmark.
+    """
+    if quick:
+        sizes = [4, 16]
+        lengths = [100, 1000]
+    else:
+        sizes = [4, 16, 64]
+        lengths = [100, 1000, 10000]
+    engines = ['python']
+    if hmm.numpy is not None:
+        engines.append('numpy')
+
+    for topology in TOPOLOGIES:
+        for n in sizes:
+            model = random_model(n, 4, topology, terminal=True, seed=n)
+            for length in lengths:
+                symbols, states = next(model.sample(length=length,
+                                                    seed=length))
+                observed = ''.join(symbols).encode('ascii')
+                params = {'topology': topology, 'states': n, 'symbols': 4,
+                          'length': length}
+
+                for engine in engines:
+                    yield (dict(params, benchmark='viterbi_path',
+                                engine=engine),
+                           lambda m=model, o=observed, e=engine:
+                               m.viterbi_path(o, engine=e))
+                    yield (dict(params, benchmark='likelihood',
+                                engine=engine),
+                           lambda m=model, o=observed, e=engine:
+                               m.likelihood(o, engine=e))
+                yield (dict(params, benchmark='trellis', engine='python'),
+                       lambda m=model, o=observed: m.trellis(o))
+                yield (dict(params, benchmark='score', engine='python'),
+                       lambda m=model, s=states, o=observed: m.score(s, o))
+                yield (dict(params, benchmark='train_hmm', engine='python'),
+                       lambda s=symbols, p=states:
+                           hmm.train_hmm([(s, p)], True))
+
+    # the number of paths grows exponentially, so enumerate() is only timed
+    # on small models and sequences
+    for n in (2, 3):
+        model = random_model(n, 4, 'dense', terminal=True, seed=n)
+        for length in (4, 8):
+            symbols, states = next(model.sample(length=length,
+                                                seed=length))
+            yield ({'benchmark': 'enumerate', 'engine': 'python',
+                    'topology': 'dense', 'states': n, 'symbols': 4,
+                    'length': length},
+                   lambda m=model, o=symbols: list(m.enumerate(o)))
+
+def _key(result):
+    return (result['benchmark'], result['engine'], result['topology'],
+            result['states'], result['symbols'], result['length'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the hmm module.')
+    parser.add_argument('--quick', action='store_true',
+                        help='run a smaller set of sizes')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='the number of times to time each benchmark '
+                             '(the best time is reported)')
+    parser.add_argument('--output', help='write the results to a JSON file')
+    parser.add_argument('--compare',
+                        help='compare with the results in a JSON file')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            for result in json.load(f)['results']:
+                baseline[_key(result)] = result['seconds']
+
+    results = []
+    for params, func in benchmarks(args.quick):
+        result = dict(params, seconds=measure(func, args.repeat))
+        result['per_symbol'] = result['seconds'] / result['length']
+        results.append(result)
+
+        line = '%-13s %-7s %-14s %4d states %6d symbols  %10.6f s' % (
+            result['benchmark'], result['engine'], result['topology'],
+            result['states'], result['length'], result['seconds'])
+        before = baseline.get(_key(result))
+        if before:
+            line += '  (%+.1f%%)' % ((result['seconds'] / before - 1) * 100)
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': hmm.numpy.__version__ if hmm.numpy else None,
+                'platform': platform.platform(),
+                'repeat': args.repeat,
+                'results': results,
+            }, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@
 # MIT License
 # http://opensource.org/licenses/MIT
 
-import sys
+import io, itertools, math, os, pickle, sys, tempfile
 
 try:
     import unittest2 as unittest
@@ -12,7 +12,12 @@ except ImportError:
     import unittest
 
 sys.path.insert(0, '..')
-import hmm
+import hmm, hmm_cli
+
+try:
+    import asyncio, hmm_server
+except (ImportError, SyntaxError):
+    hmm_server = None   # the server requires Python 3.7 or later
 
 class TestHMMConstructor(unittest.TestCase):
 
@@ -58,6 +63,52 @@ class TestHMMConstructor(unittest.TestCase):
         self.assertTrue(model.terminal_state)
         self.assertEqual(len(model.terminating_states), 1)
 
+class TestValidation(unittest.TestCase):
+
+    def states(self, **changes):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        for key, value in changes.items():
+            setattr(s2, key, value)
+        return [s1, s2, s3]
+
+    def test_invalid_models(self):
+        alphabet = ['A', 'C', 'G', 'T']
+        hmm.hmm(alphabet, self.states())
+        for changes in [{'p_initial': 0.5},
+                        {'p_emission': {'A': 0.5, 'G': 0.6}},
+                        {'p_emission': {'A': 0.05, 'G': 0.95, 'U': 0.0}},
+                        {'p_transition': {'I': 0.5}},
+                        {'p_transition': {'I': 0.5, 'X': 0.5}},
+                        {'name': 'E'}]:
+            self.assertRaises(ValueError, hmm.hmm, alphabet,
+                              self.states(**changes))
+        # '5' can no longer be reached, nor 'I' through it
+        s1, s2, s3 = self.states()
+        s1.p_transition = {'E': 1.0}
+        self.assertRaises(ValueError, hmm.hmm, alphabet, [s1, s2, s3])
+        hmm.hmm(alphabet, [s1, s2, s3], validate=False)
+
+    def test_distributions(self):
+        s1, s2, s3 = self.states()
+        self.assertEqual(s2.p_emission, {'A': 0.05, 'C': 0.0, 'G': 0.95,
+                                         'T': 0.0})
+        self.assertEqual(sorted(s2.p_emission.keys()), ['A', 'C', 'G', 'T'])
+        self.assertEqual(s2.p_emission.get('U', 0.0), 0.0)
+        self.assertRaises(KeyError, lambda: s2.p_emission['U'])
+        s2.p_transition['5'] = 0.0
+        self.assertEqual(s2.p_transition, {'I': 1.0, '5': 0.0})
+        self.assertFalse(hasattr(s2, '__dict__'))
+        self.assertFalse(hasattr(hmm.hmm(['A'], []), '__dict__'))
+
 class TestViterbiPath(unittest.TestCase):
 
     def test_simple_hmm(self):
@@ -94,6 +145,1132 @@ class TestViterbiPath(unittest.TestCase):
                          'I', 'I', 'I', 'I', 'I', 'I', 'I'])
         self.assertEqual(round(prob, 10), -17.9014785649)
 
+    @unittest.skipIf(hmm.numpy is None, 'numpy is not installed')
+    def test_numpy_engine(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+        for observed in ['CTTCATGTGAAAGCAGACGTAAGTCA', 'GA', 'CCC']:
+            self.assertEqual(model.viterbi_path(observed, engine='numpy'),
+                             model.viterbi_path(observed))
+
+class TestCheckpointedViterbi(unittest.TestCase):
+
+    def test_implied_terminal_state(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+        for observed in ['CTTCATGTGAAAGCAGACGTAAGTCA', 'GA', 'CCC']:
+            expected = model.viterbi_path(observed)
+            for checkpoint in [True, 1, 3, 5, 100]:
+                self.assertEqual(model.viterbi_path(observed,
+                                                    checkpoint=checkpoint),
+                                 expected)
+
+class TestBeamViterbi(unittest.TestCase):
+
+    def test_implied_terminal_state(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+        observed = 'CTTCATGTGAAAGCAGACGTAAGTCA'
+        expected = model.viterbi_path(observed)
+
+        # a beam wide enough to hold every state prunes nothing
+        b = hmm.beam(width=3, compare=True)
+        self.assertEqual(model.viterbi_path(observed, beam=b), expected)
+        self.assertEqual(b.pruned, 0)
+        self.assertEqual(b.cells, 3 * len(observed))
+        self.assertEqual(b.score_gap, 0.0)
+
+        # keeping only the best cell follows 'E' until it is too late to
+        # reach 'I'
+        b = hmm.beam(width=1, compare=True)
+        self.assertEqual(model.viterbi_path(observed, beam=b), (None, None))
+        self.assertTrue(b.pruned > 0)
+        self.assertEqual(b.exact_score, expected[1])
+        self.assertEqual(b.score_gap, None)
+
+        b = hmm.beam(threshold=2.0, compare=True)
+        path, prob = model.viterbi_path(observed, beam=b)
+        self.assertEqual(len(path), len(observed))
+        self.assertTrue(b.score_gap >= 0.0)
+        self.assertAlmostEqual(b.score_gap, expected[1] - prob)
+
+        trellis = model.trellis(observed, beam=hmm.beam(width=2))
+        self.assertEqual(sum(1 for p in trellis[5].values() if p is None), 1)
+
+    @unittest.skipIf(hmm.numpy is None, 'numpy is not installed')
+    def test_numpy_engine(self):
+        s1 = hmm.state('S1', 0.5,
+                       { '1': 0.5, '2': 0.5 },
+                       { 'S1': 0.9, 'S2': 0.1 })
+        s2 = hmm.state('S2', 0.5,
+                       { '1': 0.25, '2': 0.75 },
+                       { 'S1': 0.8, 'S2': 0.2 })
+        model = hmm.hmm(['1', '2'], [s1, s2])
+        observed = '2221212112222111' * 4
+
+        for width, threshold in [(1, None), (None, 0.5), (2, 0.1)]:
+            slow = hmm.beam(width, threshold)
+            fast = hmm.beam(width, threshold)
+            self.assertEqual(model.viterbi_path(observed, beam=slow),
+                             model.viterbi_path(observed, engine='numpy',
+                                                beam=fast))
+            self.assertEqual(slow.pruned, fast.pruned)
+
+class TestKBest(unittest.TestCase):
+
+    def test_simple_hmm(self):
+        s1 = hmm.state('S1', 0.5,
+                       { '1': 0.5, '2': 0.5 },
+                       { 'S1': 0.9, 'S2': 0.1 })
+        s2 = hmm.state('S2', 0.5,
+                       { '1': 0.25, '2': 0.75 },
+                       { 'S1': 0.8, 'S2': 0.2 })
+        model = hmm.hmm(['1', '2'], [s1, s2])
+
+        paths = list(model.enumerate('222'))
+        self.assertEqual(len(paths), 8)
+        self.assertEqual(paths[0], model.viterbi_path('222'))
+        scores = [p for path, p in paths]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        for path, p in paths:
+            self.assertAlmostEqual(model.score(path, '222'), p)
+        self.assertEqual(sorted(tuple(path) for path, p in paths),
+                         list(itertools.product(['S1', 'S2'], repeat=3)))
+
+        self.assertEqual(model.k_best('222', 3), paths[:3])
+
+    def test_implied_terminal_state(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+        observed = 'CTTCATGTGAAAGCAGACGTAAGTCA'
+
+        best = model.k_best(observed, 5)
+        self.assertEqual(best[0], model.viterbi_path(observed))
+        # each path moves from 'E' to 'I' at a different 'G' or 'A'
+        self.assertEqual(len(set(path.index('5') for path, p in best)), 5)
+        for path, p in best:
+            self.assertAlmostEqual(model.score(path, observed) +
+                                   math.log10(0.1), p)
+        self.assertEqual(list(model.enumerate('CCC')), [])
+
+class TestForwardBackward(unittest.TestCase):
+
+    def test_simple_hmm(self):
+        s1 = hmm.state('S1', 0.5,
+                       { '1': 0.5, '2': 0.5 },
+                       { 'S1': 0.9, 'S2': 0.1 })
+        s2 = hmm.state('S2', 0.5,
+                       { '1': 0.25, '2': 0.75 },
+                       { 'S1': 0.8, 'S2': 0.2 })
+        model = hmm.hmm(['1', '2'], [s1, s2])
+
+        # sum the probabilities of every path of states
+        total = 0.0
+        first = {'S1': 0.0, 'S2': 0.0}
+        for path in itertools.product(['S1', 'S2'], repeat=3):
+            p = 10 ** model.score(path, '212')
+            total += p
+            first[path[0]] += p
+
+        self.assertAlmostEqual(model.likelihood('212'), math.log10(total))
+        posterior = model.posterior('212')
+        self.assertEqual(len(posterior), 3)
+        self.assertAlmostEqual(posterior[0]['S1'], first['S1'] / total)
+        for col in posterior:
+            self.assertAlmostEqual(sum(col.values()), 1.0)
+
+        forward = model.forward('212')
+        backward = model.backward('212')
+        self.assertAlmostEqual(
+            10 ** (forward[1]['S2'] + backward[1]['S2']) / total,
+            posterior[1]['S2'])
+
+    def test_implied_terminal_state(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+        # the only path that explains 'CGA' is E, 5, I
+        p = model.score(['E', '5', 'I'], 'CGA') + math.log10(0.1)
+        self.assertAlmostEqual(model.likelihood('CGA'), p)
+        self.assertAlmostEqual(model.posterior('CGA')[1]['5'], 1.0)
+        self.assertEqual(model.likelihood('CCC'), None)
+        self.assertEqual(model.posterior('CCC'), None)
+
+    @unittest.skipIf(hmm.numpy is None, 'numpy is not installed')
+    def test_numpy_engine(self):
+        s1 = hmm.state('S1', 0.5,
+                       { '1': 0.5, '2': 0.5 },
+                       { 'S1': 0.9, 'S2': 0.1 })
+        s2 = hmm.state('S2', 0.5,
+                       { '1': 0.25, '2': 0.75 },
+                       { 'S1': 0.8, 'S2': 0.2 })
+        model = hmm.hmm(['1', '2'], [s1, s2])
+
+        observed = '2121122' * 200
+        self.assertAlmostEqual(model.likelihood(observed, engine='numpy'),
+                               model.likelihood(observed))
+        fast = model.posterior(observed, engine='numpy')
+        slow = model.posterior(observed)
+        self.assertAlmostEqual(fast[700]['S2'], slow[700]['S2'])
+
+class TestBaumWelch(unittest.TestCase):
+
+    def test_implied_terminal_state(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+        sequences = ['CTTCATGTGAAAGCAGACGTAAGTCA',
+                     'CTTCATGTGAAAGCAGACATAAGTCA',
+                     'GATTACAGTAAGTATTA', 'CCGGTAGTTTTT']
+        reported = []
+
+        trained, history = model.baum_welch(
+            sequences, threshold=1e-4, max_iterations=20,
+            report=lambda *args: reported.append(args))
+
+        self.assertEqual(reported, history)
+        self.assertEqual(history[0][0], 1)
+        likelihoods = [ll for i, ll, seconds in history]
+        self.assertAlmostEqual(likelihoods[0],
+                               sum(model.likelihood(s) for s in sequences))
+        for before, after in zip(likelihoods, likelihoods[1:]):
+            self.assertTrue(after >= before - 1e-9)
+        self.assertTrue(likelihoods[-1] > likelihoods[0])
+
+        # the topology is unchanged
+        self.assertEqual(sorted(trained.states['E'].p_transition.keys()),
+                         ['5', 'E'])
+        self.assertEqual(list(trained.states['5'].p_transition.keys()),
+                         ['I'])
+        self.assertEqual(trained.states['5'].p_emission.get('C', 0.0), 0.0)
+        self.assertEqual(trained.initial_states, ['E'])
+        self.assertEqual(trained.terminating_states, ['I'])
+        self.assertAlmostEqual(trained.states['I'].p_transition['I'] +
+                               trained.states['I'].p_termination, 1.0)
+
+        parallel, history2 = model.baum_welch(sequences, max_iterations=2,
+                                              workers=2, chunksize=1)
+        self.assertAlmostEqual(history2[1][1], history[1][1])
+
+class TestCompiledHMM(unittest.TestCase):
+
+    def test_tables(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+        c = model.compile()
+
+        e, five, i = c.index['E'], c.index['5'], c.index['I']
+        self.assertEqual(c.names[five], '5')
+        self.assertEqual(c.log_initial[e], 0.0)
+        self.assertEqual(c.log_initial[i], float('-inf'))
+        self.assertEqual(round(c.log_transition[e][five], 6), -1.0)
+        self.assertEqual(c.log_transition[e][i], float('-inf'))
+        self.assertEqual(c.log_emission[c.symbol_index['C']][five],
+                         float('-inf'))
+        self.assertEqual(round(c.log_termination[i], 6), -1.0)
+        self.assertEqual(c.log_termination[e], float('-inf'))
+        self.assertEqual(c.encode('GX'), [c.symbol_index['G'], c.unknown])
+        self.assertTrue(model._model() is c)
+
+    def test_score_and_trellis(self):
+        s1 = hmm.state('S1', 0.5,
+                       { '1': 0.5, '2': 0.5 },
+                       { 'S1': 0.9, 'S2': 0.1 })
+        s2 = hmm.state('S2', 0.5,
+                       { '1': 0.25, '2': 0.75 },
+                       { 'S1': 0.8, 'S2': 0.2 })
+        model = hmm.hmm(['1', '2'], [s1, s2])
+
+        state_path, prob = model.viterbi_path('222')
+        self.assertEqual(round(model.score(state_path, '222'), 6),
+                         round(prob, 6))
+        self.assertEqual(model.score(['S1', 'S2'], '2X'), None)
+        self.assertEqual(model.score([], ''), 0.0)
+        # the states and observations must correspond one to one
+        self.assertEqual(model.score(['S2', 'S1', 'S1'], '22'), None)
+        self.assertEqual(model.score(['S2', 'S1'], '222'), None)
+
+        trellis = model.trellis('222')
+        self.assertEqual(len(trellis), 3)
+        self.assertEqual(round(max(trellis[-1].values()), 6),
+                         round(prob, 6))
+
+class TestChunkedViterbi(unittest.TestCase):
+
+    def setUp(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        self.model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+    def test_exact(self):
+        observed = 'CTTCATGTGAAAGCAGACGTAAGTCA'
+        expected = self.model.viterbi_path(observed)
+        for size in (1, 5, 18, 19, 100):
+            chunks = hmm.chunking(size, workers=1)
+            path, score = self.model.viterbi_path(observed, chunks=chunks)
+            self.assertEqual(path, expected[0])
+            self.assertAlmostEqual(score, expected[1])
+            self.assertEqual(chunks.chunks, (len(observed) + size - 1) // size)
+        chunks = hmm.chunking(4, workers=2)
+        self.assertEqual(self.model.viterbi_path(observed, 'numpy'
+                                                 if hmm.numpy else 'python',
+                                                 chunks=chunks)[0],
+                         expected[0])
+        self.assertEqual(self.model.viterbi_path('CCCCCCC',
+                                                 chunks=chunks),
+                         (None, None))
+
+    def test_overlap(self):
+        observed = 'CTTCATGTGAAAGCAGACGTAAGTCA'
+        expected = self.model.viterbi_path(observed)
+        chunks = hmm.chunking(8, overlap=8, workers=1)
+        self.assertEqual(self.model.viterbi_path(observed, chunks=chunks),
+                         expected)
+        self.assertEqual(chunks.compared, 16 + 16 + 10)
+        self.assertEqual(chunks.disagreements, 0)
+        self.assertRaises(ValueError, self.model.viterbi_path, observed,
+                          checkpoint=True, chunks=chunks)
+
+    def test_overlap_junctions(self):
+        # a left-to-right model: chunks decoded on their own rarely join
+        s1 = hmm.state('a', 1.0, {'x': 0.8, 'y': 0.1, 'z': 0.1},
+                       {'a': 0.7, 'b': 0.3})
+        s2 = hmm.state('b', 0.0, {'x': 0.1, 'y': 0.8, 'z': 0.1},
+                       {'b': 0.7, 'c': 0.3})
+        s3 = hmm.state('c', 0.0, {'x': 0.1, 'y': 0.1, 'z': 0.8},
+                       {'c': 0.8}, 0.2)
+        model = hmm.hmm(['x', 'y', 'z'], [s1, s2, s3])
+        observed = 'xxzyxyyxzzyxzzyz'
+        repaired = 0
+        for observed, model in [(observed, model),
+                                ('CTTCATGTGAAAGCAGACGTAAGTCA', self.model)]:
+            for size in range(1, 13):
+                for overlap in range(6):
+                    chunks = hmm.chunking(size, overlap=overlap, workers=1)
+                    path, score = model.viterbi_path(observed, chunks=chunks)
+                    self.assertNotEqual(path, None)
+                    self.assertAlmostEqual(
+                        score, model.score(path, observed) +
+                        math.log10(model.states[path[-1]].p_termination))
+                    repaired += chunks.repaired
+        self.assertTrue(repaired > 0)
+
+class TestConstrainedDecoding(unittest.TestCase):
+
+    def setUp(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        self.model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+    def test_live_states(self):
+        # the first state must be initial, the last one must be able to
+        # terminate, and the splice site must be reachable in between
+        self.assertEqual(self.model.live_states('CTTGA'),
+                         [['E'], ['E'], ['E'], ['5'], ['I']])
+        self.assertEqual(self.model.live_states('CTTGAG', {4: 'E'}),
+                         [[], [], [], [], [], []])
+        self.assertEqual(self.model.live_states('CGAT', [None, None,
+                                                         ['E', 'I'], None]),
+                         [['E'], ['5'], ['I'], ['I']])
+        self.assertRaises(ValueError, self.model.live_states, 'CGAT',
+                          {1: 'X'})
+        self.assertRaises(ValueError, self.model.live_states, 'CGAT',
+                          {4: 'E'})
+
+    def test_anchors(self):
+        observed = 'CTTCATGTGAAAGCAGACGTAAGTCA'
+        expected = ['E'] * 10 + ['5'] + ['I'] * 15
+        engines = ['python'] + (['numpy'] if hmm.numpy else [])
+        for engine in engines:
+            path, p = self.model.viterbi_path(observed, engine,
+                                              constraints={10: '5'})
+            self.assertEqual(path, expected)
+            self.assertAlmostEqual(p, self.model.score(expected, observed) +
+                                   math.log10(0.1))
+            # only one path is allowed, so it carries all of the probability
+            self.assertAlmostEqual(self.model.likelihood(
+                observed, engine, constraints={10: '5'}), p)
+            posterior = self.model.posterior(observed, engine,
+                                             constraints={10: '5'})
+            self.assertAlmostEqual(posterior[10]['5'], 1.0)
+            self.assertEqual(self.model.viterbi_path(observed, engine,
+                                                     constraints={}),
+                             self.model.viterbi_path(observed, engine))
+            self.assertAlmostEqual(self.model.likelihood(observed, engine,
+                                                         constraints={}),
+                                   self.model.likelihood(observed, engine))
+        self.assertEqual(self.model.viterbi_path(observed, constraints={
+                             10: '5', 2: ['5', 'I']}), (None, None))
+        # the dead cells are not computed, but the live ones are unchanged
+        trellis = self.model.trellis('CTTGA')
+        constrained = self.model.trellis('CTTGA', constraints={1: ['E', 'I']})
+        self.assertNotEqual(trellis[3]['E'], None)
+        self.assertEqual(constrained[3]['E'], None)
+        self.assertEqual(constrained[3]['5'], trellis[3]['5'])
+        self.assertEqual(constrained[4], trellis[4])
+
+    @unittest.skipIf(hmm.numpy is None, 'numpy is not installed')
+    def test_numpy_engine(self):
+        c = self.model.compile()
+        for observed, constraints in [('CTTGA', None), ('GA', None),
+                                      ('CGAT', {2: ['E', 'I']}),
+                                      ('CTTCATGTGAAAGCAG', {3: 'E'})]:
+            codes = c.encode(observed)
+            self.assertEqual([list(live) for live in
+                              c.reachable(codes, constraints, 'numpy')],
+                             c.reachable(codes, constraints, 'python'))
+
+    def test_stats(self):
+        # only the live cells, and the edges out of them, are counted
+        records = []
+        self.model.instrument(hmm.stats(records.append))
+        engines = ['python'] + (['numpy'] if hmm.numpy else [])
+        for engine in engines:
+            self.model.viterbi_path('CTTGA', engine, constraints={})
+            self.model.likelihood('CTTGA', engine, constraints={})
+        for record in records:
+            self.assertEqual(record['cells'], 5)
+            self.assertEqual(record['transitions'], 2 + 2 + 2 + 1)
+
+class TestSparseTopology(unittest.TestCase):
+
+    def _left_to_right(self, length):
+        # a chain of states, each of which can only repeat itself or
+        # advance to the next state
+        states = []
+        for i in range(length):
+            if i == length - 1:
+                states.append(hmm.state('M%d' % i, 0.0,
+                                        {'A': 0.7, 'B': 0.3},
+                                        {'M%d' % i: 0.5}, 0.5))
+            else:
+                states.append(hmm.state('M%d' % i, 1.0 if i == 0 else 0.0,
+                                        {'A': 0.3 + 0.05 * i,
+                                         'B': 0.7 - 0.05 * i},
+                                        {'M%d' % i: 0.4,
+                                         'M%d' % (i+1): 0.6}))
+        return hmm.hmm(['A', 'B'], states)
+
+    def test_predecessors(self):
+        model = self._left_to_right(8)
+        c = model.compile()
+
+        preds = c.predecessors[c.index['M3']]
+        self.assertEqual(sorted(c.names[i] for i, p in preds), ['M2', 'M3'])
+        succs = c.successors[c.index['M7']]
+        self.assertEqual([c.names[j] for j, p in succs], ['M7'])
+        self.assertEqual(c.predecessors[c.index['M0']],
+                         [(c.index['M0'], math.log10(0.4))])
+
+        path, prob = model.viterbi_path('ABABBBAAAA')
+        self.assertEqual(path[0], 'M0')
+        self.assertEqual(path[-1], 'M7')
+        self.assertAlmostEqual(model.score(path, 'ABABBBAAAA') +
+                               math.log10(0.5), prob)
+
+    @unittest.skipIf(hmm.numpy is None, 'numpy is not installed')
+    def test_numpy_engine(self):
+        model = self._left_to_right(8)
+        self.assertTrue(model.compile().engine('numpy').sparse)
+        for observed in ['ABABBBAAAA', 'BBBBBBBBBBBBBBBBBB', 'AAAAAA']:
+            self.assertEqual(model.viterbi_path(observed, engine='numpy'),
+                             model.viterbi_path(observed))
+
+class TestBatchDecoding(unittest.TestCase):
+
+    def test_decode_many(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+        sequences = ['CTTCATGTGAAAGCAGACGTAAGTCA', 'CCC', 'CGA',
+                     'CTTCATGTGAAAGCAGACATAAGTCA'] * 5
+
+        expected = [model.viterbi_path(obs) for obs in sequences]
+        self.assertEqual(list(model.decode_many(iter(sequences), workers=2,
+                                                chunksize=3)),
+                         expected)
+        self.assertEqual(list(model.decode_many(sequences, workers=1)),
+                         expected)
+        unordered = sorted(model.decode_many(sequences, workers=2,
+                                             ordered=False))
+        self.assertEqual([result for i, result in unordered], expected)
+
+        pairs = [(path, obs) for (path, p), obs in zip(expected, sequences)
+                 if path is not None]
+        self.assertEqual(list(model.score_many(pairs, workers=2)),
+                         [model.score(path, obs) for path, obs in pairs])
+        self.assertEqual(list(model.trellis_many(sequences[:2], workers=2)),
+                         [model.trellis(obs) for obs in sequences[:2]])
+
+class TestOnlineViterbi(unittest.TestCase):
+
+    def test_implied_terminal_state(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+        observed = 'CTTCATGTGAAAGCAGACGTAAGTCA'
+        state_path, prob = model.viterbi_path(observed)
+
+        decoder = hmm.viterbi_decoder(model)
+        emitted = []
+        for symbol in observed[:10]:
+            emitted.extend(decoder.push(symbol))
+        # after ten symbols, the surviving paths share their first eight
+        # states, which are emitted without waiting for the end
+        self.assertEqual(emitted, ['E'] * 8)
+        for symbol in observed[10:]:
+            emitted.extend(decoder.push(symbol))
+        emitted.extend(decoder.finish())
+        self.assertEqual(emitted, state_path)
+        self.assertEqual(decoder.score, prob)
+
+        self.assertEqual(list(model.viterbi_stream(iter(observed))),
+                         state_path)
+        self.assertRaises(ValueError, list, model.viterbi_stream('CCC'))
+
+    def test_lag(self):
+        s1 = hmm.state('S1', 0.5,
+                       { '1': 0.5, '2': 0.5 },
+                       { 'S1': 0.9, 'S2': 0.1 })
+        s2 = hmm.state('S2', 0.5,
+                       { '1': 0.25, '2': 0.75 },
+                       { 'S1': 0.8, 'S2': 0.2 })
+        model = hmm.hmm(['1', '2'], [s1, s2])
+        observed = '2221212112222111' * 4
+
+        decoder = hmm.viterbi_decoder(model, lag=2)
+        emitted = []
+        for symbol in observed:
+            emitted.extend(decoder.push(symbol))
+            self.assertTrue(decoder.position - decoder.emitted <= 2)
+        emitted.extend(decoder.finish())
+        self.assertEqual(len(emitted), len(observed))
+        self.assertAlmostEqual(model.score(emitted, observed), decoder.score)
+
+    def test_no_convergence(self):
+        # two paths that never meet: the traceback tree keeps only them,
+        # rather than retracing every pending position at each push
+        s1 = hmm.state('A', 0.5, {'x': 0.5, 'y': 0.5}, {'A': 1.0})
+        s2 = hmm.state('B', 0.5, {'x': 0.5, 'y': 0.25, 'z': 0.25},
+                       {'B': 1.0})
+        model = hmm.hmm(['x', 'y', 'z'], [s1, s2])
+        decoder = hmm.viterbi_decoder(model)
+        for symbol in 'xy' * 1000:
+            self.assertEqual(decoder.push(symbol), [])
+        self.assertEqual(len(decoder._roots), 2)
+        self.assertEqual(decoder.push('z'), ['B'] * 2001)
+        self.assertEqual(decoder.finish(), [])
+
+    def test_raw_bytes(self):
+        s1 = hmm.state('S1', 0.5,
+                       { '1': 0.5, '2': 0.5 },
+                       { 'S1': 0.9, 'S2': 0.1 })
+        s2 = hmm.state('S2', 0.5,
+                       { '1': 0.25, '2': 0.75 },
+                       { 'S1': 0.8, 'S2': 0.2 })
+        model = hmm.hmm(['1', '2'], [s1, s2])
+        state_path = model.viterbi_path('2212')[0]
+
+        raw = bytearray(b'2212')
+        for observations in (raw, memoryview(raw), bytes(raw)):
+            self.assertEqual(list(model.viterbi_stream(observations)),
+                             state_path)
+        # byte values pushed one at a time, as iterating over bytes yields
+        decoder = hmm.viterbi_decoder(model)
+        emitted = []
+        for symbol in raw:
+            emitted.extend(decoder.push(symbol))
+        emitted.extend(decoder.finish())
+        self.assertEqual(emitted, state_path)
+        self.assertRaises(ValueError, list, model.viterbi_stream(b'2232'))
+
+class TestBulkScoring(unittest.TestCase):
+
+    def _check(self, engine):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+        c = model.compile()
+
+        paths = [['E', 'E', '5', 'I', 'I'],
+                 ['E', '5', 'I', 'I', 'I'],
+                 ['E', 'E', 'E', 'E', 'E'],     # does not terminate
+                 ['E', 'E', 'I', 'I', 'I'],     # no edge from 'E' to 'I'
+                 ['E', '5', 'I'],               # too short
+                 ['E', 'E', '5', 'X', 'I'],     # unknown state
+                 [c.index[s] for s in ['E', 'E', '5', 'I', 'I']],
+                 [0, 0, 1, 2, 3],               # no state 3
+                 [0, 0, 1, 2, -1]]
+        scores, valid = model.score_paths(paths, 'ACGTA', engine=engine)
+        self.assertEqual(list(valid),
+                         [True, False, False, False, False, False, True,
+                          False, False])
+        self.assertEqual(list(scores[7:]), [float('-inf')] * 2)
+        self.assertAlmostEqual(scores[0],
+                               model.score(paths[0], 'ACGTA'))
+        self.assertEqual(scores[6], scores[0])
+        self.assertEqual(scores[1], float('-inf'))   # '5' cannot emit 'C'
+
+        scores, valid = model.score_paths(paths[:2], ['ACGTA', 'AGATT'],
+                                          per_path=True, engine=engine)
+        self.assertEqual(list(valid), [True, True])
+        self.assertAlmostEqual(scores[1], model.score(paths[1], 'AGATT'))
+
+    def test_python_engine(self):
+        self._check('python')
+
+    @unittest.skipIf(hmm.numpy is None, 'numpy is not installed')
+    def test_numpy_engine(self):
+        self._check('numpy')
+
+@unittest.skipIf(hmm_server is None or sys.version_info < (3, 7),
+                 'the server requires Python 3.7 or later')
+class TestDecodingServer(unittest.TestCase):
+
+    def setUp(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        self.model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+    def _run(self, server, requests):
+        loop = asyncio.new_event_loop()
+        try:
+            address = loop.run_until_complete(server.start())
+            tasks = [loop.create_task(hmm_server.request(
+                         address, 'POST', '/decode', {'observed': observed}))
+                     for observed in requests]
+            return loop.run_until_complete(asyncio.gather(*tasks))
+        finally:
+            loop.run_until_complete(server.close())
+            loop.close()
+
+    def test_batches(self):
+        server = hmm_server.decoding_server(self.model, batch_size=8,
+                                            workers=0)
+        observed = ['CTTCATGTGAAAGCAG', 'CTTCATGTGAAAGCAGACGTAAGTCA',
+                    'CTTCATGTGAAAGCAGACATAAGTCA', 'CTTCATXTG'] * 5
+        responses = self._run(server, observed)
+        for seq, (status, body) in zip(observed, responses):
+            path, score = self.model.viterbi_path(seq)
+            self.assertEqual(status, 200)
+            self.assertEqual(body['path'], path)
+            self.assertEqual(body['score'], score)
+        metrics = server.metrics()
+        self.assertEqual(metrics['completed'], 20)
+        self.assertTrue(metrics['batches'] < 20)
+        self.assertTrue(metrics['largest_batch'] <= 8)
+
+    def test_backpressure(self):
+        server = hmm_server.decoding_server(self.model, batch_size=1,
+                                            max_queue=2, workers=0)
+        responses = self._run(server, ['CTTCATGTGAAAGCAG' * 50] * 10)
+        statuses = [status for status, body in responses]
+        self.assertTrue(503 in statuses)
+        self.assertEqual(statuses.count(200), server.metrics()['completed'])
+        self.assertEqual(statuses.count(503), server.metrics()['rejected'])
+
+    def test_bad_request(self):
+        # a request that cannot be decoded fails alone, not with its batch
+        server = hmm_server.decoding_server(self.model, batch_size=16,
+                                            workers=0)
+        observed = ['CTTCATGTGAAAGCAG'] * 10
+        responses = self._run(server, observed + [5, ['C', 5]])
+        self.assertEqual([status for status, body in responses],
+                         [200] * 10 + [400, 400])
+        self.assertEqual(server.metrics()['requests'], 10)
+
+        server = hmm_server.decoding_server(self.model, batch_size=16,
+                                            workers=0)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(server.start())
+            tasks = [loop.create_task(server.decode(seq))
+                     for seq in observed + [5]]
+            results = loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            loop.run_until_complete(server.close())
+            loop.close()
+        self.assertEqual(results[:10],
+                         [self.model.viterbi_path(observed[0])] * 10)
+        self.assertIsInstance(results[10], TypeError)
+        metrics = server.metrics()
+        self.assertEqual(metrics['completed'], 10)
+        self.assertEqual(metrics['errors'], 1)
+        self.assertEqual(metrics['batches'], 1)
+
+class TestTrellisCache(unittest.TestCase):
+
+    def setUp(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        self.model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+        self.cached = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+    def test_shared_prefixes(self):
+        cache = hmm.trellis_cache()
+        self.cached.use_cache(cache)
+        for observed in ('CTTCATGTGAAAGCAG', 'CTTCATGTGAAAGCAGACGTAAGTCA',
+                         'CTTCATGTGAAAGCAGACATAAGTCA', 'CTTCATG'):
+            self.assertEqual(self.cached.viterbi_path(observed),
+                             self.model.viterbi_path(observed))
+            self.assertEqual(self.cached.trellis(observed),
+                             self.model.trellis(observed))
+        self.assertEqual(cache.misses, 16 + 10 + 8)
+        self.assertEqual(cache.hits, 16 + 16 + 26 + 18 + 26 + 7 + 7)
+        self.assertEqual(len(cache), 34)
+
+        self.assertEqual(self.cached.extend_trellis('CTTCATG', 'TGAT'),
+                         self.model.trellis('CTTCATGTGAT')[7:])
+        self.assertEqual(cache.misses, 34 + 1)
+
+    def test_eviction(self):
+        cache = hmm.trellis_cache(10)
+        self.cached.use_cache(cache)
+        self.cached.viterbi_path('CTTCATGT')
+        self.cached.viterbi_path('GAAAGCAG')
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(cache.evictions, 6)
+        # the end of the first sequence was evicted, but its start remains
+        self.assertEqual(self.cached.viterbi_path('CTTCATGT'),
+                         self.model.viterbi_path('CTTCATGT'))
+        self.assertEqual(cache.hits, 2)
+
+    def test_instrumentation(self):
+        # only the columns computed are counted, not those reused
+        records = []
+        self.cached.use_cache(hmm.trellis_cache())
+        self.cached.instrument(hmm.stats(records.append))
+        self.model.instrument(hmm.stats(records.append))
+        self.cached.viterbi_path('CTTCATGTGA')
+        self.model.viterbi_path('CTTCATGTGA')
+        self.cached.viterbi_path('CTTCATGTGAAA')
+        self.cached.trellis('CTTCATGTGAAA')
+        uncached, cached = records[1], records[0]
+        for key in ('cells', 'transitions', 'pruned'):
+            self.assertEqual(cached[key], uncached[key])
+        self.assertTrue(cached['seconds']['forward'] > 0.0)
+        self.assertEqual(records[2]['cells'], 6)
+        self.assertEqual(records[2]['transitions'], 4 + 4)
+        self.assertEqual(records[3]['cells'], 0)
+        self.assertEqual(records[3]['transitions'], 0)
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        self.model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+    def test_viterbi_counts(self):
+        records = []
+        stats = hmm.stats(records.append)
+        self.model.instrument(stats)
+        self.model.viterbi_path('CTTCATGTGA')
+        self.model.viterbi_path('CTTCATGTGA')
+
+        self.assertEqual(len(records), 2)
+        first, second = records
+        self.assertEqual(first['method'], 'viterbi_path')
+        self.assertEqual(first['length'], 10)
+        self.assertEqual(first['cells'], 30)
+        # 'C' and 'T' cannot be emitted by '5', so only the edges into 'E'
+        # and 'I' are evaluated at those positions
+        self.assertEqual(first['transitions'], 3 + 3 + 3 + 4 + 3 + 4 + 3 +
+                                               4 + 4)
+        self.assertEqual(first['pruned'], 2 + 2 + 2 + 2 + 1 + 1 + 0 +
+                                          1 + 0 + 0)
+        # the logs of 3 initial, 3 terminal, 4 transition and 12 emission
+        # probabilities
+        self.assertEqual(first['log10_calls'], 3 + 3 + 4 + 12)
+        self.assertTrue(first['seconds']['compile'] > 0.0)
+        self.assertEqual(second['log10_calls'], 0)
+        self.assertEqual(second['seconds']['compile'], 0.0)
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual(stats.cells, 60)
+
+        # one log per scale of the forward pass; the work of other models
+        # is not counted
+        other = pickle.loads(pickle.dumps(self.model))
+        other.compile()
+        self.model.likelihood('CTTCATGTGA')
+        other.likelihood('CTTCATGTGA')
+        self.assertEqual(records[-1]['log10_calls'], 10 + 1)
+
+    def test_disabled(self):
+        stats = hmm.stats()
+        self.model.instrument(stats)
+        self.model.likelihood('CTTCA')
+        self.model.instrument(None)
+        self.model.likelihood('CTTCA')
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual(stats.last['method'], 'likelihood')
+        hmm.train_hmm([('CTTCA', 'EEEEE')], stats=stats)
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual(stats.length, 10)
+
+class TestEncodedInput(unittest.TestCase):
+
+    def setUp(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        self.model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+    def test_raw_and_encoded(self):
+        observed = 'CTTCATGTGAAAGCAGACGTAAGTCA'
+        expected = self.model.viterbi_path(list(observed))
+        raw = observed.encode('ascii')
+        for seq in (raw, bytearray(raw), memoryview(raw),
+                    self.model.encode(raw), self.model.encode(observed)):
+            self.assertEqual(self.model.viterbi_path(seq), expected)
+            self.assertAlmostEqual(self.model.likelihood(seq),
+                                   self.model.likelihood(observed))
+            self.assertEqual(self.model.score(expected[0], seq),
+                             self.model.score(expected[0], observed))
+        self.assertEqual(self.model.viterbi_path(b'CTXA'), (None, None))
+
+    def test_readers(self):
+        fasta = io.BytesIO(b'>one\nCTTCATGTGA\nAAGCAGACGT\n\n>two\nCA\n')
+        self.assertEqual(list(hmm.read_fasta(fasta)),
+                         [('one', b'CTTCATGTGAAAGCAGACGT'), ('two', b'CA')])
+        lines = io.BytesIO(b'CTTCA\n\nGTGA\n')
+        self.assertEqual(list(hmm.read_lines(lines)), [b'CTTCA', b'GTGA'])
+
+    def test_train_from_bytes(self):
+        training_data = [('CTTCATGTGAAAGCAGACGTAAGTCA',
+                          'EEEEEEEEEEEEEEEEEE5IIIIIII'),
+                         ('CTTCATGTGAAAGCAGACATAAGTCA',
+                          'EEEEEEEEEEEEEEEEEE5IIIIIII')]
+        model = hmm.train_hmm(training_data, True)
+        model2 = hmm.train_hmm([(symbols.encode('ascii'),
+                                 states.encode('ascii'))
+                                for symbols, states in training_data], True)
+        self.assertEqual(model2.states['E'].p_transition,
+                         model.states['E'].p_transition)
+        self.assertEqual(model2.states['5'].p_emission,
+                         model.states['5'].p_emission)
+        self.assertEqual(model2.states['I'].p_termination,
+                         model.states['I'].p_termination)
+
+class TestCommandLine(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def _file(self, name, contents=None):
+        filename = os.path.join(self.directory, name)
+        if contents is not None:
+            f = open(filename, 'wb')
+            f.write(contents)
+            f.close()
+        return filename
+
+    def test_train_and_decode(self):
+        training = self._file('training.txt',
+                              b'CTTCATGTGAAAGCAGACGTAAGTCA\t'
+                              b'EEEEEEEEEEEEEEEEEE5IIIIIII\n'
+                              b'CTTCATGTGAAAGCAGACATAAGTCA\t'
+                              b'EEEEEEEEEEEEEEEEEE5IIIIIII\n')
+        model = self._file('model.hmm')
+        fasta = self._file('input.fa', b'>one\nCTTCATGTGAAAGC\n'
+                                       b'AGACGTAAGTCA\n>two\nCCCC\n')
+        paths = self._file('paths.txt')
+        scores = self._file('scores.txt')
+
+        stderr = sys.stderr
+        sys.stderr = io.StringIO() if sys.version_info[0] > 2 else \
+                     io.BytesIO()
+        try:
+            hmm_cli.main(['train', training, '-o', model, '--terminal'])
+            hmm_cli.main(['decode', model, fasta, '-o', paths,
+                          '--workers', '1'])
+            hmm_cli.main(['score', model, fasta, '-o', scores,
+                          '--workers', '1'])
+            report = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+
+        trained = hmm.load(model)
+        path, p = trained.viterbi_path('CTTCATGTGAAAGCAGACGTAAGTCA')
+        self.assertEqual(open(paths).read().splitlines(),
+                         ['one\t%r\t%s' % (p, ''.join(path)),
+                          'two\t-inf\t-'])
+        self.assertEqual(open(scores).read().splitlines()[0],
+                         'one\t%r' % trained.likelihood(
+                                          'CTTCATGTGAAAGCAGACGTAAGTCA'))
+        self.assertTrue('2 sequences, 30 symbols' in report)
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        self.model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+
+    def test_terminal_state(self):
+        samples = list(self.model.sample(200, seed=1))
+        self.assertEqual(samples, list(self.model.sample(200, seed=1)))
+        lengths = set()
+        for symbols, states in samples:
+            # every sequence is E...E5I...I, and ends where it may
+            self.assertEqual(''.join(states).strip('E').strip('I'), '5')
+            self.assertNotEqual(self.model.score(states, symbols), None)
+            lengths.add(len(states))
+        self.assertTrue(len(lengths) > 10)
+
+        # with a length, the sequences need not end in a terminating state
+        samples = list(self.model.sample(20, length=8, seed=1))
+        self.assertEqual([len(states) for symbols, states in samples],
+                         [8] * 20)
+        for symbols, states in samples:
+            rest = ''.join(states).lstrip('E')
+            self.assertTrue(rest == '' or rest == '5' + 'I' * (len(rest) - 1))
+
+    def test_encoded(self):
+        names = self.model.compile().names
+        for (symbols, states), (codes, path) in zip(
+                self.model.sample(20, seed=2),
+                self.model.sample(20, seed=2, encoded=True)):
+            self.assertEqual(list(codes), list(self.model.encode(symbols)))
+            self.assertEqual([names[i] for i in path], states)
+        stream = self.model.sample(None, length=3)
+        self.assertEqual(len(list(itertools.islice(stream, 2500))), 2500)
+        no_terminal = hmm.hmm(['A'], [hmm.state('S', 1.0, {'A': 1.0},
+                                                {'S': 1.0})])
+        self.assertRaises(ValueError, list, no_terminal.sample())
+        self.assertEqual(list(no_terminal.sample(1, length=3)),
+                         [(['A'] * 3, ['S'] * 3)])
+
+    def test_empty(self):
+        self.assertEqual(list(self.model.sample(2, length=0)),
+                         [([], []), ([], [])])
+        self.assertEqual(list(self.model.sample(2, max_length=0)),
+                         [([], []), ([], [])])
+        # both samplers agree
+        c = self.model.compile()
+        rows = c._sampling_rows(False)
+        samplers = [c._sample_python([c._cumulative(r) for r in rows],
+                                     2, 0, 1)]
+        if hmm.numpy is not None:
+            samplers.append(c._sample_numpy([c._alias_tables(r)
+                                             for r in rows], 2, 0, 1, 1024))
+        for sampler in samplers:
+            self.assertEqual([(list(codes), list(path))
+                              for codes, path in sampler], [([], [])] * 2)
+
+class TestSerialization(unittest.TestCase):
+
+    def setUp(self):
+        s1 = hmm.state('E', 1.0,
+                       {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25},
+                       {'E': 0.9, '5': 0.1})
+        s2 = hmm.state('5', 0.0,
+                       {'A': 0.05, 'C': 0.0, 'G': 0.95, 'T': 0.0},
+                       {'I': 1.0})
+        s3 = hmm.state('I', 0.0,
+                       {'A': 0.4, 'C': 0.1, 'G': 0.1, 'T': 0.4},
+                       {'I': 0.9},
+                       0.1)
+        self.model = hmm.hmm(['A', 'C', 'G', 'T'], [s1, s2, s3])
+        fd, self.filename = tempfile.mkstemp(suffix='.hmm')
+        os.close(fd)
+        self.model.save(self.filename)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_round_trip(self):
+        observed = 'CTTCATGTGAAAGCAGACGTAAGTCA'
+        for use_mmap in (True, False):
+            model = hmm.load(self.filename, use_mmap)
+            self.assertEqual(model.viterbi_path(observed),
+                             self.model.viterbi_path(observed))
+            self.assertAlmostEqual(model.likelihood(observed),
+                                   self.model.likelihood(observed))
+            self.assertEqual(model.terminating_states, ['I'])
+            self.assertAlmostEqual(model.states['5'].p_emission['G'], 0.95)
+            self.assertAlmostEqual(model.states['I'].p_termination, 0.1)
+
+    @unittest.skipIf(hmm.numpy is None, 'numpy is not installed')
+    def test_shared_tables(self):
+        # a loaded model decodes, scores and prunes with the tables of the
+        # file, without building lists of them
+        observed = 'CTTCATGTGAAAGCAGACGTAAGTCA'
+        model = hmm.load(self.filename)
+        path, p = model.viterbi_path(observed)
+        self.assertEqual(path, self.model.viterbi_path(observed)[0])
+        self.assertAlmostEqual(model.score(path, observed),
+                               self.model.score(path, observed))
+        self.assertEqual([sorted(live) for live in model.live_states('CGAT')],
+                         [['E'], ['5', 'E'], ['5', 'I'], ['I']])
+        self.assertEqual(list(model.decode_many([observed], workers=1)),
+                         [(path, p)])
+        c = model._model()
+        self.assertIsInstance(c.engine(), hmm._numpy_engine)
+        for key in ('log_transition', 'log_emission', 'predecessors',
+                    'successors'):
+            self.assertFalse(key in c.__dict__)
+
+    def test_pickle_loaded(self):
+        model = pickle.loads(pickle.dumps(hmm.load(self.filename)))
+        self.assertEqual(model.viterbi_path('ACGTAAGTCA'),
+                         self.model.viterbi_path('ACGTAAGTCA'))
+
+    def test_not_a_model(self):
+        f = open(self.filename, 'wb')
+        f.write(b'ACGT' * 8)
+        f.close()
+        self.assertRaises(ValueError, hmm.load, self.filename)
+
 class TestHMMRepr(unittest.TestCase):
 
     def test_repr(self):
@@ -142,6 +1319,32 @@ class TestHMMTraining(unittest.TestCase):
         self.assertTrue(model.terminal_state)
         self.assertEqual(model.terminating_states, ['I'])
 
+    def test_merged_counts(self):
+        training_data = [('CTTCATGTGAAAGCAGACGTAAGTCA',
+                          'EEEEEEEEEEEEEEEEEE5IIIIIII'),
+                         ('CTTCATGTGAAAGCAGACATAAGTCA',
+                          'EEEEEEEEEEEEEEEEEE5IIIIIII'),
+                         ('GATTACA', 'EEE5III')]
+        model = hmm.train_hmm(iter(training_data), True)
+
+        first = hmm.training_counts()
+        first.add(*training_data[0])
+        rest = hmm.training_counts().update(training_data[1:])
+        merged = first.merge(rest).model(True)
+
+        self.assertEqual(merged.states['E'].p_initial, 1.0)
+        self.assertEqual(sorted(merged.alphabet), sorted(model.alphabet))
+        for name in ['E', '5', 'I']:
+            self.assertEqual(merged.states[name].p_emission,
+                             model.states[name].p_emission)
+            self.assertEqual(merged.states[name].p_transition,
+                             model.states[name].p_transition)
+            self.assertEqual(merged.states[name].p_termination,
+                             model.states[name].p_termination)
+        self.assertAlmostEqual(merged.states['I'].p_termination, 3 / 17.0)
+
+        self.assertRaises(ValueError, hmm.train_hmm, [('GATTACA', 'EEE5')])
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)